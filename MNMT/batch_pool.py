@@ -0,0 +1,191 @@
+# Copyright 2017, Center of Speech and Language of Tsinghua University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Multiprocess batch producer for MNMT training.
+
+Building a MNMT batch (memory, encoder_hs, memory alignments) is pure Python work
+which runs in the training thread and can not overlap with TensorFlow.
+BatchPool forks worker processes which share the training set and the memory tables
+with the trainer, build get_batch tuples and return them through shared-memory slots,
+so the large arrays are never pickled. The trainer thread only waits for the next
+batch: the memory distribution is scattered by word id in the graph.
+
+The pool must be created before the tf.Session: the workers are forked, and a fork
+only copies the thread that calls it, not the threads of a running session.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ctypes
+import multiprocessing
+import random
+import time
+
+import numpy as np
+from six.moves import xrange
+
+SEED = 123
+
+_ALIGN = 8  # byte alignment of every array inside a slot
+
+
+def _aligned(nbytes):
+    return (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _pack(batch, buf):
+    """Copy a get_batch tuple into a shared buffer.
+
+    Lists of per-step vectors (encoder_inputs, decoder_inputs, ...) are stacked into
+    one array, None items are skipped, everything else is written as it is.
+
+    Returns:
+        A list of (is_list, dtype, shape, offset) describing where each item was written,
+        with a None dtype for the None items.
+    """
+    specs = []
+    offset = 0
+    for item in batch:
+        if item is None:
+            specs.append((False, None, None, offset))
+            continue
+        is_list = isinstance(item, list) and len(item) > 0 and isinstance(item[0], np.ndarray)
+        arr = np.stack(item) if is_list else np.asarray(item)
+        if arr.dtype == np.int64:
+            arr = arr.astype(np.int32)
+        if offset + arr.nbytes > len(buf):
+            raise ValueError("Batch does not fit into a slot of %d bytes." % len(buf))
+        view = np.frombuffer(buf, dtype=arr.dtype, count=arr.size, offset=offset)
+        view[:] = arr.reshape(-1)
+        specs.append((is_list, arr.dtype.str, arr.shape, offset))
+        offset += _aligned(arr.nbytes)
+    return specs
+
+
+def _unpack(buf, specs):
+    """Rebuild a get_batch tuple as views on a shared buffer."""
+    batch = []
+    for is_list, dtype, shape, offset in specs:
+        if dtype is None:
+            batch.append(None)
+            continue
+        arr = np.frombuffer(buf, dtype=np.dtype(dtype), count=int(np.prod(shape)),
+                            offset=offset).reshape(shape)
+        batch.append(list(arr) if is_list else arr)
+    return tuple(batch)
+
+
+class BatchPool(object):
+    """A pool of processes producing training batches for a MNMT model.
+
+    Batches come back in the order they are finished. The arrays of a batch are
+    views on a shared slot which is recycled by the next call of
+    next_batch, so a batch must not be kept after the training step that consumes it.
+    Call close when training stops, also when it fails, to stop the workers.
+    """
+
+    def __init__(self, model, data, buckets_scale, mems2t, memt2s, num_workers, num_slots=None):
+        """Fork the workers. No tf.Session may be running yet.
+
+        Args:
+            model: the Seq2SeqModel whose get_batch builds the batches. Workers only use
+                its bucket and batch settings, never the TensorFlow graph.
+            data: the training set, as returned by read_data.
+            buckets_scale: the increasing bucket boundaries in [0, 1] used to pick a bucket
+                according to the data distribution.
+            mems2t: the source to target memory table.
+            memt2s: the target to source memory table.
+            num_workers: the number of worker processes.
+            num_slots: the number of shared batch slots; defaults to num_workers + 1.
+        """
+        self._model = model
+        self._data = data
+        self._buckets_scale = buckets_scale
+        self._mems2t = mems2t
+        self._memt2s = memt2s
+        self._held = None
+
+        num_slots = num_slots or num_workers + 1
+        slot_size = max(self._batch_nbytes(b) for b in xrange(len(model.buckets)))
+        self._buffers = [multiprocessing.RawArray(ctypes.c_byte, slot_size) for _ in xrange(num_slots)]
+        self._free = multiprocessing.Queue()
+        self._ready = multiprocessing.Queue()
+        for slot in xrange(num_slots):
+            self._free.put(slot)
+
+        self._workers = []
+        for worker_id in xrange(num_workers):
+            worker = multiprocessing.Process(target=self._work, args=(worker_id,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _batch_nbytes(self, bucket_id):
+        """The largest size of a packed batch of the given bucket, with every array 4 bytes per item."""
+        encoder_size, decoder_size = self._model.buckets[bucket_id]
+        mem_size = self._model.mem_capacity(encoder_size)
+        batch_size = self._model.batch_size
+        shapes = [(encoder_size, batch_size),  # encoder_inputs
+                  (batch_size, encoder_size),  # encoder_mask
+                  (batch_size, mem_size),  # encoder_ids
+                  (batch_size, mem_size, encoder_size),  # encoder_hs
+                  (batch_size, mem_size),  # mem_mask
+                  (decoder_size, batch_size),  # decoder_inputs
+                  (decoder_size, batch_size),  # target_weights
+                  (decoder_size, batch_size, mem_size),  # decoder_aligns
+                  (decoder_size, batch_size)]  # decoder_align_weights
+        return sum(_aligned(4 * int(np.prod(shape))) for shape in shapes)
+
+    def _work(self, worker_id):
+        # forked workers would otherwise draw exactly the same batches
+        random.seed(SEED + worker_id + 1)
+        np.random.seed(SEED + worker_id + 1)
+        while True:
+            slot = self._free.get()
+            if slot is None:
+                break
+            random_number_01 = np.random.random_sample()
+            bucket_id = min([i for i in xrange(len(self._buckets_scale))
+                             if self._buckets_scale[i] > random_number_01])
+            batch = self._model.get_batch(self._data, bucket_id, self._mems2t, self._memt2s)
+            specs = _pack(batch, self._buffers[slot])
+            self._ready.put((slot, bucket_id, specs))
+
+    def next_batch(self):
+        """Wait for the next finished batch.
+
+        The slot of the previously returned batch is handed back to the workers.
+
+        Returns:
+            A pair (bucket_id, batch) where batch is the tuple returned by get_batch.
+        """
+        if self._held is not None:
+            self._free.put(self._held)
+        slot, bucket_id, specs = self._ready.get()
+        self._held = slot
+        return bucket_id, _unpack(self._buffers[slot], specs)
+
+    def close(self, timeout=10.0):
+        """Stop the workers, and terminate those still busy after timeout seconds."""
+        for _ in self._workers:
+            self._free.put(None)
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            worker.join(max(deadline - time.time(), 0.0))
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._workers = []
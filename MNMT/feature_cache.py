@@ -0,0 +1,103 @@
+# Copyright 2017, Center of Speech and Language of Tsinghua University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Cache of the frozen NMT features used by the memory attention of MNMT.
+
+MNMT only trains the memory attention, whose inputs from the NMT model (the encoder
+annotations and the query of each decoder step) do not depend on it. They are extracted
+once per sentence and stored in memory-mapped .npy files, one pair of files per bucket:
+states_<bucket>.npy [sentences x encoder_size x attn_size] and
+queries_<bucket>.npy [sentences x decoder_size x query_size], in the order of the
+sentences in the bucket.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+from six.moves import xrange
+
+
+def _feature_path(path, name, bucket_id):
+    return os.path.join(path, "%s_%d.npy" % (name, bucket_id))
+
+
+def write_features(path, data_set, batch_size, extract_fn, dtype=np.float16):
+    """Extract and store the features of every sentence of a data set.
+
+    Args:
+        path: the directory of the cache.
+        data_set: a list of buckets of (source, target) pairs, as returned by read_data.
+        batch_size: the number of pairs given to extract_fn at once.
+        extract_fn: a function (pairs, bucket_id) -> (attention_states, queries).
+        dtype: the dtype of the stored features; float16 halves the size of the cache.
+
+    Returns:
+        The size of the cache in bytes.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    nbytes = 0
+    for bucket_id, pairs in enumerate(data_set):
+        states, queries = None, None
+        for start in xrange(0, len(pairs), batch_size):
+            batch_states, batch_queries = extract_fn(pairs[start:start + batch_size], bucket_id)
+            if states is None:
+                states = np.lib.format.open_memmap(_feature_path(path, "states", bucket_id), mode="w+",
+                                                   dtype=dtype, shape=(len(pairs),) + batch_states.shape[1:])
+                queries = np.lib.format.open_memmap(_feature_path(path, "queries", bucket_id), mode="w+",
+                                                    dtype=dtype, shape=(len(pairs),) + batch_queries.shape[1:])
+            states[start:start + len(batch_states)] = batch_states
+            queries[start:start + len(batch_queries)] = batch_queries
+        if states is not None:
+            states.flush()
+            queries.flush()
+            nbytes += states.nbytes + queries.nbytes
+            del states, queries
+    return nbytes
+
+
+class FeatureCache(object):
+    """Read access to the features written by write_features."""
+
+    def __init__(self, path, data_set):
+        """Memory-map the features of a data set.
+
+        Args:
+            path: the directory of the cache.
+            data_set: the data set the features were extracted from.
+
+        Raises:
+            ValueError: if the cache does not match the data set.
+        """
+        self._states = []
+        self._queries = []
+        for bucket_id, pairs in enumerate(data_set):
+            states, queries = None, None
+            if pairs:
+                states = np.load(_feature_path(path, "states", bucket_id), mmap_mode="r")
+                queries = np.load(_feature_path(path, "queries", bucket_id), mmap_mode="r")
+                if len(states) != len(pairs) or len(queries) != len(pairs):
+                    raise ValueError("The features of bucket %d in %s do not match the data, extract them again."
+                                     % (bucket_id, path))
+            self._states.append(states)
+            self._queries.append(queries)
+
+    def get(self, bucket_id, indices):
+        """Returns the pair (attention_states, queries) of the given sentences of a bucket as float32 arrays."""
+        return (self._states[bucket_id][indices].astype(np.float32),
+                self._queries[bucket_id][indices].astype(np.float32))
@@ -247,6 +247,74 @@ class GRUCell(RNNCell):
         return new_h, new_h
 
 
+class ProjectedGRUCell(RNNCell):
+    """GRU cell fed with input projections computed for the whole sequence.
+
+    GRUCell multiplies [inputs, state] by its weights at every step, although the
+    input half of that product does not depend on the recurrence. This cell has
+    the same variables as GRUCell, so their checkpoints are interchangeable, but
+    its inputs are the products returned by project_inputs, computed in one matmul
+    for all time steps; only the state is multiplied inside the recurrence.
+    """
+
+    def __init__(self, num_units, activation=tanh):
+        self._num_units = num_units
+        self._activation = activation
+        self._weight_initializer = orthogonal_initializer()
+        self._state_weights = None
+
+    @property
+    def state_size(self):
+        return self._num_units
+
+    @property
+    def output_size(self):
+        return self._num_units
+
+    def project_inputs(self, inputs, scope=None):
+        """Multiply inputs by the input rows of the gate and candidate weights.
+
+        Args:
+          inputs: a 2D Tensor [n x input_size], e.g. the inputs of all time steps
+            concatenated along the batch axis.
+          scope: VariableScope of the weights; defaults to "GRUCell", like GRUCell.
+
+        Returns:
+          A 2D Tensor [n x 3 * num_units]: the input terms of the reset and update
+          gates and of the candidate, to be fed to this cell.
+        """
+        input_size = inputs.get_shape()[1].value
+        with vs.variable_scope(scope or "GRUCell"):
+            with vs.variable_scope("Gates"):
+                with vs.variable_scope("Linear"):
+                    gates = vs.get_variable(
+                            "Matrix", [input_size + self._num_units, 2 * self._num_units],
+                            dtype=inputs.dtype, initializer=self._weight_initializer)
+            with vs.variable_scope("Candidate"):
+                with vs.variable_scope("Linear"):
+                    candidate = vs.get_variable(
+                            "Matrix", [input_size + self._num_units, self._num_units],
+                            dtype=inputs.dtype, initializer=self._weight_initializer)
+        self._state_weights = (array_ops.slice(gates, [input_size, 0], [-1, -1]),
+                               array_ops.slice(candidate, [input_size, 0], [-1, -1]))
+        input_weights = array_ops.concat(1, [array_ops.slice(gates, [0, 0], [input_size, -1]),
+                                             array_ops.slice(candidate, [0, 0], [input_size, -1])])
+        return math_ops.matmul(inputs, input_weights)
+
+    def __call__(self, inputs, state, scope=None):
+        """Gated recurrent unit (GRU) with nunits cells on projected inputs."""
+        if self._state_weights is None:
+            raise ValueError("project_inputs must be called before the cell.")
+        gates_weights, candidate_weights = self._state_weights
+        input_gates = array_ops.slice(inputs, [0, 0], [-1, 2 * self._num_units])
+        input_candidate = array_ops.slice(inputs, [0, 2 * self._num_units], [-1, -1])
+        r, u = array_ops.split(1, 2, input_gates + math_ops.matmul(state, gates_weights))
+        r, u = sigmoid(r), sigmoid(u)
+        c = self._activation(input_candidate + math_ops.matmul(r * state, candidate_weights))
+        new_h = u * state + (1 - u) * c
+        return new_h, new_h
+
+
 _LSTMStateTuple = collections.namedtuple("LSTMStateTuple", ("c", "h"))
 
 
@@ -49,6 +49,8 @@ import tensorflow as tf
 from tensorflow.python.framework import dtypes
 from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.ops import data_flow_ops
 from tensorflow.python.ops import embedding_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
@@ -57,15 +59,93 @@ from tensorflow.python.util import nest
 from tensorflow.python.ops import init_ops
 import rnn_cell
 import rnn
+import data_utils
 
 SEED = 123
 
 linear = rnn_cell._linear2
 
 
+def _tile_beam(tensor, beam_size):
+    """Repeat every row of tensor beam_size times: [batch_size x ...] -> [batch_size * beam_size x ...]."""
+    ndims = tensor.get_shape().ndims
+    tiled = array_ops.tile(array_ops.expand_dims(tensor, 1), [1, beam_size] + [1] * (ndims - 1))
+    tiled = array_ops.reshape(tiled, array_ops.concat(0, [[-1], array_ops.slice(array_ops.shape(tensor), [1], [-1])]))
+    tiled.set_shape([None] + tensor.get_shape().as_list()[1:])
+    return tiled
+
+
+def _true_indices(mask):
+    """The int32 indices of the true entries of a 1D bool Tensor."""
+    return math_ops.to_int32(array_ops.reshape(array_ops.where(mask), [-1]))
+
+
+def _update_finished(finished_probs, finished_steps, finished_rows, eos_probs, step, batch_size, beam_size):
+    """Keep the best hypothesis ending with EOS of each sentence, if it beats its finished one.
+
+    Args:
+        finished_probs: 1D Tensor [batch_size], the scores of the finished hypotheses.
+        finished_steps: 1D int32 Tensor [batch_size], the beam steps at which they ended.
+        finished_rows: 1D int32 Tensor [batch_size], the rows they extended with EOS at that step.
+        eos_probs: 1D Tensor [batch_size * beam_size], the scores of the live hypotheses ending with EOS.
+        step: Integer, the number of the beam step, from 1.
+        batch_size: The number of sentences.
+        beam_size: The number of live hypotheses of each sentence.
+
+    Returns:
+        The updated finished_probs, finished_steps and finished_rows.
+    """
+    eos_probs = array_ops.reshape(eos_probs, [-1, beam_size])
+    best_eos = math_ops.reduce_max(eos_probs, [1])
+    best_rows = math_ops.to_int32(math_ops.argmax(eos_probs, 1)) + math_ops.range(0, batch_size) * beam_size
+    improved = math_ops.greater(best_eos, finished_probs)
+    finished_probs = math_ops.select(improved, best_eos, finished_probs)
+    finished_steps = math_ops.select(improved, array_ops.fill(array_ops.shape(best_rows), step), finished_steps)
+    finished_rows = math_ops.select(improved, best_rows, finished_rows)
+    return finished_probs, finished_steps, finished_rows
+
+
+def _trace_back(step_symbols, step_indices, rows, use_finished, finished_steps, finished_rows, histories):
+    """Follow the back-pointers of beam search from the last step to rebuild the chosen hypotheses.
+
+    Args:
+        step_symbols: A list of 1D Tensors, the symbol of every row chosen at each beam step.
+        step_indices: A list of 1D Tensors, the row of the previous step that every row extends.
+        rows: 1D int32 Tensor [batch_size], the rows of the live hypotheses to rebuild after the last step.
+        use_finished: 1D bool Tensor [batch_size], whether to rebuild the finished hypothesis instead.
+        finished_steps: 1D int32 Tensor [batch_size], see _update_finished.
+        finished_rows: 1D int32 Tensor [batch_size], see _update_finished.
+        histories: A list of lists of Tensors computed for the rows before each beam step, such as
+            the decoder outputs; a list shorter than step_symbols holds the last steps.
+
+    Returns:
+        A pair (symbols, histories): the symbols of the hypotheses, padded with EOS after a
+        finished one, and the histories gathered along them.
+    """
+    num_steps = len(step_symbols)
+    symbols = [None] * num_steps
+    histories = [list(history) for history in histories]
+    for k in reversed(xrange(num_steps)):
+        symbol = array_ops.gather(step_symbols[k], rows)
+        rows = array_ops.gather(step_indices[k], rows)
+        # a finished hypothesis ends with EOS at its step, and continues from the row it extended
+        ended = math_ops.logical_and(use_finished, math_ops.less_equal(finished_steps, k + 1))
+        symbols[k] = math_ops.select(ended, array_ops.fill(array_ops.shape(symbol), data_utils.EOS_ID), symbol)
+        rows = math_ops.select(math_ops.logical_and(use_finished, math_ops.equal(finished_steps, k + 1)),
+                               finished_rows, rows)
+        for history in histories:
+            j = k - (num_steps - len(history))
+            if j >= 0:
+                history[j] = array_ops.gather(history[j], rows)
+    return symbols, histories
+
+
 def _extract_argmax_and_embed(embedding,
                               num_symbols,
-                              update_embedding=True):
+                              update_embedding=True,
+                              shortlist=None,
+                              beam_margin=None,
+                              beam_width=None):
     """Get a loop_function that extracts the previous symbol and embeds it.
 
     Args:
@@ -73,41 +153,193 @@ def _extract_argmax_and_embed(embedding,
       num_symbols: the size of target vocabulary
       update_embedding: Boolean; if False, the gradients will not propagate
         through the embeddings.
+      shortlist: if not None, a pair (ids, mask) of a 1D int32 Tensor of target word ids, which the
+        softmax and the beam search only consider, and a 2D float Tensor [batch_size x number of ids]
+        which is 1 for the ids each sentence may use.
+      beam_margin: if not None, a float or a scalar float Tensor; if positive, the hypotheses whose
+        score is more than beam_margin below the best one of their sentence are dropped from the beam.
+      beam_width: if not None, an int32 scalar Tensor; only the beam_width best hypotheses of each sentence
+        are kept alive, out of the beam_size rows built in the graph.
 
     Returns:
-      A loop function.
+      A loop function (prev, prev_probs, beam_size, d_mem, done, force_eos) -> (emb_prev, probs,
+      index, prev_symbol, eos_probs), where d_mem is the word distribution predicted from the memory,
+      done a boolean scalar Tensor set when the result of the search is known, force_eos an optional
+      boolean Tensor of the rows which must end here, and eos_probs the scores of the hypotheses of
+      prev ending with EOS.
     """
-
-    def loop_function(prev, prev_probs, beam_size, d_mem, _):
-        # combine the output from NMT and memory
-        prev = math_ops.matmul(prev, embedding, transpose_b=True)
-        d_mask = array_ops.constant([[0.0, 0.0, 0.0, 0.0, 0.0] + [1.0] * (num_symbols - 5)], dtype=tf.float32)
-        d_mem = d_mem * d_mask
-        prev = math_ops.log(math_ops.add(nn_ops.softmax(prev), 0.5 * d_mem))
-        # beam search
-        prev = nn_ops.bias_add(array_ops.transpose(prev), prev_probs)  # num_symbols*BEAM_SIZE
-        prev = array_ops.transpose(prev)
-        prev = array_ops.expand_dims(array_ops.reshape(prev, [-1]), 0)  # 1*(BEAM_SIZE*num_symbols)
-        probs, prev_symbolb = nn_ops.top_k(prev, beam_size)
-        probs = array_ops.squeeze(probs, [0])  # BEAM_SIZE,
-        prev_symbolb = array_ops.squeeze(prev_symbolb, [0])  # BEAM_SIZE,
-        index = prev_symbolb // num_symbols
-        prev_symbol = prev_symbolb % num_symbols
+    output_embedding = embedding
+    num_candidates = num_symbols
+    # the special symbols are not predicted from the memory
+    d_mask = array_ops.constant([[0.0, 0.0, 0.0, 0.0, 0.0] + [1.0] * (num_symbols - 5)], dtype=tf.float32)
+    eos_column = math_ops.to_float(math_ops.equal(math_ops.range(0, num_symbols), data_utils.EOS_ID))
+    shortlist_mask = None
+    if shortlist is not None:
+        shortlist, shortlist_mask = shortlist
+        output_embedding = embedding_ops.embedding_lookup(embedding, shortlist)
+        num_candidates = array_ops.shape(shortlist)[0]
+        d_mask = math_ops.to_float(math_ops.greater_equal(shortlist, 5))
+        eos_column = math_ops.to_float(math_ops.equal(shortlist, data_utils.EOS_ID))
+
+    def loop_function(prev, prev_probs, beam_size, d_mem, done, force_eos=None):
+        # the dead hypotheses (pruned, outside the beam width or of a stopped sentence) are not scored
+        live = math_ops.greater(prev_probs, -1e29)
+        live_rows = _true_indices(live)
+
+        def log_probs():
+            # combine the output from NMT and memory
+            logits = math_ops.matmul(array_ops.gather(prev, live_rows), output_embedding, transpose_b=True)
+            mem_probs = array_ops.gather(d_mem, live_rows)
+            if shortlist is not None:
+                mem_probs = array_ops.transpose(array_ops.gather(array_ops.transpose(mem_probs), shortlist))
+            mem_probs = mem_probs * d_mask
+            if shortlist_mask is None:
+                scores = math_ops.log(math_ops.add(nn_ops.softmax(logits), 0.5 * mem_probs))
+            else:
+                # each sentence is decoded over its own shortlist, whatever the other sentences of the batch;
+                # the other words of the union get a finite score far below any word of the shortlist
+                outside = 1.0 - array_ops.gather(_tile_beam(shortlist_mask, beam_size), live_rows)
+                probs = nn_ops.softmax(logits - 1e30 * outside) + 0.5 * mem_probs * (1.0 - outside)
+                scores = math_ops.log(probs + outside) - 1e30 * outside
+            # the dead rows score 0, so they stay far behind every live hypothesis
+            return math_ops.unsorted_segment_sum(scores, live_rows, array_ops.shape(prev)[0])
+
+        # once the search is done, its result does not depend on the scores any more
+        prev = control_flow_ops.cond(done, lambda: array_ops.zeros(
+                array_ops.pack([array_ops.shape(prev)[0], num_candidates])), log_probs)
+        # the hypotheses ending here with EOS go to the finished pool, not to the live beam
+        eos_probs = prev_probs + math_ops.reduce_sum(prev * eos_column, [1])
+        prev -= 1e30 * eos_column
+        if force_eos is not None:
+            prev -= 1e30 * array_ops.expand_dims(math_ops.to_float(force_eos), 1)
+        # beam search: the rows of prev are the beam_size hypotheses of each sentence
+        prev = array_ops.expand_dims(prev_probs, 1) + prev  # (batch_size*BEAM_SIZE)*num_symbols
+        prev = array_ops.reshape(prev, array_ops.pack([-1, beam_size * num_candidates]))  # batch_size*(BEAM_SIZE*num_symbols)
+        # only the sentences with a live hypothesis are searched, the others get dead rows
+        live_sentences = math_ops.reduce_any(array_ops.reshape(live, [-1, beam_size]), [1])
+        searched = _true_indices(live_sentences)
+        stopped = _true_indices(math_ops.logical_not(live_sentences))
+        probs, prev_symbolb = nn_ops.top_k(array_ops.gather(prev, searched), beam_size)  # batch_size*BEAM_SIZE
+        stopped_shape = array_ops.pack([array_ops.size(stopped), beam_size])
+        probs = data_flow_ops.dynamic_stitch([searched, stopped], [probs, array_ops.fill(stopped_shape, -1e30)])
+        prev_symbolb = data_flow_ops.dynamic_stitch(
+                [searched, stopped], [prev_symbolb, array_ops.zeros(stopped_shape, dtype=dtypes.int32)])
+        if beam_margin is not None:
+            # threshold pruning: the hypotheses far behind the best one are dead, which narrows the beam
+            threshold = array_ops.slice(probs, [0, 0], [-1, 1]) - beam_margin
+            pruned = math_ops.logical_and(math_ops.less(probs, threshold), math_ops.greater(beam_margin, 0.0))
+            probs -= 1e30 * math_ops.to_float(pruned)
+        if beam_width is not None:
+            # a narrower beam: the hypotheses after the beam_width best ones of a sentence are dead
+            probs -= 1e30 * math_ops.to_float(math_ops.greater_equal(math_ops.range(0, beam_size), beam_width))
+        # the rows of the extended hypotheses
+        index = prev_symbolb // num_candidates + array_ops.expand_dims(
+                math_ops.range(0, array_ops.shape(prev)[0]) * beam_size, 1)
+        probs = array_ops.reshape(probs, [-1])  # batch_size*BEAM_SIZE,
+        index = array_ops.reshape(index, [-1])
+        prev_symbol = array_ops.reshape(prev_symbolb % num_candidates, [-1])
+        if shortlist is not None:
+            prev_symbol = array_ops.gather(shortlist, prev_symbol)  # back to vocabulary ids
 
         # Note that gradients will not propagate through the second parameter of
         # embedding_lookup.
         emb_prev = embedding_ops.embedding_lookup(embedding, prev_symbol)
         if not update_embedding:
             emb_prev = array_ops.stop_gradient(emb_prev)
-        return emb_prev, probs, index, prev_symbol  # modified by shiyue
+        return emb_prev, probs, index, prev_symbol, eos_probs  # modified by shiyue
 
     return loop_function
 
 
-def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_probs,
-                      encoder_hs, mem_mask, initial_state, attention_states, cell, beam_size,
+def _memory_keys(attention_states, encoder_embeds, encoder_hs, num_heads, attention_vec_size):
+    """The projections of the memory slots the memory attention compares with its queries.
+
+    Called in the variable scope of the attention, by attention_decoder and memory_attention.
+
+    Args:
+        attention_states: 3D Tensor [batch_size x attn_length x attn_size].
+        encoder_embeds: A 3D Tensor [batch_size x mem_size x hidden_emb].
+        encoder_hs: A 3D Tensor [batch_size x mem_size x attn_length].
+        num_heads: Number of attention heads.
+        attention_vec_size: Size of the projections.
+
+    Returns:
+        A pair (vt, hidden_targets) of lists with one element for each head: the vectors of the
+        attention scores and the projected memory [batch_size x mem_size x 1 x attention_vec_size].
+    """
+    attn_size = attention_states.get_shape()[2].value
+    embed_size = encoder_embeds.get_shape()[2].value
+
+    # memory hidden states based on the probability in encoder_hs:
+    # [batch_size x mem_size x attn_length] x [batch_size x attn_length x attn_size],
+    # the number of memory slots differs from batch to batch
+    encoder_hs = math_ops.batch_matmul(encoder_hs, attention_states)
+    encoder_hs.set_shape([None, None, attn_size])
+
+    # merged hidden states are concatenated by target word embeddings
+    mems = array_ops.concat(2, [encoder_hs, encoder_embeds])
+    mems = array_ops.transpose(array_ops.expand_dims(mems, 3), [0, 1, 3, 2])
+
+    vt = []
+    hidden_targets = []
+    for a in xrange(num_heads):
+        vt.append(variable_scope.get_variable("AttnVt_%d" % a, [attention_vec_size],
+                                              initializer=init_ops.constant_initializer(0.0)))
+        kt = variable_scope.get_variable("AttnWt_%d" % a,
+                                         [1, 1, embed_size + attn_size, attention_vec_size],
+                                         initializer=init_ops.random_normal_initializer(0, 0.001, seed=SEED))
+        hidden_targets.append(nn_ops.conv2d(mems, kt, [1, 1, 1, 1], "SAME"))
+    return vt, hidden_targets
+
+
+def _memory_attention_weights(query, vt, hidden_targets, mem_mask, attention_vec_size):
+    """The weights of the memory attention for a query, one [batch_size x mem_size] Tensor for each head.
+
+    Called in the variable scope of the attention, by attention_decoder and memory_attention, with
+    the keys returned by _memory_keys.
+    """
+    as_mem = []
+    for a in xrange(len(vt)):
+        with variable_scope.variable_scope("AttnU_%d" % a):
+            y_mem = linear(query, attention_vec_size, False,
+                           weight_initializer=init_ops.random_normal_initializer(0, 0.001, seed=SEED),
+                           scope="Linear_mem")
+            y_mem = array_ops.reshape(y_mem, [-1, 1, 1, attention_vec_size])
+            # Attention mask is a softmax of v^T * tanh(...).
+            s_mem = math_ops.reduce_sum(vt[a] * math_ops.tanh(hidden_targets[a] + y_mem), [2, 3])
+            s_mem = array_ops.transpose(array_ops.transpose(s_mem) - math_ops.reduce_max(s_mem, [1]))
+            s_mem = math_ops.exp(s_mem)
+            s_mem = mem_mask * s_mem
+            as_mem.append(array_ops.transpose(array_ops.transpose(s_mem) / math_ops.reduce_sum(s_mem, [1])))
+    return as_mem
+
+
+def _memory_distribution(a_mem, encoder_ids, mem_mask, num_symbols):
+    """The word distribution predicted from the memory: the weight of each slot goes to its target word.
+
+    This is the product of a_mem with the one-hot vectors of the words in memory, without building
+    them as a [batch_size x mem_size x num_symbols] Tensor.
+
+    Args:
+        a_mem: A 2D Tensor [batch_size x mem_size], the memory attention weights.
+        encoder_ids: A 2D int32 Tensor [batch_size x mem_size], the target word ids in memory.
+        mem_mask: A 2D Tensor [batch_size x mem_size], 0 for the empty slots.
+        num_symbols: Integer, the size of the target vocabulary.
+
+    Returns:
+        A 2D Tensor [batch_size x num_symbols].
+    """
+    rows = array_ops.shape(a_mem)[0]
+    word_ids = encoder_ids + array_ops.expand_dims(math_ops.range(0, rows) * num_symbols, 1)
+    d_mem = math_ops.unsorted_segment_sum(array_ops.reshape(a_mem * mem_mask, [-1]),
+                                          array_ops.reshape(word_ids, [-1]), rows * num_symbols)
+    return array_ops.reshape(d_mem, [-1, num_symbols])
+
+
+def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_ids,
+                      encoder_hs, mem_mask, initial_state, attention_states, cell, num_symbols, beam_size,
                       output_size=None, num_heads=1, num_layers=1, loop_function=None,
-                      dtype=dtypes.float32, scope=None, initial_state_attention=False):
+                      dtype=dtypes.float32, scope=None, initial_state_attention=False, max_length_ratio=0.0):
     """RNN decoder with attention for the sequence-to-sequence model.
 
     In this context "attention" means that, during decoding, the RNN can look up
@@ -118,13 +350,16 @@ def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_prob
     Args:
         encoder_mask: A 2D Tensor [batch_size x input_size]
         decoder_inputs: A list of 3D Tensors [batch_size x input_size x hidden_emb].
-        encoder_embeds: A 3D Tensor [batch_size x 2*input_size x hidden_emb]
-        encoder_probs: A 3D Tensor [batch_size x 2*input_size x target_vocab_size]
-        encoder_hs: A 3D Tensor [batch_size x 2*input_size x input_size]
-        mem_mask:  A 2D Tensor [batch_size x 2*input_size]
+        encoder_embeds: A 3D Tensor [batch_size x mem_size x hidden_emb]
+        encoder_ids: A 2D int32 Tensor [batch_size x mem_size], the target word ids in memory.
+        encoder_hs: A 3D Tensor [batch_size x mem_size x input_size]
+        mem_mask:  A 2D Tensor [batch_size x mem_size]. mem_size is the number of memory slots,
+            it may change from batch to batch.
         initial_state: 2D Tensor [batch_size x cell.state_size].
         attention_states: 3D Tensor [batch_size x attn_length x attn_size].
         cell: rnn_cell.RNNCell defining the cell function and size.
+        num_symbols: Integer, the size of the target vocabulary.
+        beam_size: Integer, the beam size used in beam search.
         output_size: Size of the output vectors; if None, we use cell.output_size.
         num_heads: Number of attention heads that read from attention_states.
         loop_function: If not None, this function will be applied to i-th output
@@ -136,16 +371,22 @@ def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_prob
             If True, initialize the attentions from the initial state and attention
             states -- useful when we wish to resume decoding from a previously
             stored decoder state and attention states.
+        max_length_ratio: If positive, beam search ends every hypothesis with EOS
+            once it is max_length_ratio times as long as its source sentence.
 
     Returns:
-         A tuple of the form (outputs, state, symbols, logits_mem, aligns_mem), where:
+         A tuple of the form (outputs, state, symbols, logits_mem, aligns_mem, attention_keys), where:
             outputs: A list of the same length as decoder_inputs of 2D Tensors of
                   shape [batch_size x output_size].
             state: The state of each decoder cell the final time-step.
                 It is a 2D Tensor of shape [batch_size x cell.state_size].
-            symbols: A list of target word ids, the best results returned by beam search.
+            symbols: A list of batch-sized Tensors, the best target word ids found by beam search.
             aligns_mem: A list of memory attention weights.
             logits_mem: A list of [batch_size x target_vocab_size].
+            attention_keys: The pair (hidden_features, hidden_targets) of the lists of the projected
+                attention_states [batch_size x attn_length x 1 x attention_vec_size] and of the projected
+                memory [batch_size x mem_size x 1 x attention_vec_size] of each head; feeding them skips
+                the projections.
 
     Raises:
       ValueError: when num_heads is not positive, there are no inputs, shapes
@@ -166,20 +407,10 @@ def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_prob
         batch_size = array_ops.shape(decoder_inputs[0])[0]  # Needed for reshaping.
         attn_length = attention_states.get_shape()[1].value
         attn_size = attention_states.get_shape()[2].value
-        embed_size = encoder_embeds.get_shape()[2].value
         state_size = initial_state.get_shape()[1].value
 
         hidden = array_ops.reshape(attention_states, [-1, attn_length, 1, attn_size])
 
-        # memory hidden states based on the probability in encoder_hs
-        encoder_hs = math_ops.reduce_sum(
-                array_ops.tile(array_ops.reshape(attention_states, [batch_size, 1, attn_length, attn_size]),
-                               [1, 2 * attn_length, 1, 1]) * array_ops.expand_dims(encoder_hs, 3), [2])
-
-        # merged hidden states are concatenated by target word embeddings
-        mems = array_ops.concat(2, [encoder_hs, encoder_embeds])
-        mems = array_ops.transpose(array_ops.expand_dims(mems, 3), [0, 1, 3, 2])
-
         hidden_features = []
         v = []
         attention_vec_size = attn_size // 2  # Size of query vectors for attention.
@@ -188,15 +419,39 @@ def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_prob
                 linear(initial_state, state_size, False,
                        weight_initializer=init_ops.random_normal_initializer(0, 0.01, seed=SEED)))
 
+        # The projections of the source annotations and of the memory do not depend on the decoder step,
+        # so they are computed once per sentence.
+        with variable_scope.variable_scope("attention"):
+            for a in xrange(num_heads):
+                k = variable_scope.get_variable("AttnW_%d" % a, [1, 1, attn_size, attention_vec_size],
+                                                initializer=init_ops.random_normal_initializer(0, 0.001, seed=SEED))
+                hidden_features.append(nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME"))
+                v.append(variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size],
+                                                     initializer=init_ops.constant_initializer(0.0)))
+            vt, hidden_targets = _memory_keys(attention_states, encoder_embeds, encoder_hs, num_heads,
+                                              attention_vec_size)
+        attention_keys = (hidden_features, hidden_targets)
+
+        # Beam search keeps the beam_size hypotheses of each sentence in consecutive rows.
+        beam_rows = 1
+        prev_probs = [0]
+        if loop_function is not None:
+            beam_rows = beam_size
+            hidden = _tile_beam(hidden, beam_size)
+            hidden_features = [_tile_beam(h, beam_size) for h in hidden_features]
+            hidden_targets = [_tile_beam(h, beam_size) for h in hidden_targets]
+            encoder_mask = _tile_beam(encoder_mask, beam_size)
+            encoder_ids = _tile_beam(encoder_ids, beam_size)
+            mem_mask = _tile_beam(mem_mask, beam_size)
+            initial_state = _tile_beam(initial_state, beam_size)
+            decoder_inputs = [_tile_beam(decoder_inputs[0], beam_size)] + decoder_inputs[1:]
+            # only the first hypothesis of each sentence is alive before the first step
+            prev_probs = array_ops.reshape(array_ops.tile(
+                    array_ops.constant([[0.0] + [-1e30] * (beam_size - 1)]), array_ops.pack([batch_size, 1])), [-1])
+
         def attention(query, scope=None):
             """Put attention masks on hidden using hidden_features and query."""
             with variable_scope.variable_scope(scope or "attention"):
-                for a in xrange(num_heads):
-                    k = variable_scope.get_variable("AttnW_%d" % a, [1, 1, attn_size, attention_vec_size],
-                                                    initializer=init_ops.random_normal_initializer(0, 0.001, seed=SEED))
-                    hidden_features.append(nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME"))
-                    v.append(variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size],
-                                                         initializer=init_ops.constant_initializer(0.0)))
                 ds = []  # Results of attention reads will be stored here.
                 aa = []
                 if nest.is_sequence(query):  # If the query is a tuple, flatten it.
@@ -227,18 +482,7 @@ def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_prob
         # memory attention
         def attention_mem(query, scope=None):
             with variable_scope.variable_scope(scope or "attention"):
-                vt = []
-                hidden_targets = []
-                for a in xrange(num_heads):
-                    vt.append(variable_scope.get_variable("AttnVt_%d" % a, [attention_vec_size],
-                                                          initializer=init_ops.constant_initializer(0.0)))
-                    kt = variable_scope.get_variable("AttnWt_%d" % a,
-                                                     [1, 1, embed_size + attn_size, attention_vec_size],
-                                                     initializer=init_ops.random_normal_initializer(0, 0.001, seed=SEED))
-                    hidden_targets.append(nn_ops.conv2d(mems, kt, [1, 1, 1, 1], "SAME"))
-
                 ds_mem = []
-                as_mem = []
                 if nest.is_sequence(query):  # If the query is a tuple, flatten it.
                     query_list = nest.flatten(query)
                     for q in query_list:  # Check that ndims == 2 if specified.
@@ -247,80 +491,104 @@ def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_prob
                             assert ndims == 2
                     query = array_ops.concat(1, query_list)
 
-                for a in xrange(num_heads):
-                    with variable_scope.variable_scope("AttnU_%d" % a):
-                        y_mem = linear(query, attention_vec_size, False,
-                                       weight_initializer=init_ops.random_normal_initializer(0, 0.001, seed=SEED),
-                                       scope="Linear_mem")
-                        y_mem = array_ops.reshape(y_mem, [-1, 1, 1, attention_vec_size])
-                        # Attention mask is a softmax of v^T * tanh(...).
-                        s_mem = math_ops.reduce_sum(vt[a] * math_ops.tanh(hidden_targets[a] + y_mem), [2, 3])
-                        s_mem = array_ops.transpose(array_ops.transpose(s_mem) - math_ops.reduce_max(s_mem, [1]))
-                        s_mem = math_ops.exp(s_mem)
-                        s_mem = mem_mask * s_mem
-                        a_mem = array_ops.transpose(array_ops.transpose(s_mem) / math_ops.reduce_sum(s_mem, [1]))
-                        as_mem.append(a_mem)
-                        # Now calculate the attention-weighted vector d.
-                        d_mem = math_ops.reduce_sum(array_ops.expand_dims(a_mem, 2) * encoder_probs, [1])
-                        ds_mem.append(d_mem)
+                as_mem = _memory_attention_weights(query, vt, hidden_targets, mem_mask, attention_vec_size)
+                for a_mem in as_mem:
+                    ds_mem.append(_memory_distribution(a_mem, encoder_ids, mem_mask, num_symbols))
             return ds_mem, as_mem
 
+        def decoder_step(inp, out_state, state, attns, i):
+            """Run the attentions, the RNN and the output projection of one decoding step."""
+            step_mem = []
+            # Run the attention mechanism.
+            if i > 0 or (i == 0 and initial_state_attention):
+                attns, aa = attention(out_state, scope="attention")
+                query = array_ops.concat(1, [out_state, inp])
+                logit_mem, align_mem = attention_mem(query, scope="attention")
+                step_mem = [logit_mem[0], align_mem[0], query]
+
+            # Run the RNN.
+            cinp = array_ops.concat(1, [inp, attns[0]])
+            out_state, state = cell(cinp, state)
+
+            with variable_scope.variable_scope("AttnOutputProjection"):
+                output = linear([out_state] + [cinp], output_size, False)
+                output = array_ops.reshape(output, [-1, output_size // 2, 2])
+                output = math_ops.reduce_max(output, 2)  # maxout
+            return [out_state, state] + attns + [output] + step_mem
+
         outputs = []
         logits_mem = []
         aligns_mem = []
+        mem_queries = []  # the queries of the memory attention, cached to train it alone
         output = None
         state = initial_state
         out_state = array_ops.split(1, num_layers, state)[-1]
         prev = None
         prev_d_mem = None
         symbols = []
-        prev_probs = [0]
-        batch_attn_size = array_ops.pack([batch_size, attn_size])
+        batch_attn_size = array_ops.pack([batch_size * beam_rows, attn_size])
         attns = [array_ops.zeros(batch_attn_size, dtype=dtype) for _ in xrange(num_heads)]
         for a in attns:  # Ensure the second shape of attention vectors is set.
             a.set_shape([None, attn_size])
 
+        if loop_function is not None:
+            # The best hypothesis ending with EOS of each sentence, and whether no live hypothesis can beat them.
+            finished_probs = array_ops.fill(array_ops.pack([batch_size]), -1e30)
+            finished_steps = array_ops.zeros(array_ops.pack([batch_size]), dtype=dtypes.int32)
+            finished_rows = array_ops.zeros(array_ops.pack([batch_size]), dtype=dtypes.int32)
+            done = array_ops.constant(False)
+            # the back-pointers of beam search: the rebuilt hypotheses are gathered once at the end
+            step_symbols = []
+            step_indices = []
+            max_lengths = None
+            if max_length_ratio > 0:
+                max_lengths = math_ops.to_int32(math_ops.ceil(
+                        max_length_ratio * math_ops.to_float(math_ops.reduce_sum(encoder_mask, [1]))))
+
         for i, inp in enumerate(decoder_inputs):
             if i > 0:
                 variable_scope.get_variable_scope().reuse_variables()
             # If loop_function is set, we use it instead of decoder_inputs.
             if loop_function is not None and prev is not None:
                 with variable_scope.variable_scope("loop_function", reuse=True):
-                    inp, prev_probs, index, prev_symbol = loop_function(prev, prev_probs, beam_size, prev_d_mem, i)
+                    # the hypotheses reaching the maximum length must end with this symbol
+                    force_eos = None if max_lengths is None else math_ops.less_equal(max_lengths, i - 1)
+                    inp, prev_probs, index, prev_symbol, eos_probs = loop_function(
+                            prev, prev_probs, beam_size, prev_d_mem, done, force_eos)
+                    finished_probs, finished_steps, finished_rows = _update_finished(
+                            finished_probs, finished_steps, finished_rows, eos_probs, i, batch_size, beam_size)
+                    # a sentence whose live hypotheses all fall behind its finished one is over: its rows die
+                    stopped = math_ops.less(
+                            math_ops.reduce_max(array_ops.reshape(prev_probs, [-1, beam_size]), [1]), finished_probs)
+                    done = math_ops.reduce_all(stopped)
+                    prev_probs -= 1e30 * _tile_beam(math_ops.to_float(stopped), beam_size)
                     out_state = array_ops.gather(out_state, index)  # update prev state
                     state = array_ops.gather(state, index)  # update prev state
                     attns = [array_ops.gather(attn, index) for attn in attns]  # update prev attens
-                    for j, output in enumerate(outputs):
-                        outputs[j] = array_ops.gather(output, index)  # update prev outputs
-                    for j, symbol in enumerate(symbols):
-                        symbols[j] = array_ops.gather(symbol, index)  # update prev symbols
-                    for j, logit_mem in enumerate(logits_mem):
-                        logits_mem[j] = array_ops.gather(logit_mem, index)  # update prev outputs
-                    for j, align_mem in enumerate(aligns_mem):
-                        aligns_mem[j] = array_ops.gather(align_mem, index)  # update prev outputs
-                    symbols.append(prev_symbol)
+                    step_symbols.append(prev_symbol)
+                    step_indices.append(index)
 
             # Merge input and previous attentions into one vector of the right size.
             input_size = inp.get_shape().with_rank(2)[1]
             if input_size.value is None:
                 raise ValueError("Could not infer input size from input: %s" % inp.name)
 
-            # Run the attention mechanism.
-            if i > 0 or (i == 0 and initial_state_attention):
-                attns, aa = attention(out_state, scope="attention")
-                query = array_ops.concat(1, [out_state, inp])
-                logit_mem, align_mem = attention_mem(query, scope="attention")
-                logits_mem.append(logit_mem[0])
-                aligns_mem.append(align_mem[0])
-
-            # Run the RNN.
-            cinp = array_ops.concat(1, [inp, attns[0]])
-            out_state, state = cell(cinp, state)
-
-            with variable_scope.variable_scope("AttnOutputProjection"):
-                output = linear([out_state] + [cinp], output_size, False)
-                output = array_ops.reshape(output, [-1, output_size // 2, 2])
-                output = math_ops.reduce_max(output, 2)  # maxout
+            if loop_function is not None and prev is not None:
+                # Skip the step once the search is done.
+                step_outputs = control_flow_ops.cond(
+                        done, lambda: [out_state, state] + attns + [prev, logits_mem[-1], aligns_mem[-1],
+                                                                    array_ops.concat(1, [out_state, inp])],
+                        lambda: decoder_step(inp, out_state, state, attns, i))
+            else:
+                step_outputs = decoder_step(inp, out_state, state, attns, i)
+            out_state, state = step_outputs[0], step_outputs[1]
+            attns = step_outputs[2:2 + num_heads]
+            output = step_outputs[2 + num_heads]
+            if len(step_outputs) > 3 + num_heads:
+                logit_mem, align_mem, query = step_outputs[3 + num_heads:]
+                mem_queries.append(query)
+                logits_mem.append(logit_mem)
+                aligns_mem.append(align_mem)
 
             if loop_function is not None:
                 prev = output
@@ -329,48 +597,77 @@ def attention_decoder(encoder_mask, decoder_inputs, encoder_embeds, encoder_prob
 
         if loop_function is not None:
             # process the last symbol
-            inp, prev_probs, index, prev_symbol = loop_function(prev, prev_probs, beam_size, prev_d_mem, i + 1)
-            out_state = array_ops.gather(out_state, index)  # update prev state
-            state = array_ops.gather(state, index)  # update prev state
-            for j, output in enumerate(outputs):
-                outputs[j] = array_ops.gather(output, index)  # update prev outputs
-            for j, symbol in enumerate(symbols):
-                symbols[j] = array_ops.gather(symbol, index)  # update prev symbols
-            for j, logit_mem in enumerate(logits_mem):
-                logits_mem[j] = array_ops.gather(logit_mem, index)  # update prev outputs
-            for j, align_mem in enumerate(aligns_mem):
-                aligns_mem[j] = array_ops.gather(align_mem, index)  # update prev outputs
-            symbols.append(prev_symbol)
-
-            # output the final best result of beam search
-            for k, symbol in enumerate(symbols):
-                symbols[k] = array_ops.gather(symbol, 0)
-            out_state = array_ops.expand_dims(array_ops.gather(out_state, 0), 0)
-            state = array_ops.expand_dims(array_ops.gather(state, 0), 0)
-            for j, output in enumerate(outputs):
-                outputs[j] = array_ops.expand_dims(array_ops.gather(output, 0), 0)  # update prev outputs
-            for k, logit_mem in enumerate(logits_mem):
-                logits_mem[k] = array_ops.expand_dims(array_ops.gather(logit_mem, 0), 0)
-            for k, align_mem in enumerate(aligns_mem):
-                aligns_mem[k] = array_ops.expand_dims(array_ops.gather(align_mem, 0), 0)
-    return outputs, state, symbols, logits_mem, aligns_mem
-
-
-def embedding_attention_decoder(encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask,
+            force_eos = None if max_lengths is None else math_ops.less_equal(max_lengths, i)
+            inp, prev_probs, index, prev_symbol, eos_probs = loop_function(
+                    prev, prev_probs, beam_size, prev_d_mem, done, force_eos)
+            finished_probs, finished_steps, finished_rows = _update_finished(
+                    finished_probs, finished_steps, finished_rows, eos_probs, i + 1, batch_size, beam_size)
+            step_symbols.append(prev_symbol)
+            step_indices.append(index)
+
+            # output the final best result of beam search: the best finished hypothesis of each sentence,
+            # unless its first live hypothesis, which did not end, is better
+            best = math_ops.range(0, batch_size) * beam_size
+            use_finished = math_ops.greater_equal(finished_probs, array_ops.gather(prev_probs, best))
+            symbols, (outputs, logits_mem, aligns_mem) = _trace_back(
+                    step_symbols, step_indices, best, use_finished, finished_steps, finished_rows,
+                    [outputs, logits_mem, aligns_mem])
+            out_state = array_ops.gather(out_state, array_ops.gather(index, best))
+            state = array_ops.gather(state, array_ops.gather(index, best))
+        else:
+            # the inputs of the memory attention which do not depend on it, see memory_attention
+            ops.add_to_collection("mem_attention_states", attention_states)
+            ops.add_to_collection("mem_queries", array_ops.pack(mem_queries))
+    return outputs, state, symbols, logits_mem, aligns_mem, attention_keys
+
+
+def memory_attention(attention_states, queries, encoder_embeds, encoder_hs, mem_mask, num_heads=1, scope=None):
+    """The memory attention of attention_decoder, run on its precomputed inputs.
+
+    It builds the same ops, with the same variables, as attention_mem in attention_decoder, through
+    _memory_keys and _memory_attention_weights, so that they can be trained without running the
+    encoder and the decoder RNN.
+
+    Args:
+        attention_states: 3D Tensor [batch_size x attn_length x attn_size].
+        queries: A list of 2D Tensors [batch_size x query_size], the queries of the decoder steps.
+        encoder_embeds: A 3D Tensor [batch_size x mem_size x hidden_emb].
+        encoder_hs: A 3D Tensor [batch_size x mem_size x input_size].
+        mem_mask:  A 2D Tensor [batch_size x mem_size].
+        num_heads: Number of attention heads.
+        scope: VariableScope for the created subgraph; default: "attention".
+
+    Returns:
+        aligns_mem: A list of memory attention weights [batch_size x mem_size], one for each query.
+    """
+    with variable_scope.variable_scope(scope or "attention"):
+        attention_vec_size = attention_states.get_shape()[2].value // 2
+        vt, hidden_targets = _memory_keys(attention_states, encoder_embeds, encoder_hs, num_heads,
+                                          attention_vec_size)
+        aligns_mem = []
+        for i, query in enumerate(queries):
+            if i > 0:
+                variable_scope.get_variable_scope().reuse_variables()
+            aligns_mem.append(_memory_attention_weights(query, vt, hidden_targets, mem_mask,
+                                                        attention_vec_size)[0])
+    return aligns_mem
+
+
+def embedding_attention_decoder(encoder_mask, encoder_ids, encoder_hs, mem_mask,
                                 decoder_inputs, initial_state, attention_states,
                                 cell, num_symbols, embedding_size, beam_size, num_heads=1, num_layers=1,
                                 output_size=None, output_projection=None, feed_previous=False,
-                                update_embedding_for_previous=True,
+                                update_embedding_for_previous=True, shortlist=None,
                                 dtype=dtypes.float32, scope=None,
-                                initial_state_attention=False):
+                                initial_state_attention=False, max_length_ratio=0.0, beam_margin=None,
+                                beam_width=None):
     """RNN decoder with embedding and attention and a pure-decoding option.
 
     Args:
         encoder_mask: A 2D Tensor [batch_size x input_size].
-        encoder_probs: A 3D Tensor [batch_size x 2*input_size x target_vocab_size].
-        encoder_ids: A 2D Tensor [batch_size x 2*input_size].
-        encoder_hs: A 3D Tensor [batch_size x 2*input_size x input_size].
-        mem_mask:  A 2D Tensor [batch_size x 2*input_size].
+        encoder_ids: A 2D Tensor [batch_size x mem_size].
+        encoder_hs: A 3D Tensor [batch_size x mem_size x input_size].
+        mem_mask:  A 2D Tensor [batch_size x mem_size].
         decoder_inputs: A list of 2D Tensors [batch_size x input_size].
         initial_state: 2D Tensor [batch_size x cell.state_size].
         attention_states: 3D Tensor [batch_size x attn_length x attn_size].
@@ -383,22 +680,31 @@ def embedding_attention_decoder(encoder_mask, encoder_probs, encoder_ids, encode
         feed_previous: Boolean, if True, only the first of decoder_inputs will be
             used (the "GO" symbol), and all other decoder inputs will be generated by:
             next = embedding_lookup(embedding, argmax(previous_output)).
+        shortlist: if not None, the pair (ids, mask) of the target word ids considered when feed_previous
+            is set, see _extract_argmax_and_embed.
         dtype: The dtype to use for the RNN initial states (default: tf.float32).
         scope: VariableScope for the created subgraph; defaults to "embedding_attention_decoder".
         initial_state_attention: If False (default), initial attentions are zero.
             If True, initialize the attentions from the initial state and attention
             states -- useful when we wish to resume decoding from a previously
             stored decoder state and attention states.
+        max_length_ratio: If positive, the maximum length of a translation relative
+            to its source sentence when feed_previous is set.
+        beam_margin: If not None, a float or a scalar float Tensor; if positive, beam search drops
+            the hypotheses whose score is more than beam_margin below the best one of their sentence.
+        beam_width: If not None, an int32 scalar Tensor, the number of hypotheses of each sentence
+            beam search keeps alive, at most beam_size.
 
     Returns:
-        A tuple of the form (outputs, state, symbols, logits_mem, aligns_mem), where:
+        A tuple of the form (outputs, state, symbols, logits_mem, aligns_mem, attention_keys), where:
             outputs: A list of the same length as decoder_inputs of 2D Tensors of
                   shape [batch_size x output_size].
             state: The state of each decoder cell the final time-step.
                 It is a 2D Tensor of shape [batch_size x cell.state_size].
-            symbols: A list of target word ids, the best results returned by beam search.
+            symbols: A list of batch-sized Tensors, the best target word ids found by beam search.
             logits_mem: A list of [batch_size x target_vocab_size].
             aligns_mem: A list of memory attention weights.
+            attention_keys: The projected attention states and memory, see attention_decoder.
 
     Raises:
         ValueError: When output_projection has the wrong shape.
@@ -415,31 +721,88 @@ def embedding_attention_decoder(encoder_mask, encoder_probs, encoder_ids, encode
         encoder_embs = embedding_ops.embedding_lookup(embedding, encoder_ids)
 
         loop_function = _extract_argmax_and_embed(embedding, num_symbols,
-                update_embedding_for_previous) if feed_previous else None
+                update_embedding_for_previous, shortlist, beam_margin, beam_width) if feed_previous else None
 
         emb_inp = [embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs]
 
-        return attention_decoder(encoder_mask, emb_inp, encoder_embs, encoder_probs,
+        return attention_decoder(encoder_mask, emb_inp, encoder_embs, encoder_ids,
                                  encoder_hs, mem_mask, initial_state, attention_states, cell,
-                                 beam_size, output_size=output_size,
+                                 num_symbols, beam_size, output_size=output_size,
                                  num_heads=num_heads, num_layers=num_layers, loop_function=loop_function,
-                                 initial_state_attention=initial_state_attention), tf.identity(embedding)
+                                 initial_state_attention=initial_state_attention,
+                                 max_length_ratio=max_length_ratio), tf.identity(embedding)
+
+
+def _projected_gru_cell(cell):
+    """Returns (num_units, input_keep_prob, seed) if cell is one GRUCell, maybe with input dropout, else None."""
+    input_keep_prob, seed = 1.0, None
+    if isinstance(cell, rnn_cell.DropoutWrapper):
+        if not isinstance(cell._output_keep_prob, float) or cell._output_keep_prob < 1:
+            return None
+        input_keep_prob, seed = cell._input_keep_prob, cell._seed
+        cell = cell._cell
+    if type(cell) is not rnn_cell.GRUCell:
+        return None
+    return cell.output_size, input_keep_prob, seed
 
 
-def embedding_attention_seq2seq(encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask,
+def bidirectional_gru_encoder(encoder_inputs, embedding, num_units, sequence_length, dtype,
+                              input_keep_prob=1.0, seed=None):
+    """The bidirectional GRU encoder with the input projections out of the recurrence.
+
+    This builds the same variables as rnn.bidirectional_rnn over an EmbeddingWrapper
+    around a GRUCell, but embeds the inputs of all time steps at once and multiplies
+    them by the input half of the GRU weights in one matmul per direction, so only
+    the recurrent matmuls are left in the unrolled loop.
+
+    Args:
+        encoder_inputs: A list of 1D int32 Tensors of shape [batch_size].
+        embedding: The source embedding, of shape [num_encoder_symbols x embedding_size].
+        num_units: The size of the GRU state.
+        sequence_length: A 1D Tensor of the lengths of the input sentences.
+        dtype: The dtype of the initial RNN state.
+        input_keep_prob: The keep probability of the dropout on the embedded inputs.
+        seed: The seed of the dropout.
+
+    Returns:
+        A tuple (outputs, output_state_fw, output_state_bw), as rnn.bidirectional_rnn.
+    """
+    num_steps = len(encoder_inputs)
+    with ops.device("/cpu:0"):
+        embedded = embedding_ops.embedding_lookup(embedding, array_ops.concat(0, encoder_inputs))
+    outputs = {}
+    states = {}
+    for direction in ("FW", "BW"):
+        with variable_scope.variable_scope("BiRNN_" + direction) as rnn_scope:
+            inputs = embedded
+            if not isinstance(input_keep_prob, float) or input_keep_prob < 1:
+                inputs = nn_ops.dropout(inputs, input_keep_prob, seed=seed)
+            cell = rnn_cell.ProjectedGRUCell(num_units)
+            with variable_scope.variable_scope("EmbeddingWrapper"):
+                inputs = array_ops.split(0, num_steps, cell.project_inputs(inputs))
+            if direction == "BW":
+                inputs = rnn._reverse_seq(inputs, sequence_length)
+            outputs[direction], states[direction] = rnn.rnn(cell, inputs, dtype=dtype,
+                                                            sequence_length=sequence_length, scope=rnn_scope)
+    output_bw = rnn._reverse_seq(outputs["BW"], sequence_length)
+    outputs = [array_ops.concat(1, [fw, bw]) for fw, bw in zip(outputs["FW"], output_bw)]
+    return outputs, states["FW"], states["BW"]
+
+
+def embedding_attention_seq2seq(encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask,
                                 decoder_inputs, cell, num_encoder_symbols, num_decoder_symbols, embedding_size,
                                 beam_size, num_heads=1, num_layers=1, output_projection=None,
-                                feed_previous=False, dtype=dtypes.float32, scope=None,
-                                initial_state_attention=True):
+                                feed_previous=False, shortlist=None, dtype=dtypes.float32, scope=None,
+                                initial_state_attention=True, max_length_ratio=0.0,
+                                beam_margin=None, beam_width=None):
     """Embedding sequence-to-sequence model with attention.
 
     Args:
         encoder_inputs: A list of 1D int32 Tensors of shape [batch_size].
         encoder_mask: A 2D Tensor [batch_size x input_size].
-        encoder_probs: A 3D Tensor [batch_size x 2*input_size x target_vocab_size].
-        encoder_ids: A 2D Tensor [batch_size x 2*input_size].
-        encoder_hs: A 3D Tensor [batch_size x 2*input_size x input_size].
-        mem_mask:  A 2D Tensor [batch_size x 2*input_size].
+        encoder_ids: A 2D Tensor [batch_size x mem_size].
+        encoder_hs: A 3D Tensor [batch_size x mem_size x input_size].
+        mem_mask:  A 2D Tensor [batch_size x mem_size].
         decoder_inputs: A list of 1D int32 Tensors of shape [batch_size].
         cell: rnn_cell.RNNCell defining the cell function and size.
         num_encoder_symbols: Integer; number of symbols on the encoder side.
@@ -448,53 +811,78 @@ def embedding_attention_seq2seq(encoder_inputs, encoder_mask, encoder_probs, enc
         beam_size: Integer, the beam size used in beam search.
         num_heads: Number of attention heads that read from attention_states.
         feed_previous: Boolean, if True, only the first of decoder_inputs will be used (the "GO" symbol).
+        shortlist: if not None, the pair (ids, mask) of the target word ids considered when feed_previous
+            is set, see _extract_argmax_and_embed.
         dtype: The dtype of the initial RNN state (default: tf.float32).
         scope: VariableScope for the created subgraph; defaults to "embedding_attention_seq2seq".
         initial_state_attention: If False (default), initial attentions are zero.
             If True, initialize the attentions from the initial state and attention
             states.
+        max_length_ratio: If positive, the maximum length of a translation relative to its source sentence.
+        beam_margin: If not None, the score margin below the best hypothesis of beam search pruning;
+            a scalar Tensor lets it change from run to run.
+        beam_width: If not None, an int32 scalar Tensor, the number of live hypotheses of each sentence
+            in beam search, from 1 to beam_size; it can change from run to run.
 
     Returns:
-        A tuple of the form (outputs, state, symbols, logits_mem, aligns_mem), where:
+        A tuple of the form ((outputs, state, symbols, logits_mem, aligns_mem), embedding,
+        (attention_states, encoder_state, attention_keys)), where:
             outputs: A list of the same length as decoder_inputs of 2D Tensors of
                   shape [batch_size x output_size].
             state: The state of each decoder cell the final time-step.
                 It is a 2D Tensor of shape [batch_size x cell.state_size].
-            symbols: A list of target word ids, the best results returned by beam search.
+            symbols: A list of batch-sized Tensors, the best target word ids found by beam search.
             logits_mem: A list of [batch_size x target_vocab_size].
             aligns_mem: A list of memory attention weights.
+            embedding: The target word embedding, used as the output projection.
+            attention_states: The 3D Tensor of encoder outputs the decoder attends to.
+            encoder_state: The final state of the encoder.
+            attention_keys: The pair of the lists of the projected attention_states and memory of each head.
 
     """
     with variable_scope.variable_scope(scope or "embedding_attention_seq2seq"):
         embedding = variable_scope.get_variable(
                 "embedding", [num_encoder_symbols, embedding_size], dtype=dtype,
                 initializer=init_ops.random_normal_initializer(0, 0.01, seed=SEED))
-        encoder_cell = rnn_cell.EmbeddingWrapper(
-                cell, embedding_classes=num_encoder_symbols,
-                embedding_size=embedding_size, embedding=embedding)
-
         encoder_lens = math_ops.reduce_sum(encoder_mask, [1])
 
-        encoder_outputs, _, encoder_state = rnn.bidirectional_rnn(
-                encoder_cell, encoder_cell, encoder_inputs, sequence_length=encoder_lens, dtype=dtype)
+        projected_gru = _projected_gru_cell(cell)
+        if projected_gru:
+            num_units, input_keep_prob, seed = projected_gru
+            encoder_outputs, _, encoder_state = bidirectional_gru_encoder(
+                    encoder_inputs, embedding, num_units, encoder_lens, dtype,
+                    input_keep_prob=input_keep_prob, seed=seed)
+        else:
+            encoder_cell = rnn_cell.EmbeddingWrapper(
+                    cell, embedding_classes=num_encoder_symbols,
+                    embedding_size=embedding_size, embedding=embedding)
+
+            encoder_outputs, _, encoder_state = rnn.bidirectional_rnn(
+                    encoder_cell, encoder_cell, encoder_inputs, sequence_length=encoder_lens, dtype=dtype)
 
-        assert encoder_cell._embedding is embedding
+            assert encoder_cell._embedding is embedding
 
         # First calculate a concatenation of encoder outputs to put attention on.
-        top_states = [array_ops.reshape(e, [-1, 1, 2 * cell.output_size])
-                      for e in encoder_outputs]
+        top_states = [array_ops.reshape(e, [-1, 1, 2 * cell.output_size]) for e in encoder_outputs]
         attention_states = array_ops.concat(1, top_states)
 
         # Decoder.
         output_size = None
 
-        return embedding_attention_decoder(encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask,
+        decoder_outputs, target_embedding = embedding_attention_decoder(encoder_mask, encoder_ids, encoder_hs, mem_mask,
                                            decoder_inputs, encoder_state, attention_states, cell,
                                            num_decoder_symbols, embedding_size, beam_size=beam_size,
                                            num_heads=num_heads, num_layers=num_layers, output_size=output_size,
                                            output_projection=output_projection,
-                                           feed_previous=feed_previous,
-                                           initial_state_attention=initial_state_attention)
+                                           feed_previous=feed_previous, shortlist=shortlist,
+                                           initial_state_attention=initial_state_attention,
+                                           max_length_ratio=max_length_ratio, beam_margin=beam_margin,
+                                           beam_width=beam_width)
+        outputs, state, symbols, logits_mem, aligns_mem, attention_keys = decoder_outputs
+        # The encoder outputs of the bucket, which Seq2SeqModel.search feeds to skip the encoder
+        # and the projections of the attention keys.
+        return ((outputs, state, symbols, logits_mem, aligns_mem), target_embedding,
+                (attention_states, encoder_state, attention_keys))
 
 
 def sequence_loss_by_example(logits, logits_mem, targets, weights, aligns_mem,
@@ -508,8 +896,8 @@ def sequence_loss_by_example(logits, logits_mem, targets, weights, aligns_mem,
         logits_mem:  List of 2D Tensors of shape [batch_size x num_decoder_symbols]. The logits from memory.
         targets: List of 1D batch-sized int32 Tensors of the same length as logits.
         weights: List of 1D batch-sized float-Tensors of the same length as logits.
-        aligns_mem: List of 2D Tensors of shape [batch_size x 2*input_size]. The weights of memory attention.
-        decoder_aligns: List of 2D Tensors of shape [batch_size x 2*input_size]. The groundtruth alignments on memory.
+        aligns_mem: List of 2D Tensors of shape [batch_size x mem_size]. The weights of memory attention.
+        decoder_aligns: List of 2D Tensors of shape [batch_size x mem_size]. The groundtruth alignments on memory.
         decoder_align_weights: List of 1D int32 Tensors of shape [batch_size].
         average_across_timesteps: If set, divide the returned cost by the total label weight.
         softmax_loss_function: Function (inputs-batch, labels-batch) -> loss-batch
@@ -527,6 +915,29 @@ def sequence_loss_by_example(logits, logits_mem, targets, weights, aligns_mem,
                          "%d, %d, %d." % (len(logits), len(weights), len(targets)))
     with ops.op_scope(logits + targets + weights, name,
                       "sequence_loss_by_example"):
+        # only the memory attention is trained, so the loss is the one of its alignments
+        return alignment_loss_by_example(aligns_mem, weights, decoder_aligns, decoder_align_weights,
+                                         average_across_timesteps=average_across_timesteps)
+
+
+def alignment_loss_by_example(aligns_mem, weights, decoder_aligns, decoder_align_weights,
+                              average_across_timesteps=True, name=None):
+    """Cross-entropy of the memory attention weights against the groundtruth alignments (per example).
+
+    The attention of step i is compared with the alignment of the target word of step i + 1.
+
+    Args:
+        aligns_mem: List of 2D Tensors of shape [batch_size x mem_size]. The weights of memory attention.
+        weights: List of 1D batch-sized float-Tensors of the same length as aligns_mem.
+        decoder_aligns: List of 2D Tensors of shape [batch_size x mem_size]. The groundtruth alignments on memory.
+        decoder_align_weights: List of 1D float Tensors of shape [batch_size].
+        average_across_timesteps: If set, divide the returned cost by the total label weight.
+        name: Optional name for this operation, default: "alignment_loss_by_example".
+
+    Returns:
+        1D batch-sized float Tensor: The alignment cross-entropy of each sequence.
+    """
+    with ops.op_scope(aligns_mem + weights, name, "alignment_loss_by_example"):
         log_perp_list = []
         decoder_aligns = decoder_aligns[1:]
         aligns_mem = aligns_mem[:-1]
@@ -545,6 +956,33 @@ def sequence_loss_by_example(logits, logits_mem, targets, weights, aligns_mem,
     return log_perps
 
 
+def alignment_loss(aligns_mem, weights, decoder_aligns, decoder_align_weights,
+                   average_across_timesteps=True, average_across_batch=True, name=None):
+    """Cross-entropy of the memory attention weights against the groundtruth alignments, batch-collapsed.
+
+    Args:
+        aligns_mem: List of 2D Tensors of shape [batch_size x mem_size]. The weights of memory attention.
+        weights: List of 1D batch-sized float-Tensors of the same length as aligns_mem.
+        decoder_aligns: List of 2D Tensors of shape [batch_size x mem_size]. The groundtruth alignments on memory.
+        decoder_align_weights: List of 1D float Tensors of shape [batch_size].
+        average_across_timesteps: If set, divide the returned cost by the total label weight.
+        average_across_batch: If set, divide the returned cost by the batch size.
+        name: Optional name for this operation, defaults to "alignment_loss".
+
+    Returns:
+        A scalar float Tensor: The average alignment cross-entropy per symbol (weighted).
+    """
+    with ops.op_scope(aligns_mem + weights, name, "alignment_loss"):
+        cost = math_ops.reduce_sum(alignment_loss_by_example(
+                aligns_mem, weights, decoder_aligns, decoder_align_weights,
+                average_across_timesteps=average_across_timesteps))
+        if average_across_batch:
+            batch_size = array_ops.shape(weights[0])[0]
+            return cost / math_ops.cast(batch_size, dtypes.float32)
+        else:
+            return cost
+
+
 def sequence_loss(logits, logits_mem, targets, weights, aligns_mem, decoder_aligns,
                   decoder_align_weights, output_projection=None,
                   average_across_timesteps=True, average_across_batch=True,
@@ -556,8 +994,8 @@ def sequence_loss(logits, logits_mem, targets, weights, aligns_mem, decoder_alig
         logits_mem:  List of 2D Tensors of shape [batch_size x num_decoder_symbols]. The logits from memory.
         targets: List of 1D batch-sized int32 Tensors of the same length as logits.
         weights: List of 1D batch-sized float-Tensors of the same length as logits.
-        aligns_mem: List of 2D Tensors of shape [batch_size x 2*input_size]. The weights of memory attention.
-        decoder_aligns: List of 2D Tensors of shape [batch_size x 2*input_size]. The groundtruth alignments on memory.
+        aligns_mem: List of 2D Tensors of shape [batch_size x mem_size]. The weights of memory attention.
+        decoder_aligns: List of 2D Tensors of shape [batch_size x mem_size]. The groundtruth alignments on memory.
         decoder_align_weights: List of 1D int32 Tensors of shape [batch_size].
         average_across_timesteps: If set, divide the returned cost by the total label weight.
         average_across_batch: If set, divide the returned cost by the batch size.
@@ -584,23 +1022,22 @@ def sequence_loss(logits, logits_mem, targets, weights, aligns_mem, decoder_alig
             return cost
 
 
-def model_with_buckets(encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask,
+def model_with_buckets(encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask,
                        decoder_inputs, targets, weights, decoder_aligns, decoder_align_weights,
                        buckets, seq2seq, output_projection=None, softmax_loss_function=None,
-                       per_example_loss=False, name=None):
+                       per_example_loss=False, name=None, bucket_ids=None, reuse=None):
     """Create a sequence-to-sequence model with support for bucketing.
 
     Args:
         encoder_inputs: A list of Tensors to feed the encoder.
         encoder_mask: A 2D Tensor [batch_size x input_size]. The master
-        encoder_probs: A 3D Tensor [batch_size x 2*input_size x target_vocab_size].
-        encoder_ids: A 2D Tensor [batch_size x 2*input_size].
-        encoder_hs: A 3D Tensor [batch_size x 2*input_size x input_size].
-        mem_mask:  A 2D Tensor [batch_size x 2*input_size].
+        encoder_ids: A 2D Tensor [batch_size x mem_size].
+        encoder_hs: A 3D Tensor [batch_size x mem_size x input_size].
+        mem_mask:  A 2D Tensor [batch_size x mem_size].
         decoder_inputs: A list of Tensors to feed the decoder; second seq2seq input.
         targets: A list of 1D batch-sized int32 Tensors (desired output sequence).
         weights: A List of 1D batch-sized float-Tensors to weight the targets.
-        decoder_aligns: A List of 2D Tensors of shape [batch_size x 2*input_size]. The groundtruth alignments on memory.
+        decoder_aligns: A List of 2D Tensors of shape [batch_size x mem_size]. The groundtruth alignments on memory.
         decoder_align_weights: List of 1D int32 Tensors of shape [batch_size].
         buckets: A list of pairs of (input size, output size) for each bucket.
         seq2seq: A sequence-to-sequence model function.
@@ -610,14 +1047,18 @@ def model_with_buckets(encoder_inputs, encoder_mask, encoder_probs, encoder_ids,
             tensor of losses for each sequence in the batch. If unset, it will be
             a scalar with the averaged loss from all examples.
         name: Optional name for this operation, defaults to "model_with_buckets".
+        bucket_ids: The ids of the buckets to build, all of them if None; the outputs, losses,
+            symbols and encoder outputs of the other buckets are None.
+        reuse: If True, reuse the variables of buckets built before, e.g. by an earlier call.
 
     Returns:
-        A tuple of the form (outputs, losses, symbols), where:
+        A tuple of the form (outputs, losses, symbols, encoder_outputs), where:
             outputs: The outputs for each bucket. Its j'th element consists of a list
                 of 2D Tensors of shape [batch_size x num_decoder_symbols] (jth outputs).
             losses: List of scalar Tensors, representing losses for each bucket, or,
                 if per_example_loss is set, a list of 1D batch-sized float Tensors.
             symbols: List of target word ids, the best results returned by beam search.
+            encoder_outputs: List of the (attention_states, encoder_state, attention_keys) of each bucket.
 
     Raises:
       ValueError: If length of encoder_inputsut, targets, or weights is smaller
@@ -637,15 +1078,25 @@ def model_with_buckets(encoder_inputs, encoder_mask, encoder_probs, encoder_ids,
     losses = []
     outputs = []
     symbols = []  # to save the output of beam search
+    encoder_outputs = []
+    built = False
     with ops.op_scope(all_inputs, name, "model_with_buckets"):
         for j, bucket in enumerate(buckets):
+            if bucket_ids is not None and j not in bucket_ids:
+                outputs.append(None)
+                losses.append(None)
+                symbols.append(None)
+                encoder_outputs.append(None)
+                continue
             with variable_scope.variable_scope(variable_scope.get_variable_scope(),
-                                               reuse=True if j > 0 else None):
-                (bucket_outputs, _, bucket_symbols, bucket_logits_mem, bucket_aligns_mem), output_projection =\
-                    seq2seq(encoder_inputs[:bucket[0]], encoder_mask, encoder_probs,
-                            encoder_ids, encoder_hs, mem_mask, decoder_inputs[:bucket[1]])
+                                               reuse=True if reuse or built else None):
+                built = True
+                ((bucket_outputs, _, bucket_symbols, bucket_logits_mem, bucket_aligns_mem), output_projection,
+                 bucket_encoder_outputs) = seq2seq(encoder_inputs[:bucket[0]], encoder_mask, encoder_ids,
+                                                   encoder_hs, mem_mask, decoder_inputs[:bucket[1]])
                 outputs.append(bucket_outputs)
                 symbols.append(bucket_symbols)
+                encoder_outputs.append(bucket_encoder_outputs)
                 if per_example_loss:
                     losses.append(sequence_loss_by_example(
                             outputs[-1], bucket_logits_mem[:bucket[1]], targets[:bucket[1]], weights[:bucket[1]],
@@ -659,4 +1110,4 @@ def model_with_buckets(encoder_inputs, encoder_mask, encoder_probs, encoder_ids,
                             output_projection=output_projection,
                             softmax_loss_function=softmax_loss_function))
 
-    return outputs, losses, symbols
+    return outputs, losses, symbols, encoder_outputs
@@ -32,6 +32,8 @@ from __future__ import division
 from __future__ import print_function
 
 import random
+import sys
+import time
 
 import numpy as np
 from six.moves import xrange
@@ -42,7 +44,9 @@ from tensorflow.python.ops import math_ops
 
 import rnn_cell
 import data_utils
+import mem
 import seq2seq_fy
+import translation_cache
 
 SEED = 123
 
@@ -56,8 +60,10 @@ class Seq2SeqModel(object):
     def __init__(self, source_vocab_size, target_vocab_size, buckets,
                  hidden_edim, hidden_units, num_layers, keep_prob,
                  max_gradient_norm, batch_size,learning_rate,
-                 learning_rate_decay_factor, beam_size,
-                 use_lstm=False, forward_only=False):
+                 learning_rate_decay_factor, beam_size, mem_size=0,
+                 use_lstm=False, forward_only=False, extract_features=False, use_shortlist=False,
+                 lazy_buckets=False, max_length_ratio=0.0,
+                 beam_margin=0.0, encoder_cache_size=0):
         """Create the model.
 
         Args:
@@ -77,18 +83,34 @@ class Seq2SeqModel(object):
                 changed after initialization if this is convenient, e.g., for decoding.
             learning_rate: learning rate to start with.
             learning_rate_decay_factor: decay learning rate by this much when needed.
-            beam_size: the beam size used in beam search.
+            beam_size: the beam size used in beam search; search can use a narrower beam.
+            mem_size: the maximum number of target words in memory; 0 means 2 * the encoder size of the bucket.
+                Each batch is trimmed to its largest number of filled memory slots.
             use_lstm: if true, we use LSTM cells instead of GRU cells.
             forward_only: if set, we do not construct the backward pass in the model.
+            use_shortlist: if set, beam search only considers the target words fed to step as shortlist.
+            extract_features: if set, the model only runs the trained NMT without dropout and
+                feeding the reference translation, to extract the inputs of the memory attention.
+            lazy_buckets: if set with forward_only, only the first bucket is built here, and each
+                other bucket the first time step is called on it.
+            max_length_ratio: if positive, beam search ends a translation with EOS once it is
+                max_length_ratio times as long as its source sentence.
+            beam_margin: if positive, beam search drops the hypotheses whose log probability is
+                more than beam_margin below the best one of their sentence; search can change it.
+            encoder_cache_size: the number of sentences whose encoder states encode keeps for reuse.
         """
         self.source_vocab_size = source_vocab_size
         self.target_vocab_size = target_vocab_size
         self.buckets = buckets
         self.batch_size = batch_size
+        self.mem_size = mem_size
         self.learning_rate = tf.Variable(float(learning_rate), trainable=False)
         self.learning_rate_decay_op = self.learning_rate.assign(
                 self.learning_rate * learning_rate_decay_factor)
         self.global_step = tf.Variable(0, trainable=False)
+        self.beam_size = beam_size
+        self.default_beam_margin = beam_margin
+        self.encoder_cache = translation_cache.LRUCache(encoder_cache_size)
 
         def loss_function(logit, target, output_projection):
             logit = math_ops.matmul(logit, output_projection, transpose_b=True)
@@ -106,21 +128,24 @@ class Seq2SeqModel(object):
         cell = single_cell
         if num_layers > 1:
             cell = rnn_cell.MultiRNNCell([single_cell] * num_layers)
-        if not forward_only:
+        if not forward_only and not extract_features:
             cell = rnn_cell.DropoutWrapper(cell, input_keep_prob=keep_prob, seed=SEED)
 
         # The seq2seq function: we use embedding for the input and attention.
-        def seq2seq_f(encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask, decoder_inputs,
-                      do_decode):
+        def seq2seq_f(encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask, decoder_inputs, do_decode):
             return seq2seq_fy.embedding_attention_seq2seq(
-                    encoder_inputs, encoder_mask, encoder_probs, encoder_ids,
+                    encoder_inputs, encoder_mask, encoder_ids,
                     encoder_hs, mem_mask, decoder_inputs, cell,
                     num_encoder_symbols=source_vocab_size,
                     num_decoder_symbols=target_vocab_size,
                     embedding_size=hidden_edim,
                     beam_size=beam_size,
                     num_layers=num_layers,
-                    feed_previous=do_decode)
+                    feed_previous=do_decode,
+                    shortlist=None if self.shortlist is None else (self.shortlist, self.shortlist_mask),
+                    max_length_ratio=max_length_ratio,
+                    beam_margin=self.beam_margin,
+                    beam_width=self.beam_width)
 
         # Feeds for inputs.
         self.encoder_inputs = []
@@ -143,34 +168,59 @@ class Seq2SeqModel(object):
                                                              name="align_weight{0}".format(i)))
         self.encoder_mask = tf.placeholder(tf.int32, shape=[None, None],
                                            name="encoder_mask")
-        self.encoder_probs = tf.placeholder(tf.float32, shape=[None, None, self.target_vocab_size],
-                                            name="encoder_prob")
         self.encoder_ids = tf.placeholder(tf.int32, shape=[None, None],
                                           name="encoder_id")
         self.encoder_hs = tf.placeholder(tf.float32, shape=[None, None, None],
                                          name="encoder_h")
         self.mem_mask = tf.placeholder(tf.float32, shape=[None, None],
                                           name="mem_mask")
+        self.shortlist = None
+        self.shortlist_mask = None
+        if use_shortlist:
+            self.shortlist = tf.placeholder(tf.int32, shape=[None], name="shortlist")
+            self.shortlist_mask = tf.placeholder(tf.float32, shape=[None, None], name="shortlist_mask")
+        self.beam_margin = tf.placeholder(tf.float32, shape=[], name="beam_margin")
+        self.beam_width = tf.placeholder(tf.int32, shape=[], name="beam_width")
 
         # Our targets are decoder inputs shifted by one.
         targets = [self.decoder_inputs[i + 1]
                    for i in xrange(len(self.decoder_inputs) - 1)]
 
         # Training outputs and losses.
+        # The encoder outputs of each bucket, fed by search to skip the encoder.
+        self.encoder_attention_states = [None] * len(buckets)
+        self.encoder_state = [None] * len(buckets)
+        self.encoder_attention_keys = [None] * len(buckets)
         if forward_only:
-            self.outputs, self.losses, self.symbols = seq2seq_fy.model_with_buckets(
-                    self.encoder_inputs, self.encoder_mask, self.encoder_probs, self.encoder_ids, self.encoder_hs,
-                    self.mem_mask, self.decoder_inputs, targets,
-                    self.target_weights, self.decoder_aligns, self.decoder_align_weights, buckets,
-                    lambda x, y, z, s, a, b, c : seq2seq_f(x, y, z, s, a, b, c, True),
-                    softmax_loss_function=softmax_loss_function)
+            def build_buckets(bucket_ids=None, reuse=None):
+                return seq2seq_fy.model_with_buckets(
+                        self.encoder_inputs, self.encoder_mask, self.encoder_ids,
+                        self.encoder_hs, self.mem_mask, self.decoder_inputs, targets,
+                        self.target_weights, self.decoder_aligns, self.decoder_align_weights, buckets,
+                        lambda x, y, s, a, b, c : seq2seq_f(x, y, s, a, b, c, True),
+                        softmax_loss_function=softmax_loss_function, bucket_ids=bucket_ids, reuse=reuse)
+
+            self._build_buckets = None
+            if lazy_buckets:
+                # The first bucket creates all the variables; the others reuse them when built.
+                self.outputs, self.losses, self.symbols, encoder_outputs = build_buckets([0])
+                self._keep_encoder_outputs(encoder_outputs)
+                self._build_buckets = build_buckets
+                self._graph = tf.get_default_graph()
+                self._variable_scope = tf.get_variable_scope()
+            else:
+                self.outputs, self.losses, self.symbols, encoder_outputs = build_buckets()
+                self._keep_encoder_outputs(encoder_outputs)
         else:
-            self.outputs, self.losses, self.symbols = seq2seq_fy.model_with_buckets(
-                    self.encoder_inputs, self.encoder_mask, self.encoder_probs, self.encoder_ids, self.encoder_hs,
+            self.outputs, self.losses, self.symbols, _ = seq2seq_fy.model_with_buckets(
+                    self.encoder_inputs, self.encoder_mask, self.encoder_ids, self.encoder_hs,
                     self.mem_mask, self.decoder_inputs, targets,
                     self.target_weights, self.decoder_aligns, self.decoder_align_weights, buckets,
-                    lambda x, y, z, s, a, b, c : seq2seq_f(x, y, z, s, a, b, c, False),
+                    lambda x, y, s, a, b, c : seq2seq_f(x, y, s, a, b, c, False),
                     softmax_loss_function=softmax_loss_function)
+            # the attention states and the stacked queries [decoder_size x batch_size x query_size]
+            # of the memory attention in each bucket
+            self.features = list(zip(tf.get_collection("mem_attention_states"), tf.get_collection("mem_queries")))
 
         # only update memory attention parameters
         params_to_update = [p for p in tf.trainable_variables() if p.name in [
@@ -188,7 +238,7 @@ class Seq2SeqModel(object):
             u'embedding_attention_seq2seq/embedding_attention_decoder/attention_decoder/attention/AttnU_0/Linear_mem/Bias/Adam:0',
             u'embedding_attention_seq2seq/embedding_attention_decoder/attention_decoder/attention/AttnU_0/Linear_mem/Bias/Adam_1:0'
         ]]
-        if not forward_only:
+        if not forward_only and not extract_features:
             self.gradient_norms = []
             self.gradient_norms_print = []
             self.updates = []
@@ -243,15 +293,35 @@ class Seq2SeqModel(object):
         self.saver = tf.train.Saver(params_to_save, max_to_keep=1000,
                                     keep_checkpoint_every_n_hours=6)
 
-    def step(self, session, encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask, decoder_inputs,
-             target_weights, decoder_aligns, decoder_align_weights, bucket_id, forward_only):
+    def build_bucket(self, bucket_id):
+        """Build the subgraph of a bucket if the model was created with lazy_buckets and it is not built yet."""
+        if self.outputs[bucket_id] is not None:
+            return
+        start_time = time.time()
+        with self._graph.as_default(), tf.variable_scope(self._variable_scope):
+            outputs, losses, symbols, encoder_outputs = self._build_buckets([bucket_id], reuse=True)
+        self._keep_encoder_outputs(encoder_outputs)
+        self.losses[bucket_id] = losses[bucket_id]
+        self.symbols[bucket_id] = symbols[bucket_id]
+        self.outputs[bucket_id] = outputs[bucket_id]
+        sys.stderr.write("Built bucket %d in %.1fs\n" % (bucket_id, time.time() - start_time))
+        sys.stderr.flush()
+
+    def _keep_encoder_outputs(self, encoder_outputs):
+        """Keep the encoder outputs returned by model_with_buckets for the built buckets."""
+        for bucket_id, bucket_encoder_outputs in enumerate(encoder_outputs):
+            if bucket_encoder_outputs is not None:
+                (self.encoder_attention_states[bucket_id], self.encoder_state[bucket_id],
+                 self.encoder_attention_keys[bucket_id]) = bucket_encoder_outputs
+
+    def step(self, session, encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask, decoder_inputs,
+             target_weights, decoder_aligns, decoder_align_weights, bucket_id, forward_only, shortlist=None):
         """Run a step of the model feeding the given inputs.
 
         Args:
           session: tensorflow session to use.
           encoder_inputs: list of numpy int vectors to feed as encoder inputs.
           encoder_mask: a 2D numpy int matrix to feed as encoder mask.
-          encoder_probs: a 3D numpy float matrix to feed as encoder probs.
           encoder_ids: a 2D numpy int matrix to feed as encoder ids.
           encoder_hs: a 3D numpy float matrix to feed as encoder hs.
           mem_mask: a 2D numpy int matrix to feed as mem mask.
@@ -261,15 +331,20 @@ class Seq2SeqModel(object):
           decoder_align_weights: list of numpy float vectors to feed as decoder_align_weights.
           bucket_id: which bucket of the model to use.
           forward_only: whether to do the backward step or only forward.
+          shortlist: if the model uses a shortlist, the sorted target word ids considered in beam search,
+            or the pair (ids, mask) of mem.merge_shortlists to give each sentence its own.
 
         Returns:
           A triple consisting of gradient norm (or None if we did not do backward),
-          average perplexity, and the outputs.
+          average perplexity (or None when decoding with beam search), and the outputs.
 
         Raises:
           ValueError: if length of encoder_inputs, decoder_inputs, or
             target_weights disagrees with bucket size for the specified bucket_id.
         """
+        if forward_only and self.outputs[bucket_id] is None:
+            self.build_bucket(bucket_id)
+
         # Check if the sizes match.
         encoder_size, decoder_size = self.buckets[bucket_id]
         if len(encoder_inputs) != encoder_size:
@@ -292,59 +367,214 @@ class Seq2SeqModel(object):
             input_feed[self.decoder_aligns[l].name] = decoder_aligns[l]
             input_feed[self.decoder_align_weights[l].name] = decoder_align_weights[l]
         input_feed[self.encoder_mask.name] = encoder_mask
-        input_feed[self.encoder_probs.name] = encoder_probs
         input_feed[self.encoder_ids.name] = encoder_ids
         input_feed[self.encoder_hs.name] = encoder_hs
         input_feed[self.mem_mask.name] = mem_mask
+        if self.shortlist is not None:
+            self._feed_shortlist(input_feed, shortlist, len(encoder_mask))
+        input_feed[self.beam_margin.name] = self.default_beam_margin
+        input_feed[self.beam_width.name] = self.beam_size
 
         # Since our targets are decoder inputs shifted by one, we need one more.
         last_target = self.decoder_inputs[decoder_size].name
-        input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+        input_feed[last_target] = np.zeros([len(decoder_inputs[0])], dtype=np.int32)
 
         # Output feed: depends on whether we do a backward step or not.
         if not forward_only:
             output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
                            self.gradient_norms[bucket_id],  # Gradient norm.
                            self.losses[bucket_id]]  # Loss for this batch.
+        elif self.symbols[0]:
+            # The loss of the beam search outputs means nothing, so it is not computed when decoding.
+            output_feed = [self.symbols[bucket_id][l] for l in xrange(decoder_size)]  # Output symbols
         else:
             output_feed = [self.losses[bucket_id]]  # Loss for this batch.
-            if self.symbols[0]:
-                for l in xrange(decoder_size):  # Output symbols
-                    output_feed.append(self.symbols[bucket_id][l])
-            else:
-                for l in xrange(decoder_size):  # Output logits.
-                    output_feed.append(self.outputs[bucket_id][l])
+            for l in xrange(decoder_size):  # Output logits.
+                output_feed.append(self.outputs[bucket_id][l])
 
         outputs = session.run(output_feed, input_feed)
         if not forward_only:
             return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
+        elif self.symbols[0]:
+            return None, None, outputs  # No gradient norm, no loss, symbols.
         else:
             return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
 
+    def encode(self, session, source_ids, bucket_id, mems2t, memt2s):
+        """Run the encoder of the decoding model on sentences of a bucket, and project the source
+        annotations and the memory the attentions compare with their queries.
+
+        The states of the sentences seen recently are taken from the encoder cache of the model,
+        so re-decoding a sentence with other search settings skips the encoder and the memory.
+
+        Args:
+            session: tensorflow session to use.
+            source_ids: a list of source token ids, ending with EOS, shorter than the bucket.
+            bucket_id: which bucket of the model to use.
+            mems2t: the source to target memory, a mem.LexicalTable.
+            memt2s: the target to source memory, a mem.LexicalTable.
+
+        Returns:
+            A list of the encoder states of the sentences, to give to search.
+        """
+        if self.outputs[bucket_id] is None:
+            self.build_bucket(bucket_id)
+        keys = [(bucket_id, tuple(token_ids)) for token_ids in source_ids]
+        states = [self.encoder_cache.get(key) for key in keys]
+        misses = [k for k, state in enumerate(states) if state is None]
+        if misses:
+            encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask, _, _, _, _ = self.prepare_batch(
+                    [(source_ids[k], []) for k in misses], bucket_id, mems2t, memt2s)
+            input_feed = {
+                self.encoder_mask.name: encoder_mask,
+                self.encoder_ids.name: encoder_ids,
+                self.encoder_hs.name: encoder_hs,
+            }
+            for l in xrange(len(encoder_inputs)):
+                input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+            attention_states, encoder_state, (attention_keys, memory_keys) = session.run(
+                    [self.encoder_attention_states[bucket_id], self.encoder_state[bucket_id],
+                     self.encoder_attention_keys[bucket_id]], input_feed)
+            for i, k in enumerate(misses):
+                # the memory of a sentence fills its first slots
+                mem_len = int(mem_mask[i].sum())
+                states[k] = (attention_states[i], encoder_state[i], np.array(encoder_mask[i], dtype=np.int32),
+                             [head_keys[i] for head_keys in attention_keys], encoder_ids[i, :mem_len],
+                             [head_keys[i, :mem_len] for head_keys in memory_keys])
+                self.encoder_cache.put(keys[k], states[k])
+        return states
+
+    def search(self, session, states, bucket_id, shortlist=None, beam_margin=None, beam_width=None):
+        """Run beam search from encoder states returned by encode, without running the encoder
+        or projecting the source annotations and the memory again.
+
+        Args:
+            session: tensorflow session to use.
+            states: a list of encoder states of sentences of the bucket, returned by encode.
+            bucket_id: which bucket of the model to use.
+            shortlist: if the model uses a shortlist, the sorted target word ids considered in beam search,
+                or the pair (ids, mask) of mem.merge_shortlists to give each sentence its own.
+            beam_margin: the beam pruning margin of this search, see the constructor; None uses the
+                margin of the model.
+            beam_width: the number of hypotheses of each sentence kept alive in this search, from 1 to
+                the beam_size of the model; None uses beam_size.
+
+        Returns:
+            The output symbols, one numpy vector over the sentences for each decoder step, as from step.
+        """
+        if beam_width is not None and not 1 <= beam_width <= self.beam_size:
+            raise ValueError("beam_width must be from 1 to %d, got %d." % (self.beam_size, beam_width))
+        if self.outputs[bucket_id] is None:
+            self.build_bucket(bucket_id)
+        _, decoder_size = self.buckets[bucket_id]
+        # The memories of the sentences are padded to the fullest one, as in prepare_batch.
+        mem_size = max(max(len(state[4]) for state in states), 1)
+        encoder_ids = np.zeros([len(states), mem_size], dtype=np.int32)
+        mem_mask = np.zeros([len(states), mem_size], dtype=np.float32)
+        for i, state in enumerate(states):
+            encoder_ids[i, :len(state[4])] = state[4]
+            mem_mask[i, :len(state[4])] = 1.0
+        input_feed = {
+            self.encoder_attention_states[bucket_id].name: np.array([state[0] for state in states]),
+            self.encoder_state[bucket_id].name: np.array([state[1] for state in states]),
+            self.encoder_mask.name: np.array([state[2] for state in states]),
+            self.encoder_ids.name: encoder_ids,
+            self.mem_mask.name: mem_mask,
+            self.decoder_inputs[0].name: np.full([len(states)], data_utils.GO_ID, dtype=np.int32),
+            self.beam_margin.name: self.default_beam_margin if beam_margin is None else beam_margin,
+            self.beam_width.name: self.beam_size if beam_width is None else beam_width,
+        }
+        attention_keys, memory_keys = self.encoder_attention_keys[bucket_id]
+        for a, head_keys in enumerate(attention_keys):
+            input_feed[head_keys.name] = np.array([state[3][a] for state in states])
+        for a, head_keys in enumerate(memory_keys):
+            padded = np.zeros([len(states), mem_size] + list(states[0][5][a].shape[1:]), dtype=np.float32)
+            for i, state in enumerate(states):
+                padded[i, :len(state[4])] = state[5][a]
+            input_feed[head_keys.name] = padded
+        if self.shortlist is not None:
+            self._feed_shortlist(input_feed, shortlist, len(states))
+        return session.run([self.symbols[bucket_id][l] for l in xrange(decoder_size)], input_feed)
+
+    def extract_features(self, session, encoder_inputs, encoder_mask, decoder_inputs, bucket_id):
+        """Run the NMT part of the model and fetch the inputs of its memory attention.
+
+        Args:
+          session: tensorflow session to use.
+          encoder_inputs: list of numpy int vectors to feed as encoder inputs.
+          encoder_mask: a 2D numpy int matrix to feed as encoder mask.
+          decoder_inputs: list of numpy int vectors to feed as decoder inputs.
+          bucket_id: which bucket of the model to use.
+
+        Returns:
+          A pair (attention_states, queries) of numpy float arrays of shapes
+          [batch_size x encoder_size x attn_size] and [batch_size x decoder_size x query_size].
+        """
+        encoder_size, decoder_size = self.buckets[bucket_id]
+        input_feed = {}
+        for l in xrange(encoder_size):
+            input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+        for l in xrange(decoder_size):
+            input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
+        input_feed[self.encoder_mask.name] = encoder_mask
+
+        attention_states, queries = session.run(self.features[bucket_id], input_feed)
+        return attention_states, np.transpose(queries, [1, 0, 2])
+
+    def mem_capacity(self, encoder_size):
+        """The maximum number of memory slots for a bucket with the given encoder size."""
+        return self.mem_size or 2 * encoder_size
+
+    def _feed_shortlist(self, input_feed, shortlist, batch_size):
+        """Feed the target word ids of a shortlist, and the mask of those of each sentence."""
+        ids, mask = shortlist if isinstance(shortlist, tuple) else (shortlist, None)
+        if mask is None:
+            # the sentences share all the ids
+            mask = np.ones([batch_size, len(ids)], dtype=np.float32)
+        input_feed[self.shortlist.name] = ids
+        input_feed[self.shortlist_mask.name] = mask
+
     def get_batch(self, data, bucket_id, mems2t, memt2s):
         """Get a random batch of data from the specified bucket, prepare for step.
 
+        Args:
+          data: a tuple of size len(self.buckets) in which each element contains
+            lists of pairs of input and output data that we use to create a batch.
+          bucket_id: integer, which bucket to get the batch for.
+          mems2t: the source to target memory, a mem.LexicalTable.
+          memt2s: the target to source memory, a mem.LexicalTable.
+
+        Returns:
+          The batch returned by prepare_batch.
+        """
+        pairs = [random.choice(data[bucket_id]) for _ in xrange(self.batch_size)]
+        return self.prepare_batch(pairs, bucket_id, mems2t, memt2s)
+
+    def prepare_batch(self, pairs, bucket_id, mems2t, memt2s):
+        """Prepare the given pairs of the specified bucket for step.
+
         To feed data in step(..) it must be a list of batch-major vectors, while
         data here contains single length-major cases. So the main logic of this
         function is to re-index data cases to be in the proper format for feeding.
 
         Args:
-          data: a tuple of size len(self.buckets) in which each element contains
-            lists of pairs of input and output data that we use to create a batch.
-          bucket_id: integer, which bucket to get the batch for.
+          pairs: a list of pairs of input and output data, one for each batch entry.
+          bucket_id: integer, which bucket the pairs belong to.
+          mems2t: the source to target memory, a mem.LexicalTable.
+          memt2s: the target to source memory, a mem.LexicalTable.
 
         Returns:
-          The triple (encoder_inputs, decoder_inputs, target_weights) for
+          The tuple (encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask,
+          decoder_inputs, target_weights, decoder_aligns, decoder_align_weights) for
           the constructed batch that has the proper format to call step(...) later.
         """
+        batch_size = len(pairs)
         encoder_size, decoder_size = self.buckets[bucket_id]
         encoder_inputs, decoder_inputs = [], []
         encoder_mask = []
 
-        # Get a random batch of encoder and decoder inputs from data,
-        # pad them if needed, reverse encoder inputs and add GO to decoder.
-        for _ in xrange(self.batch_size):
-            encoder_input, decoder_input = random.choice(data[bucket_id])
+        # Pad the encoder and decoder inputs if needed and add GO to decoder.
+        for encoder_input, decoder_input in pairs:
             # Encoder inputs are padded and then reversed.
             encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
             encoder_inputs.append(list(encoder_input + encoder_pad))
@@ -359,63 +589,47 @@ class Seq2SeqModel(object):
         for length_idx in xrange(encoder_size):
             batch_encoder_inputs.append(
                     np.array([encoder_inputs[batch_idx][length_idx]
-                              for batch_idx in xrange(self.batch_size)], dtype=np.int32))
+                              for batch_idx in xrange(batch_size)], dtype=np.int32))
 
-        # The one-hot representations of each target word in memory. The memory will memorize at most 2*encoder_size target words.
-        encoder_probs = np.zeros((self.batch_size, 2 * encoder_size, self.target_vocab_size), dtype=np.float32)
+        # The memory will memorize at most mem_capacity target words.
+        mem_capacity = self.mem_capacity(encoder_size)
         # The target word ids in memory.
-        encoder_ids = np.zeros((self.batch_size, 2 * encoder_size,), dtype=np.int32)
+        encoder_ids = np.zeros((batch_size, mem_capacity,), dtype=np.int32)
         # The mask of memory denoting padding positions in memory.
-        mem_mask = np.zeros((self.batch_size, 2 * encoder_size,), dtype=np.float32)
+        mem_mask = np.zeros((batch_size, mem_capacity,), dtype=np.float32)
+        mem_lens = []
         # generate memory
-        for batch_idx in xrange(self.batch_size):
-            id_set = set()  # record the target ids in memory
-            num = 0
-            loop = 0
-            # add target words into memory via loop. In first loop, add the most possible target word of each source
-            # word in the source sentence; in the second loop, add the second possible target word, ...
-            while num < 2 * encoder_size and loop < 5:
-                for length_idx in xrange(encoder_size):
-                    sid = encoder_inputs[batch_idx][length_idx]
-                    if sid == 2:
-                        break
-                    if len(mems2t[sid]) <= loop:
-                        continue
-                    k, v = mems2t[sid][loop]
-                    if k not in id_set and k != 2 and k != 3:
-                        id_set.add(k)
-                        encoder_ids[batch_idx][num] = k
-                        encoder_probs[batch_idx][num][k] = 1.0
-                        mem_mask[batch_idx][num] = 1.0
-                        num += 1
-                        if num == 2 * encoder_size:
-                            break
-                loop += 1
+        for batch_idx in xrange(batch_size):
+            ids = mem.fill_memory(mems2t, encoder_inputs[batch_idx], mem_capacity)
+            encoder_ids[batch_idx, :len(ids)] = ids
+            mem_mask[batch_idx, :len(ids)] = 1.0
+            mem_lens.append(len(ids))
+
+        # Trim the memory to the largest number of filled slots in this batch, so that the memory attention
+        # only works on the slots in use.
+        mem_size = max(max(mem_lens), 1)
+        encoder_ids = encoder_ids[:, :mem_size]
+        mem_mask = mem_mask[:, :mem_size]
 
         # The probabilities of target to source word mappings. If one target word was from two or more source words
         # in the source sentence, we need to get the probabiblities.
-        encoder_hs = np.zeros((self.batch_size, 2 * encoder_size, encoder_size), dtype=np.float32)
-        for batch_idx in xrange(self.batch_size):
-            for mid in xrange(2 * encoder_size):
-                tid = encoder_ids[batch_idx][mid]
-                if tid in memt2s:
-                    for length_idx in xrange(encoder_size):
-                        sid = encoder_inputs[batch_idx][length_idx]
-                        encoder_hs[batch_idx][mid][length_idx] = memt2s[tid].get(sid, 0.0)
-                    psum = sum(encoder_hs[batch_idx][mid])
-                    if psum > 0:
-                        for length_idx in xrange(encoder_size):
-                            encoder_hs[batch_idx][mid][length_idx] = encoder_hs[batch_idx][mid][length_idx] / psum
+        encoder_hs = np.zeros((batch_size, mem_size, encoder_size), dtype=np.float32)
+        for batch_idx in xrange(batch_size):
+            for mid in xrange(mem_lens[batch_idx]):
+                probs = memt2s.lookup(encoder_ids[batch_idx][mid], encoder_inputs[batch_idx])
+                psum = probs.sum()
+                if psum > 0:
+                    encoder_hs[batch_idx][mid] = probs / psum
 
         # Batch decoder inputs are re-indexed decoder_inputs, we create weights.
         for length_idx in xrange(decoder_size):
             batch_decoder_inputs.append(
                     np.array([decoder_inputs[batch_idx][length_idx]
-                              for batch_idx in xrange(self.batch_size)], dtype=np.int32))
+                              for batch_idx in xrange(batch_size)], dtype=np.int32))
 
             # Create target_weights to be 0 for targets that are padding.
-            batch_weight = np.ones(self.batch_size, dtype=np.float32)
-            for batch_idx in xrange(self.batch_size):
+            batch_weight = np.ones(batch_size, dtype=np.float32)
+            for batch_idx in xrange(batch_size):
                 # We set weight to 0 if the corresponding target is a PAD symbol.
                 # The corresponding target is decoder_input shifted by 1 forward.
                 if length_idx < decoder_size - 1:
@@ -429,9 +643,9 @@ class Seq2SeqModel(object):
         # If one target word is not in memory, and the alignment is zero, then the weight should be zero.
         batch_decoder_aligns, batch_decoder_align_weights = [], []
         for length_idx in xrange(decoder_size):
-            align = np.zeros((self.batch_size, 2 * encoder_size), dtype=np.float32)
-            align_weight = np.ones((self.batch_size,), dtype=np.float32)
-            for batch_idx in xrange(self.batch_size):
+            align = np.zeros((batch_size, mem_size), dtype=np.float32)
+            align_weight = np.ones((batch_size,), dtype=np.float32)
+            for batch_idx in xrange(batch_size):
                 tid = decoder_inputs[batch_idx][length_idx]
                 for i, stid in enumerate(encoder_ids[batch_idx]):
                     if stid == tid:
@@ -441,5 +655,144 @@ class Seq2SeqModel(object):
                     align_weight[batch_idx] = 0.0
             batch_decoder_aligns.append(align)
             batch_decoder_align_weights.append(align_weight)
-        return batch_encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask, \
+        return batch_encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask, \
                batch_decoder_inputs, batch_weights, batch_decoder_aligns, batch_decoder_align_weights
+
+
+class MemAttentionModel(Seq2SeqModel):
+    """
+    The memory attention of Seq2SeqModel, trained on cached features.
+    The NMT part of Seq2SeqModel is frozen, so the encoder annotations and the queries of the memory attention
+    can be extracted once (see Seq2SeqModel.extract_features). This model only builds the memory attention on them,
+    with the variable names of Seq2SeqModel, so that Seq2SeqModel loads its checkpoints as the mem model.
+    Batches are built by the prepare_batch of Seq2SeqModel.
+    """
+
+    def __init__(self, target_vocab_size, buckets, hidden_edim, hidden_units,
+                 max_gradient_norm, batch_size, learning_rate, learning_rate_decay_factor, mem_size=0):
+        """Create the model.
+
+        Args:
+            target_vocab_size: size of the target vocabulary.
+            buckets: a list of pairs (I, O), as in Seq2SeqModel.
+            hidden_edim: number of dimensions for word embedding
+            hidden_units: number of hidden units of the NMT model.
+            max_gradient_norm: gradients will be clipped to maximally this norm.
+            batch_size: the size of the batches used during training.
+            learning_rate: learning rate to start with.
+            learning_rate_decay_factor: decay learning rate by this much when needed.
+            mem_size: the maximum number of target words in memory, as in Seq2SeqModel.
+        """
+        self.target_vocab_size = target_vocab_size
+        self.buckets = buckets
+        self.batch_size = batch_size
+        self.mem_size = mem_size
+        self.learning_rate = tf.Variable(float(learning_rate), trainable=False)
+        self.learning_rate_decay_op = self.learning_rate.assign(
+                self.learning_rate * learning_rate_decay_factor)
+        self.global_step = tf.Variable(0, trainable=False)
+
+        attn_size = 2 * hidden_units
+        query_size = hidden_units + hidden_edim
+
+        # Feeds for inputs.
+        self.attention_states = tf.placeholder(tf.float32, shape=[None, None, attn_size],
+                                               name="attention_states")
+        self.queries = []
+        self.decoder_inputs = []
+        self.target_weights = []
+        self.decoder_aligns = []
+        self.decoder_align_weights = []
+        for i in xrange(buckets[-1][1] + 1):
+            self.queries.append(tf.placeholder(tf.float32, shape=[None, query_size],
+                                               name="query{0}".format(i)))
+            self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None],
+                                                      name="decoder{0}".format(i)))
+            self.target_weights.append(tf.placeholder(tf.float32, shape=[None],
+                                                      name="weight{0}".format(i)))
+            self.decoder_aligns.append(tf.placeholder(tf.float32, shape=[None, None],
+                                                      name="align{0}".format(i)))
+            self.decoder_align_weights.append(tf.placeholder(tf.float32, shape=[None],
+                                                             name="align_weight{0}".format(i)))
+        self.encoder_ids = tf.placeholder(tf.int32, shape=[None, None],
+                                          name="encoder_id")
+        self.encoder_hs = tf.placeholder(tf.float32, shape=[None, None, None],
+                                         name="encoder_h")
+        self.mem_mask = tf.placeholder(tf.float32, shape=[None, None],
+                                       name="mem_mask")
+
+        with tf.variable_scope("embedding_attention_seq2seq"):
+            with tf.variable_scope("embedding_attention_decoder"):
+                # the frozen target embedding, loaded from the NMT model
+                self.embedding = tf.get_variable("embedding", [target_vocab_size, hidden_edim],
+                                                 trainable=False)
+                encoder_embeds = tf.nn.embedding_lookup(self.embedding, self.encoder_ids)
+                self.losses = []
+                for j, bucket in enumerate(buckets):
+                    with tf.variable_scope("attention_decoder", reuse=True if j > 0 else None):
+                        aligns_mem = seq2seq_fy.memory_attention(
+                                self.attention_states, self.queries[:bucket[1]], encoder_embeds,
+                                self.encoder_hs, self.mem_mask, scope="attention")
+                    self.losses.append(seq2seq_fy.alignment_loss(
+                            aligns_mem, self.target_weights[:bucket[1]], self.decoder_aligns[:bucket[1]],
+                            self.decoder_align_weights[:bucket[1]]))
+
+        params_to_update = tf.trainable_variables()
+        self.gradient_norms = []
+        self.updates = []
+        opt = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+        for b in xrange(len(buckets)):
+            gradients = tf.gradients(self.losses[b], params_to_update,
+                                     aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE)
+            clipped_gradients, norm = tf.clip_by_global_norm(gradients,
+                                                             max_gradient_norm)
+            self.gradient_norms.append(norm)
+            self.updates.append(opt.apply_gradients(
+                    zip(clipped_gradients, params_to_update), global_step=self.global_step))
+
+        # load the target embedding of the trained NMT model
+        self.saver_old = tf.train.Saver([self.embedding], max_to_keep=1000)
+        # save the same parameters as Seq2SeqModel.saver
+        self.saver = tf.train.Saver([p for p in tf.all_variables() if p is not self.embedding],
+                                    max_to_keep=1000, keep_checkpoint_every_n_hours=6)
+
+    def step(self, session, attention_states, queries, encoder_ids, encoder_hs, mem_mask, decoder_inputs,
+             target_weights, decoder_aligns, decoder_align_weights, bucket_id, forward_only):
+        """Run a step of the model feeding the given inputs.
+
+        Args:
+          session: tensorflow session to use.
+          attention_states: a 3D numpy float matrix [batch_size x encoder_size x attn_size].
+          queries: a 3D numpy float matrix [batch_size x decoder_size x query_size].
+          encoder_ids: a 2D numpy int matrix to feed as encoder ids.
+          encoder_hs: a 3D numpy float matrix to feed as encoder hs.
+          mem_mask: a 2D numpy int matrix to feed as mem mask.
+          decoder_inputs: list of numpy int vectors to feed as decoder inputs.
+          target_weights: list of numpy float vectors to feed as target weights.
+          decoder_aligns: list of numpy int vectors to feed as decoder aligns.
+          decoder_align_weights: list of numpy float vectors to feed as decoder_align_weights.
+          bucket_id: which bucket of the model to use.
+          forward_only: whether to do the backward step or only forward.
+
+        Returns:
+          A pair consisting of gradient norm (or None if we did not do backward) and the loss.
+        """
+        encoder_size, decoder_size = self.buckets[bucket_id]
+        input_feed = {}
+        for l in xrange(decoder_size):
+            input_feed[self.queries[l].name] = queries[:, l]
+            input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
+            input_feed[self.target_weights[l].name] = target_weights[l]
+            input_feed[self.decoder_aligns[l].name] = decoder_aligns[l]
+            input_feed[self.decoder_align_weights[l].name] = decoder_align_weights[l]
+        input_feed[self.attention_states.name] = attention_states
+        input_feed[self.encoder_ids.name] = encoder_ids
+        input_feed[self.encoder_hs.name] = encoder_hs
+        input_feed[self.mem_mask.name] = mem_mask
+        input_feed[self.decoder_inputs[decoder_size].name] = np.zeros([len(encoder_ids)], dtype=np.int32)
+
+        if not forward_only:
+            outputs = session.run([self.updates[bucket_id], self.gradient_norms[bucket_id],
+                                   self.losses[bucket_id]], input_feed)
+            return outputs[1], outputs[2]
+        return None, session.run(self.losses[bucket_id], input_feed)
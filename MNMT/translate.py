@@ -39,6 +39,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
 import math
 import os
 import sys
@@ -46,11 +47,14 @@ import time
 import numpy as np
 from six.moves import xrange
 import tensorflow as tf
-import pickle as pkl
 
 sys.path.append(".")
 import data_utils
+import mem
 import seq2seq_model
+import batch_pool
+import feature_cache
+import translation_cache
 
 tf.app.flags.DEFINE_float("learning_rate", 0.0005, "Learning rate.")
 tf.app.flags.DEFINE_float("learning_rate_decay_factor", 0.99,
@@ -69,12 +73,72 @@ tf.app.flags.DEFINE_string("data_dir", "./data", "Data directory")
 tf.app.flags.DEFINE_string("train_dir", "./MNMT/train", "Training directory.")
 tf.app.flags.DEFINE_integer("steps_per_checkpoint", 1000,
                             "How many training steps to do per checkpoint.")
+tf.app.flags.DEFINE_integer("batch_workers", 0,
+                            "Number of processes building training batches; 0 builds them in the training thread.")
+tf.app.flags.DEFINE_string("feature_dir", "",
+                           "Directory of the cached NMT features; when set, only the memory attention is "
+                           "trained on them.")
+tf.app.flags.DEFINE_boolean("extract_features", False,
+                            "Set to True to run the trained NMT model over the training and dev sets "
+                            "and cache their features in feature_dir.")
 tf.app.flags.DEFINE_boolean("decode", False,
                             "Set to True for interactive decoding.")
 tf.app.flags.DEFINE_string("model", "translate.ckpt-nmt", "The trained NMT model to load.")
 tf.app.flags.DEFINE_string("model2", "", "the checkpoint mem model to load")
+tf.app.flags.DEFINE_integer("mem_size", 0,
+                            "The maximum number of target words in memory, 0 means twice the source bucket size.")
 tf.app.flags.DEFINE_integer("beam_size", 5,
                             "The size of beam search. Do greedy search when set this to 1.")
+tf.app.flags.DEFINE_float("decode_length_ratio", 0.0,
+                          "When decoding, end every translation once it is this many times as long as its source "
+                          "sentence; 0 only limits it by the bucket.")
+tf.app.flags.DEFINE_float("beam_relative_threshold", 0.0,
+                          "When decoding, drop the hypotheses whose probability is below this fraction of the best "
+                          "one of their sentence, e.g. 0.01; 0 keeps them.")
+tf.app.flags.DEFINE_float("beam_absolute_margin", 0.0,
+                          "When decoding, drop the hypotheses whose log probability is more than this below the best "
+                          "one of their sentence; 0 keeps them.")
+tf.app.flags.DEFINE_integer("encoder_cache_size", 0,
+                            "When decoding, keep the encoder states of this many recent sentences and run beam search "
+                            "from them, so that repeated sentences and shortlist_check skip the encoder; 0 disables it.")
+tf.app.flags.DEFINE_integer("decode_batch_size", 1,
+                            "The number of input sentences read and translated together when decoding.")
+tf.app.flags.DEFINE_string("decode_input", "",
+                           "Translate this file, with its sentences sorted by length and translated in batches of "
+                           "decode_batch_size, instead of reading stdin.")
+tf.app.flags.DEFINE_string("decode_output", "",
+                           "The file of the translations of decode_input, in the input order; empty prints them.")
+tf.app.flags.DEFINE_integer("decode_chunk_size", 10000,
+                            "The number of lines of decode_input read and sorted at a time; 0 reads the whole file.")
+tf.app.flags.DEFINE_integer("translation_cache_size", 0,
+                            "When decoding, keep the translations of this many recent sentences in memory and reuse "
+                            "them for repeated sentences; 0 disables the cache unless translation_cache_path is set.")
+tf.app.flags.DEFINE_string("translation_cache_path", "",
+                           "A file keeping all translations across runs; it is emptied when the model changes.")
+tf.app.flags.DEFINE_float("fuzzy_threshold", 0.0,
+                          "When decoding, reuse the translation of a previously translated sentence whose similarity "
+                          "(1 - edit distance / length) to the input is at least this; 0 disables the fuzzy memory.")
+tf.app.flags.DEFINE_integer("fuzzy_max_edits", 2,
+                            "The maximum number of token edits between the input and a reused sentence.")
+tf.app.flags.DEFINE_string("fuzzy_memory_path", "",
+                           "A file keeping the fuzzy memory across runs; it is emptied when the model changes.")
+tf.app.flags.DEFINE_boolean("fuzzy_flag", False,
+                            "Prefix the reused fuzzy translations with [fuzzy <similarity>].")
+tf.app.flags.DEFINE_integer("intra_op_threads", 0,
+                            "The number of threads of the decoding session within an op (e.g. a matmul); "
+                            "0 lets TensorFlow use all cores.")
+tf.app.flags.DEFINE_integer("inter_op_threads", 0,
+                            "The number of threads of the decoding session running independent ops; "
+                            "0 lets TensorFlow choose.")
+tf.app.flags.DEFINE_boolean("lazy_buckets", False,
+                            "When decoding, build the graph of a bucket the first time a sentence of its length comes.")
+tf.app.flags.DEFINE_integer("shortlist_top_n", 0,
+                            "Decode with a vocabulary shortlist made of the top n mems2t candidates of each source "
+                            "word and the shortlist_frequent most frequent target words; 0 uses the full vocabulary.")
+tf.app.flags.DEFINE_integer("shortlist_frequent", 2000,
+                            "Number of most frequent target words always in the shortlist.")
+tf.app.flags.DEFINE_boolean("shortlist_check", False,
+                            "Also decode with the full vocabulary and report how often both translations agree.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -127,15 +191,51 @@ def read_data(source_path, target_path):
     return data_set
 
 
-def create_model(session, forward_only, ckpt_file=None, ckpt_file2=None):
+def _report_graph(start_time):
+    """Print the time taken to build the model graph and the size of its GraphDef."""
+    graph_def = tf.get_default_graph().as_graph_def()
+    sys.stderr.write("Built the model in %.1fs: %d ops, GraphDef %.1f MB\n"
+                     % (time.time() - start_time, len(graph_def.node), graph_def.ByteSize() / 2.0 ** 20))
+    sys.stderr.flush()
+
+
+def _beam_margin():
+    """The margin of log probability below the best hypothesis of the beam pruning flags, 0 if none is set."""
+    margins = []
+    if FLAGS.beam_absolute_margin > 0:
+        margins.append(FLAGS.beam_absolute_margin)
+    if 0 < FLAGS.beam_relative_threshold < 1:
+        margins.append(-math.log(FLAGS.beam_relative_threshold))
+    return min(margins) if margins else 0.0
+
+
+def create_model(session, forward_only, ckpt_file=None, ckpt_file2=None, extract_features=False,
+                 use_shortlist=False):
     """Create translation model and initialize or load parameters in session."""
+    model = build_model(forward_only, extract_features=extract_features, use_shortlist=use_shortlist)
+    load_model(session, model, ckpt_file, ckpt_file2)
+    return model
+
+
+def build_model(forward_only, extract_features=False, use_shortlist=False):
+    """Build the graph of the translation model, without a session."""
+    start_time = time.time()
     model = seq2seq_model.Seq2SeqModel(
             FLAGS.src_vocab_size, FLAGS.trg_vocab_size, _buckets,
             FLAGS.hidden_edim, FLAGS.hidden_units, FLAGS.num_layers,
             FLAGS.keep_prob, FLAGS.max_gradient_norm, FLAGS.batch_size,
             FLAGS.learning_rate, FLAGS.learning_rate_decay_factor,
-            FLAGS.beam_size,
-            forward_only=forward_only)
+            FLAGS.beam_size, mem_size=FLAGS.mem_size,
+            forward_only=forward_only, extract_features=extract_features, use_shortlist=use_shortlist,
+            lazy_buckets=forward_only and FLAGS.lazy_buckets,
+            max_length_ratio=FLAGS.decode_length_ratio, beam_margin=_beam_margin(),
+            encoder_cache_size=FLAGS.encoder_cache_size if forward_only else 0)
+    _report_graph(start_time)
+    return model
+
+
+def load_model(session, model, ckpt_file=None, ckpt_file2=None):
+    """Initialize or load the parameters of a model built by build_model in session."""
     if ckpt_file and not ckpt_file2:
         model_path = os.path.join(FLAGS.train_dir, ckpt_file)
         if tf.gfile.Exists(model_path):
@@ -179,7 +279,6 @@ def create_model(session, forward_only, ckpt_file=None, ckpt_file2=None):
         else:
             print("Created model with fresh parameters.")
             session.run(tf.initialize_all_variables())
-    return model
 
 
 def train():
@@ -196,29 +295,178 @@ def train():
     if FLAGS.trg_vocab_size > len(trg_vocab):
         FLAGS.trg_vocab_size = len(trg_vocab)
 
-    f = open("{}/mems2t.pkl".format(FLAGS.data_dir), 'rb')
-    mems2t = pkl.load(f)
-    f.close()
+    mems2t = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "mems2t"))
+    memt2s = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "memt2s"))
+
+    # Create model.
+    print("Creating %d layers of %d units with word embedding %d."
+          % (FLAGS.num_layers, FLAGS.hidden_units, FLAGS.hidden_edim))
+    model = build_model(False)
+
+    # Read data into buckets and compute their sizes.
+    dev_set = read_data(src_dev, trg_dev)
+    train_set = read_data(src_train, trg_train)
+    train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
+    train_total_size = float(sum(train_bucket_sizes))
+
+    # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
+    # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
+    # the size if i-th training bucket, as used later.
+    train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
+                           for i in xrange(len(train_bucket_sizes))]
+
+    # Worker processes build the batches when batch_workers is set, they choose the buckets themselves.
+    # They are forked before the session starts its threads.
+    pool = None
+    if FLAGS.batch_workers > 0:
+        pool = batch_pool.BatchPool(model, train_set, train_buckets_scale, mems2t, memt2s,
+                                    FLAGS.batch_workers)
+
+    try:
+        with tf.Session() as sess:
+            load_model(sess, model, FLAGS.model, FLAGS.model2)
+
+            # This is the training loop.
+            step_time, batch_time, loss = 0.0, 0.0, 0.0
+            current_step = 0
+            previous_losses = []
+            while True:
+                # Get a batch and make a step.
+                start_time = time.time()
+                if pool:
+                    bucket_id, batch = pool.next_batch()
+                else:
+                    # Choose a bucket according to data distribution. We pick a random number
+                    # in [0, 1] and use the corresponding interval in train_buckets_scale.
+                    random_number_01 = np.random.random_sample()
+                    bucket_id = min([i for i in xrange(len(train_buckets_scale))
+                                     if train_buckets_scale[i] > random_number_01])
+                    batch = model.get_batch(train_set, bucket_id, mems2t, memt2s)
+                batch_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
+                encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask, decoder_inputs, \
+                target_weights, decoder_aligns, decoder_align_weights = batch
+
+                _, step_loss, _ = model.step(sess, encoder_inputs, encoder_mask, encoder_ids,
+                                             encoder_hs, mem_mask, decoder_inputs, target_weights, decoder_aligns,
+                                             decoder_align_weights, bucket_id, False)
+
+                step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
+                loss += step_loss / FLAGS.steps_per_checkpoint
+                current_step += 1
+
+                # Once in a while, we save checkpoint, print statistics, and run evals.
+                if current_step % FLAGS.steps_per_checkpoint == 0:
+                    # Print statistics for the previous epoch.
+                    perplexity = math.exp(loss) if loss < 300 else float('inf')
+                    print("global step %d learning rate %.8f step-time %.2f batch-time %.2f perplexity "
+                          "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
+                                    step_time, batch_time, perplexity))
+
+                    # Decrease learning rate if no improvement was seen over last 3 times.
+                    if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
+                        sess.run(model.learning_rate_decay_op)
+                    previous_losses.append(loss)
+                    # Save checkpoint and zero timer and loss.
+                    checkpoint_path = os.path.join(FLAGS.train_dir, "translate.ckpt")
+                    model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+                    step_time, batch_time, loss = 0.0, 0.0, 0.0
+                    # Run evals on development set and print their perplexity.
+                    for bucket_id in xrange(len(_buckets)):
+                        if len(dev_set[bucket_id]) == 0:
+                            print("  eval: empty bucket %d" % (bucket_id))
+                            continue
+                        encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask, \
+                        decoder_inputs, target_weights, decoder_aligns, decoder_align_weights = model.get_batch(
+                                dev_set, bucket_id, mems2t, memt2s)
+                        _, eval_loss, _ = model.step(sess, encoder_inputs, encoder_mask, encoder_ids,
+                                                     encoder_hs, mem_mask, decoder_inputs, target_weights,
+                                                     decoder_aligns, decoder_align_weights, bucket_id, True)
+                        eval_ppx = math.exp(eval_loss) if eval_loss < 300 else float('inf')
+                        print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))  # annotated by yfeng
+                    sys.stdout.flush()
+    finally:
+        if pool:
+            pool.close()
+
+
+def extract_features():
+    """Run the trained NMT model over the training and dev sets and cache the inputs of the memory attention."""
+    print("Preparing training and dev data in %s" % FLAGS.data_dir)
+    src_train, trg_train, src_dev, trg_dev, src_vocab_path, trg_vocab_path = data_utils.prepare_wmt_data(
+            FLAGS.data_dir, FLAGS.src_vocab_size, FLAGS.trg_vocab_size)
+
+    src_vocab, rev_src_vocab = data_utils.initialize_vocabulary(src_vocab_path)
+    trg_vocab, rev_trg_vocab = data_utils.initialize_vocabulary(trg_vocab_path)
+
+    if FLAGS.src_vocab_size > len(src_vocab):
+        FLAGS.src_vocab_size = len(src_vocab)
+    if FLAGS.trg_vocab_size > len(trg_vocab):
+        FLAGS.trg_vocab_size = len(trg_vocab)
+
+    mems2t = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "mems2t"))
+    memt2s = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "memt2s"))
+
+    with tf.Session() as sess:
+        model = create_model(sess, False, FLAGS.model, extract_features=True)
+
+        def extract_fn(pairs, bucket_id):
+            encoder_inputs, encoder_mask, _, _, _, decoder_inputs, _, _, _ = model.prepare_batch(
+                    pairs, bucket_id, mems2t, memt2s)
+            return model.extract_features(sess, encoder_inputs, encoder_mask, decoder_inputs, bucket_id)
+
+        for name, source_path, target_path in (("train", src_train, trg_train), ("dev", src_dev, trg_dev)):
+            start_time = time.time()
+            nbytes = feature_cache.write_features(os.path.join(FLAGS.feature_dir, name),
+                                                  read_data(source_path, target_path), FLAGS.batch_size, extract_fn)
+            print("Cached the %s features in %s: %.1f MB in %.1f seconds."
+                  % (name, FLAGS.feature_dir, nbytes / 2 ** 20, time.time() - start_time))
+            sys.stdout.flush()
+
+
+def _feature_batch(model, data_set, features, bucket_id, mems2t, memt2s):
+    """A random batch of a bucket with its cached features, in the order of the arguments of MemAttentionModel.step."""
+    indices = np.sort(np.random.randint(len(data_set[bucket_id]), size=model.batch_size))
+    _, _, encoder_ids, encoder_hs, mem_mask, decoder_inputs, target_weights, decoder_aligns, \
+    decoder_align_weights = model.prepare_batch([data_set[bucket_id][i] for i in indices], bucket_id,
+                                                mems2t, memt2s)
+    attention_states, queries = features.get(bucket_id, indices)
+    return attention_states, queries, encoder_ids, encoder_hs, mem_mask, decoder_inputs, target_weights, \
+           decoder_aligns, decoder_align_weights
+
+
+def train_from_features():
+    """Train the memory attention on the features cached by extract_features."""
+    print("Preparing training and dev data in %s" % FLAGS.data_dir)
+    src_train, trg_train, src_dev, trg_dev, src_vocab_path, trg_vocab_path = data_utils.prepare_wmt_data(
+            FLAGS.data_dir, FLAGS.src_vocab_size, FLAGS.trg_vocab_size)
+
+    trg_vocab, rev_trg_vocab = data_utils.initialize_vocabulary(trg_vocab_path)
+    if FLAGS.trg_vocab_size > len(trg_vocab):
+        FLAGS.trg_vocab_size = len(trg_vocab)
 
-    f = open("{}/memt2s.pkl".format(FLAGS.data_dir), 'rb')
-    memt2s = pkl.load(f)
-    f.close()
+    mems2t = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "mems2t"))
+    memt2s = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "memt2s"))
 
     with tf.Session() as sess:
-        # Create model.
-        print("Creating %d layers of %d units with word embedding %d."
-              % (FLAGS.num_layers, FLAGS.hidden_units, FLAGS.hidden_edim))
-        model = create_model(sess, False, FLAGS.model, FLAGS.model2)
+        model = seq2seq_model.MemAttentionModel(
+                FLAGS.trg_vocab_size, _buckets, FLAGS.hidden_edim, FLAGS.hidden_units,
+                FLAGS.max_gradient_norm, FLAGS.batch_size, FLAGS.learning_rate,
+                FLAGS.learning_rate_decay_factor, mem_size=FLAGS.mem_size)
+        sess.run(tf.initialize_all_variables())
+        model_path = os.path.join(FLAGS.train_dir, FLAGS.model)
+        sys.stderr.write("Reading the target embedding from %s\n" % model_path)
+        model.saver_old.restore(sess, model_path)
+        if FLAGS.model2:
+            model_path2 = os.path.join(FLAGS.train_dir, FLAGS.model2)
+            sys.stderr.write("Reading model parameters from %s\n" % model_path2)
+            model.saver.restore(sess, model_path2)
 
-        # Read data into buckets and compute their sizes.
         dev_set = read_data(src_dev, trg_dev)
         train_set = read_data(src_train, trg_train)
+        dev_features = feature_cache.FeatureCache(os.path.join(FLAGS.feature_dir, "dev"), dev_set)
+        train_features = feature_cache.FeatureCache(os.path.join(FLAGS.feature_dir, "train"), train_set)
         train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
         train_total_size = float(sum(train_bucket_sizes))
-
-        # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-        # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-        # the size if i-th training bucket, as used later.
         train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
                                for i in xrange(len(train_bucket_sizes))]
 
@@ -227,21 +475,13 @@ def train():
         current_step = 0
         previous_losses = []
         while True:
-            # Choose a bucket according to data distribution. We pick a random number
-            # in [0, 1] and use the corresponding interval in train_buckets_scale.
+            # Get a batch and make a step.
+            start_time = time.time()
             random_number_01 = np.random.random_sample()
             bucket_id = min([i for i in xrange(len(train_buckets_scale))
                              if train_buckets_scale[i] > random_number_01])
-
-            # Get a batch and make a step.
-            start_time = time.time()
-            encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask, decoder_inputs, \
-            target_weights, decoder_aligns, decoder_align_weights = model.get_batch(
-                    train_set, bucket_id, mems2t, memt2s)
-
-            _, step_loss, _ = model.step(sess, encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask,
-                                         decoder_inputs, target_weights, decoder_aligns, decoder_align_weights,
-                                         bucket_id, False)
+            batch = _feature_batch(model, train_set, train_features, bucket_id, mems2t, memt2s)
+            _, step_loss = model.step(sess, *(batch + (bucket_id, False)))
 
             step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
             loss += step_loss / FLAGS.steps_per_checkpoint
@@ -249,11 +489,9 @@ def train():
 
             # Once in a while, we save checkpoint, print statistics, and run evals.
             if current_step % FLAGS.steps_per_checkpoint == 0:
-                # Print statistics for the previous epoch.
                 perplexity = math.exp(loss) if loss < 300 else float('inf')
                 print("global step %d learning rate %.8f step-time %.2f perplexity "
-                      "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
-                                step_time, perplexity))
+                      "%.2f" % (model.global_step.eval(), model.learning_rate.eval(), step_time, perplexity))
 
                 # Decrease learning rate if no improvement was seen over last 3 times.
                 if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
@@ -268,19 +506,73 @@ def train():
                     if len(dev_set[bucket_id]) == 0:
                         print("  eval: empty bucket %d" % (bucket_id))
                         continue
-                    encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask, decoder_inputs, \
-                    target_weights, decoder_aligns, decoder_align_weights = model.get_batch(
-                            dev_set, bucket_id, mems2t, memt2s)
-                    _, eval_loss, _ = model.step(sess, encoder_inputs, encoder_mask, encoder_probs, encoder_ids,
-                                                 encoder_hs, mem_mask, decoder_inputs, target_weights, decoder_aligns,
-                                                 decoder_align_weights, bucket_id, True)
+                    batch = _feature_batch(model, dev_set, dev_features, bucket_id, mems2t, memt2s)
+                    _, eval_loss = model.step(sess, *(batch + (bucket_id, True)))
                     eval_ppx = math.exp(eval_loss) if eval_loss < 300 else float('inf')
-                    print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))  # annotated by yfeng
+                    print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
                 sys.stdout.flush()
 
 
+def translate_file(input_path, output_path, to_token_ids, translate):
+    """Translate a file in batches of sentences of similar lengths, and write the translations in the input order.
+
+    Args:
+        input_path: the file of the source sentences, one per line.
+        output_path: the file to write the translations to; they are printed if it is empty.
+        to_token_ids: a function sentence -> token ids, ending with EOS.
+        translate: a function (list of token ids, bucket_id) -> list of translations.
+    """
+    def bucket_of(token_ids):
+        return min([b for b in xrange(len(_buckets)) if _buckets[b][0] > len(token_ids)])
+
+    start_time = time.time()
+    num_sentences, num_source_tokens, num_target_tokens = 0, 0, 0
+    output_file = open(output_path, "w") if output_path else sys.stdout
+    with open(input_path) as input_file:
+        while True:
+            # Read a chunk of the input, or all of it.
+            sentences = list(itertools.islice(input_file, FLAGS.decode_chunk_size or None))
+            if not sentences:
+                break
+            token_ids = [to_token_ids(sentence) for sentence in sentences]
+            # Sort the sentences by length, so that each batch holds sentences of the same bucket.
+            order = sorted(xrange(len(sentences)), key=lambda k: len(token_ids[k]))
+            translations = [None] * len(sentences)
+            start = 0
+            while start < len(order):
+                bucket_id = bucket_of(token_ids[order[start]])
+                end = start + 1
+                while (end < len(order) and end - start < FLAGS.decode_batch_size
+                       and bucket_of(token_ids[order[end]]) == bucket_id):
+                    end += 1
+                batch = order[start:end]
+                for k, translation in zip(batch, translate([token_ids[k] for k in batch], bucket_id)):
+                    translations[k] = translation
+                start = end
+
+            for translation in translations:
+                output_file.write(translation + "\n")
+            output_file.flush()
+            num_sentences += len(sentences)
+            num_source_tokens += sum(len(ids) - 1 for ids in token_ids)
+            num_target_tokens += sum(len(translation.split()) for translation in translations)
+            sys.stderr.write("Translated %d sentences\n" % num_sentences)
+            sys.stderr.flush()
+    if output_path:
+        output_file.close()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    sys.stderr.write("Translated %d sentences in %.1fs: %.2f sentences/s, %.1f source tokens/s, "
+                     "%.1f target tokens/s\n" % (num_sentences, elapsed, num_sentences / elapsed,
+                                                 num_source_tokens / elapsed, num_target_tokens / elapsed))
+    sys.stderr.flush()
+
+
 def decode():
-    with tf.Session() as sess:
+    # Several decoding processes on one machine each get their share of the cores, see shard_decode.py.
+    config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                            inter_op_parallelism_threads=FLAGS.inter_op_threads)
+    with tf.Session(config=config) as sess:
         # Load vocabularies.
         src_vocab_path = os.path.join(FLAGS.data_dir,
                                      "vocab%d.src" % FLAGS.src_vocab_size)
@@ -294,45 +586,170 @@ def decode():
         if FLAGS.trg_vocab_size > len(trg_vocab):
             FLAGS.trg_vocab_size = len(trg_vocab)
 
-        f = open("{}/mems2t.pkl".format(FLAGS.data_dir), 'rb')
-        mems2t = pkl.load(f)
-        f.close()
+        mems2t = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "mems2t"))
+        memt2s = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "memt2s"))
 
-        f = open("{}/memt2s.pkl".format(FLAGS.data_dir), 'rb')
-        memt2s = pkl.load(f)
-        f.close()
+        if FLAGS.shortlist_top_n > 0:
+            full_vocab = np.arange(FLAGS.trg_vocab_size, dtype=np.int32)
+        # shortlist size, translations identical to full vocabulary decoding, translations checked
+        check = [0, 0, 0]
 
         # Create model and load parameters.
-        model = create_model(sess, True, FLAGS.model, FLAGS.model2)
-        model.batch_size = 1  # We decode one sentence at a time.
-
-        sentence = sys.stdin.readline()
-        while sentence:
+        model = create_model(sess, True, FLAGS.model, FLAGS.model2, use_shortlist=FLAGS.shortlist_top_n > 0)
+
+        cache, fuzzy = None, None
+        if FLAGS.translation_cache_size > 0 or FLAGS.translation_cache_path or FLAGS.fuzzy_threshold > 0:
+            # The translations depend on the checkpoints, the vocabularies, the memories and the decoding settings.
+            patterns = translation_cache.checkpoint_patterns(os.path.join(FLAGS.train_dir, FLAGS.model))
+            if FLAGS.model2:
+                patterns += translation_cache.checkpoint_patterns(os.path.join(FLAGS.train_dir, FLAGS.model2))
+            patterns += [src_vocab_path, trg_vocab_path, os.path.join(FLAGS.data_dir, "mems2t.*.npy"),
+                         os.path.join(FLAGS.data_dir, "memt2s.*.npy")]
+            settings = (FLAGS.beam_size, _beam_margin(), FLAGS.mem_size, FLAGS.decode_length_ratio,
+                        FLAGS.shortlist_top_n, FLAGS.shortlist_frequent, FLAGS.hidden_edim, FLAGS.hidden_units,
+                        FLAGS.num_layers)
+            model_fingerprint = translation_cache.fingerprint(patterns, settings)
+            if FLAGS.translation_cache_size > 0 or FLAGS.translation_cache_path:
+                cache = translation_cache.TranslationCache(model_fingerprint, FLAGS.translation_cache_size,
+                                                           FLAGS.translation_cache_path)
+            if FLAGS.fuzzy_threshold > 0:
+                fuzzy = translation_cache.FuzzyMemory(model_fingerprint, FLAGS.fuzzy_threshold, FLAGS.fuzzy_max_edits,
+                                                      path=FLAGS.fuzzy_memory_path)
+        # seconds of beam search, sentences translated by beam search
+        search_time = [0.0, 0]
+
+        def to_token_ids(sentence):
             token_ids = data_utils.sentence_to_token_ids(tf.compat.as_bytes(sentence), src_vocab)
             token_ids.append(data_utils.EOS_ID)
-            # Which bucket does it belong to?
-            bucket_id = min([b for b in xrange(len(_buckets)) if _buckets[b][0] > len(token_ids)])
-            # Get a 1-element batch to feed the sentence to the model.
-            encoder_inputs, encoder_mask, encoder_probs, encoder_ids, encoder_hs, mem_mask, decoder_inputs, \
-            target_weights, decoder_aligns, decoder_align_weights = model.get_batch(
-                    {bucket_id: [(token_ids, [])]}, bucket_id, mems2t, memt2s)
-            # Get output logits for the sentence.
-            _, _, output_logits = model.step(sess, encoder_inputs, encoder_mask, encoder_probs, encoder_ids,
-                                             encoder_hs, mem_mask, decoder_inputs, target_weights, decoder_aligns,
-                                             decoder_align_weights, bucket_id, True)
-
-            # This is a beam search decoder - output is the best result from beam search
-            outputs = [int(logit) for logit in output_logits]
-
-            # If there is an EOS symbol in outputs, cut them at that point.
-            if data_utils.EOS_ID in outputs:
-                outputs = outputs[:outputs.index(data_utils.EOS_ID)]
-            print(" ".join([tf.compat.as_str(rev_trg_vocab[output]) for output in outputs]))
+            return token_ids
+
+        def translate(batch, bucket_id):
+            """Translate a list of token ids of the same bucket together, returns the translated sentences."""
+            shortlist = None
+            if FLAGS.shortlist_top_n > 0:
+                # The batch is decoded over the union of the shortlists, each sentence over its own.
+                shortlist = mem.merge_shortlists([
+                    mem.get_shortlist(mems2t, token_ids, FLAGS.shortlist_top_n,
+                                      min(FLAGS.shortlist_frequent, FLAGS.trg_vocab_size))
+                    for token_ids in batch])
+            if FLAGS.encoder_cache_size > 0:
+                # Search from the cached encoder states; the check below reuses them too.
+                states = model.encode(sess, batch, bucket_id, mems2t, memt2s)
+                output_logits = model.search(sess, states, bucket_id, shortlist=shortlist)
+                if FLAGS.shortlist_top_n > 0 and FLAGS.shortlist_check:
+                    full_logits = model.search(sess, states, bucket_id, shortlist=full_vocab)
+            else:
+                # Get a batch of the sentences of the bucket to feed the model.
+                encoder_inputs, encoder_mask, encoder_ids, encoder_hs, mem_mask, decoder_inputs, \
+                target_weights, decoder_aligns, decoder_align_weights = model.prepare_batch(
+                        [(token_ids, []) for token_ids in batch], bucket_id, mems2t, memt2s)
+                # Get output logits for the sentences.
+                _, _, output_logits = model.step(sess, encoder_inputs, encoder_mask, encoder_ids,
+                                                 encoder_hs, mem_mask, decoder_inputs, target_weights, decoder_aligns,
+                                                 decoder_align_weights, bucket_id, True, shortlist=shortlist)
+                if FLAGS.shortlist_top_n > 0 and FLAGS.shortlist_check:
+                    _, _, full_logits = model.step(sess, encoder_inputs, encoder_mask, encoder_ids,
+                                                   encoder_hs, mem_mask, decoder_inputs, target_weights,
+                                                   decoder_aligns, decoder_align_weights, bucket_id, True,
+                                                   shortlist=full_vocab)
+
+            translations = []
+            for i in xrange(len(batch)):
+                # This is a beam search decoder - output is the best result from beam search
+                outputs = [int(logit[i]) for logit in output_logits]
+                if FLAGS.shortlist_top_n > 0 and FLAGS.shortlist_check:
+                    check[0] += shortlist[1][i].sum()
+                    check[1] += [int(logit[i]) for logit in full_logits] == outputs
+                    check[2] += 1
+
+                # If there is an EOS symbol in outputs, cut them at that point.
+                if data_utils.EOS_ID in outputs:
+                    outputs = outputs[:outputs.index(data_utils.EOS_ID)]
+                translations.append(" ".join([tf.compat.as_str(rev_trg_vocab[output]) for output in outputs]))
+            return translations
+
+        def reuse_translate(batch, bucket_id):
+            """Like translate, but only the sentences missing from the cache and the fuzzy memory are translated."""
+            translations = [None] * len(batch)
+            if cache is not None:
+                translations = [cache.get(token_ids) for token_ids in batch]
+            if fuzzy is not None:
+                for k, token_ids in enumerate(batch):
+                    match = fuzzy.lookup(token_ids) if translations[k] is None else None
+                    if match is not None:
+                        translation, similarity = match
+                        if FLAGS.fuzzy_flag:
+                            translation = "[fuzzy %.2f] %s" % (similarity, translation)
+                        translations[k] = translation
+            misses = [k for k, translation in enumerate(translations) if translation is None]
+            if misses:
+                start_time = time.time()
+                translated = translate([batch[k] for k in misses], bucket_id)
+                search_time[0] += time.time() - start_time
+                search_time[1] += len(misses)
+                for k, translation in zip(misses, translated):
+                    translations[k] = translation
+                    if cache is not None:
+                        cache.put(batch[k], translation)
+                    if fuzzy is not None:
+                        fuzzy.add(batch[k], translation)
+            return translations
+
+        translate_batch = reuse_translate if cache is not None or fuzzy is not None else translate
+        if FLAGS.decode_input:
+            translate_file(FLAGS.decode_input, FLAGS.decode_output, to_token_ids, translate_batch)
+        else:
             sentence = sys.stdin.readline()
+            while sentence:
+                # Read up to decode_batch_size sentences, and translate those of the same bucket together.
+                sentences = [sentence]
+                while len(sentences) < FLAGS.decode_batch_size:
+                    sentence = sys.stdin.readline()
+                    if not sentence:
+                        break
+                    sentences.append(sentence)
+                batches = {}
+                for k, sentence in enumerate(sentences):
+                    token_ids = to_token_ids(sentence)
+                    # Which bucket does it belong to?
+                    bucket_id = min([b for b in xrange(len(_buckets)) if _buckets[b][0] > len(token_ids)])
+                    batches.setdefault(bucket_id, []).append((k, token_ids))
+
+                translations = [None] * len(sentences)
+                for bucket_id, batch in batches.items():
+                    translated = translate_batch([token_ids for _, token_ids in batch], bucket_id)
+                    for (k, _), translation in zip(batch, translated):
+                        translations[k] = translation
+                for translation in translations:
+                    print(translation)
+                sys.stdout.flush()
+                sentence = sys.stdin.readline()
+
+        reused = 0
+        if cache is not None:
+            cache.close()
+            reused += cache.hits
+            sys.stderr.write(cache.report() + "\n")
+        if fuzzy is not None:
+            fuzzy.save()
+            reused += fuzzy.hits
+            sys.stderr.write("%s, at most %d edits and similarity %.2f\n"
+                             % (fuzzy.report(), FLAGS.fuzzy_max_edits, FLAGS.fuzzy_threshold))
+        if reused > 0 and search_time[1] > 0:
+            sys.stderr.write("Reusing %d translations saved about %.1fs of beam search (%.3fs per sentence)\n"
+                             % (reused, reused * search_time[0] / search_time[1], search_time[0] / search_time[1]))
+        if FLAGS.shortlist_top_n > 0 and FLAGS.shortlist_check and check[2] > 0:
+            sys.stderr.write("Shortlist check: %d of %d translations identical to full vocabulary decoding, "
+                             "average shortlist size %.1f.\n" % (check[1], check[2], check[0] / check[2]))
+
 
 def main(_):
     if FLAGS.decode:
         decode()
+    elif FLAGS.extract_features:
+        extract_features()
+    elif FLAGS.feature_dir:
+        train_from_features()
     else:
         train()
 
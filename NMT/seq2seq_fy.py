@@ -49,6 +49,8 @@ import tensorflow as tf
 from tensorflow.python.framework import dtypes
 from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.ops import data_flow_ops
 from tensorflow.python.ops import embedding_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
@@ -57,13 +59,89 @@ from tensorflow.python.util import nest
 from tensorflow.python.ops import init_ops
 import rnn_cell
 import rnn
+import data_utils
 
 SEED = 123
 
 linear = rnn_cell._linear2  # pylint: disable=protected-access
 
 
-def _extract_argmax_and_embed(embedding, num_symbols, update_embedding=True):
+def _tile_beam(tensor, beam_size):
+    """Repeat every row of tensor beam_size times: [batch_size x ...] -> [batch_size * beam_size x ...]."""
+    ndims = tensor.get_shape().ndims
+    tiled = array_ops.tile(array_ops.expand_dims(tensor, 1), [1, beam_size] + [1] * (ndims - 1))
+    tiled = array_ops.reshape(tiled, array_ops.concat(0, [[-1], array_ops.slice(array_ops.shape(tensor), [1], [-1])]))
+    tiled.set_shape([None] + tensor.get_shape().as_list()[1:])
+    return tiled
+
+
+def _true_indices(mask):
+    """The int32 indices of the true entries of a 1D bool Tensor."""
+    return math_ops.to_int32(array_ops.reshape(array_ops.where(mask), [-1]))
+
+
+def _update_finished(finished_probs, finished_steps, finished_rows, eos_probs, step, batch_size, beam_size):
+    """Keep the best hypothesis ending with EOS of each sentence, if it beats its finished one.
+
+    Args:
+        finished_probs: 1D Tensor [batch_size], the scores of the finished hypotheses.
+        finished_steps: 1D int32 Tensor [batch_size], the beam steps at which they ended.
+        finished_rows: 1D int32 Tensor [batch_size], the rows they extended with EOS at that step.
+        eos_probs: 1D Tensor [batch_size * beam_size], the scores of the live hypotheses ending with EOS.
+        step: Integer, the number of the beam step, from 1.
+        batch_size: The number of sentences.
+        beam_size: The number of live hypotheses of each sentence.
+
+    Returns:
+        The updated finished_probs, finished_steps and finished_rows.
+    """
+    eos_probs = array_ops.reshape(eos_probs, [-1, beam_size])
+    best_eos = math_ops.reduce_max(eos_probs, [1])
+    best_rows = math_ops.to_int32(math_ops.argmax(eos_probs, 1)) + math_ops.range(0, batch_size) * beam_size
+    improved = math_ops.greater(best_eos, finished_probs)
+    finished_probs = math_ops.select(improved, best_eos, finished_probs)
+    finished_steps = math_ops.select(improved, array_ops.fill(array_ops.shape(best_rows), step), finished_steps)
+    finished_rows = math_ops.select(improved, best_rows, finished_rows)
+    return finished_probs, finished_steps, finished_rows
+
+
+def _trace_back(step_symbols, step_indices, rows, use_finished, finished_steps, finished_rows, histories):
+    """Follow the back-pointers of beam search from the last step to rebuild the chosen hypotheses.
+
+    Args:
+        step_symbols: A list of 1D Tensors, the symbol of every row chosen at each beam step.
+        step_indices: A list of 1D Tensors, the row of the previous step that every row extends.
+        rows: 1D int32 Tensor [batch_size], the rows of the live hypotheses to rebuild after the last step.
+        use_finished: 1D bool Tensor [batch_size], whether to rebuild the finished hypothesis instead.
+        finished_steps: 1D int32 Tensor [batch_size], see _update_finished.
+        finished_rows: 1D int32 Tensor [batch_size], see _update_finished.
+        histories: A list of lists of Tensors computed for the rows before each beam step, such as
+            the decoder outputs; a list shorter than step_symbols holds the last steps.
+
+    Returns:
+        A pair (symbols, histories): the symbols of the hypotheses, padded with EOS after a
+        finished one, and the histories gathered along them.
+    """
+    num_steps = len(step_symbols)
+    symbols = [None] * num_steps
+    histories = [list(history) for history in histories]
+    for k in reversed(xrange(num_steps)):
+        symbol = array_ops.gather(step_symbols[k], rows)
+        rows = array_ops.gather(step_indices[k], rows)
+        # a finished hypothesis ends with EOS at its step, and continues from the row it extended
+        ended = math_ops.logical_and(use_finished, math_ops.less_equal(finished_steps, k + 1))
+        symbols[k] = math_ops.select(ended, array_ops.fill(array_ops.shape(symbol), data_utils.EOS_ID), symbol)
+        rows = math_ops.select(math_ops.logical_and(use_finished, math_ops.equal(finished_steps, k + 1)),
+                               finished_rows, rows)
+        for history in histories:
+            j = k - (num_steps - len(history))
+            if j >= 0:
+                history[j] = array_ops.gather(history[j], rows)
+    return symbols, histories
+
+
+def _extract_argmax_and_embed(embedding, num_symbols, update_embedding=True, shortlist=None, beam_margin=None,
+                              beam_width=None):
     """Get a loop_function that extracts the previous symbol and embeds it.
 
     Args:
@@ -71,37 +149,97 @@ def _extract_argmax_and_embed(embedding, num_symbols, update_embedding=True):
       num_symbols: the size of target vocabulary
       update_embedding: Boolean; if False, the gradients will not propagate
         through the embeddings.
+      shortlist: if not None, a pair (ids, mask) of a 1D int32 Tensor of target word ids, which the
+        softmax and the beam search only consider, and a 2D float Tensor [batch_size x number of ids]
+        which is 1 for the ids each sentence may use.
+      beam_margin: if not None, a float or a scalar float Tensor; if positive, the hypotheses whose
+        score is more than beam_margin below the best one of their sentence are dropped from the beam.
+      beam_width: if not None, an int32 scalar Tensor; only the beam_width best hypotheses of each sentence
+        are kept alive, out of the beam_size rows built in the graph.
 
     Returns:
-      A loop function.
+      A loop function (prev, prev_probs, beam_size, done, force_eos) -> (emb_prev, probs, index,
+      prev_symbol, eos_probs), where done is a boolean scalar Tensor set when the result of the
+      search is known, force_eos an optional boolean Tensor of the rows which must end here, and
+      eos_probs the scores of the hypotheses of prev ending with EOS.
     """
-
-    def loop_function(prev, prev_probs, beam_size, _):
-        # beam search
-        prev = math_ops.matmul(prev, embedding, transpose_b=True)
-        prev = math_ops.log(nn_ops.softmax(prev))
-        prev = nn_ops.bias_add(array_ops.transpose(prev), prev_probs)  # num_symbols*BEAM_SIZE
-        prev = array_ops.transpose(prev)
-        prev = array_ops.expand_dims(array_ops.reshape(prev, [-1]), 0)  # 1*(BEAM_SIZE*num_symbols)
-        probs, prev_symbolb = nn_ops.top_k(prev, beam_size)
-        probs = array_ops.squeeze(probs, [0])  # BEAM_SIZE,
-        prev_symbolb = array_ops.squeeze(prev_symbolb, [0])  # BEAM_SIZE,
-        index = prev_symbolb // num_symbols
-        prev_symbol = prev_symbolb % num_symbols
+    output_embedding = embedding
+    num_candidates = num_symbols
+    eos_column = math_ops.to_float(math_ops.equal(math_ops.range(0, num_symbols), data_utils.EOS_ID))
+    shortlist_mask = None
+    if shortlist is not None:
+        shortlist, shortlist_mask = shortlist
+        output_embedding = embedding_ops.embedding_lookup(embedding, shortlist)
+        num_candidates = array_ops.shape(shortlist)[0]
+        eos_column = math_ops.to_float(math_ops.equal(shortlist, data_utils.EOS_ID))
+
+    def loop_function(prev, prev_probs, beam_size, done, force_eos=None):
+        # the dead hypotheses (pruned, outside the beam width or of a stopped sentence) are not scored
+        live = math_ops.greater(prev_probs, -1e29)
+        live_rows = _true_indices(live)
+
+        def log_probs():
+            logits = math_ops.matmul(array_ops.gather(prev, live_rows), output_embedding, transpose_b=True)
+            if shortlist_mask is None:
+                scores = math_ops.log(nn_ops.softmax(logits))
+            else:
+                # each sentence is decoded over its own shortlist, whatever the other sentences of the batch;
+                # the other words of the union get a finite score far below any word of the shortlist
+                outside = 1.0 - array_ops.gather(_tile_beam(shortlist_mask, beam_size), live_rows)
+                scores = math_ops.log(nn_ops.softmax(logits - 1e30 * outside) + outside) - 1e30 * outside
+            # the dead rows score 0, so they stay far behind every live hypothesis
+            return math_ops.unsorted_segment_sum(scores, live_rows, array_ops.shape(prev)[0])
+
+        # once the search is done, its result does not depend on the scores any more
+        prev = control_flow_ops.cond(done, lambda: array_ops.zeros(
+                array_ops.pack([array_ops.shape(prev)[0], num_candidates])), log_probs)
+        # the hypotheses ending here with EOS go to the finished pool, not to the live beam
+        eos_probs = prev_probs + math_ops.reduce_sum(prev * eos_column, [1])
+        prev -= 1e30 * eos_column
+        if force_eos is not None:
+            prev -= 1e30 * array_ops.expand_dims(math_ops.to_float(force_eos), 1)
+        # beam search: the rows of prev are the beam_size hypotheses of each sentence
+        prev = array_ops.expand_dims(prev_probs, 1) + prev  # (batch_size*BEAM_SIZE)*num_symbols
+        prev = array_ops.reshape(prev, array_ops.pack([-1, beam_size * num_candidates]))  # batch_size*(BEAM_SIZE*num_symbols)
+        # only the sentences with a live hypothesis are searched, the others get dead rows
+        live_sentences = math_ops.reduce_any(array_ops.reshape(live, [-1, beam_size]), [1])
+        searched = _true_indices(live_sentences)
+        stopped = _true_indices(math_ops.logical_not(live_sentences))
+        probs, prev_symbolb = nn_ops.top_k(array_ops.gather(prev, searched), beam_size)  # batch_size*BEAM_SIZE
+        stopped_shape = array_ops.pack([array_ops.size(stopped), beam_size])
+        probs = data_flow_ops.dynamic_stitch([searched, stopped], [probs, array_ops.fill(stopped_shape, -1e30)])
+        prev_symbolb = data_flow_ops.dynamic_stitch(
+                [searched, stopped], [prev_symbolb, array_ops.zeros(stopped_shape, dtype=dtypes.int32)])
+        if beam_margin is not None:
+            # threshold pruning: the hypotheses far behind the best one are dead, which narrows the beam
+            threshold = array_ops.slice(probs, [0, 0], [-1, 1]) - beam_margin
+            pruned = math_ops.logical_and(math_ops.less(probs, threshold), math_ops.greater(beam_margin, 0.0))
+            probs -= 1e30 * math_ops.to_float(pruned)
+        if beam_width is not None:
+            # a narrower beam: the hypotheses after the beam_width best ones of a sentence are dead
+            probs -= 1e30 * math_ops.to_float(math_ops.greater_equal(math_ops.range(0, beam_size), beam_width))
+        # the rows of the extended hypotheses
+        index = prev_symbolb // num_candidates + array_ops.expand_dims(
+                math_ops.range(0, array_ops.shape(prev)[0]) * beam_size, 1)
+        probs = array_ops.reshape(probs, [-1])  # batch_size*BEAM_SIZE,
+        index = array_ops.reshape(index, [-1])
+        prev_symbol = array_ops.reshape(prev_symbolb % num_candidates, [-1])
+        if shortlist is not None:
+            prev_symbol = array_ops.gather(shortlist, prev_symbol)  # back to vocabulary ids
 
         # Note that gradients will not propagate through the second parameter of
         # embedding_lookup.
         emb_prev = embedding_ops.embedding_lookup(embedding, prev_symbol)
         if not update_embedding:
             emb_prev = array_ops.stop_gradient(emb_prev)
-        return emb_prev, probs, index, prev_symbol
+        return emb_prev, probs, index, prev_symbol, eos_probs
 
     return loop_function
 
 
 def attention_decoder(encoder_mask, decoder_inputs, initial_state, attention_states, cell,
                       beam_size, output_size=None, num_heads=1, num_layers=1, loop_function=None,
-                      dtype=dtypes.float32, scope=None, initial_state_attention=False):
+                      dtype=dtypes.float32, scope=None, initial_state_attention=False, max_length_ratio=0.0):
     """RNN decoder with attention for the sequence-to-sequence model.
 
     In this context "attention" means that, during decoding, the RNN can look up
@@ -127,14 +265,18 @@ def attention_decoder(encoder_mask, decoder_inputs, initial_state, attention_sta
             If True, initialize the attentions from the initial state and attention
             states -- useful when we wish to resume decoding from a previously
             stored decoder state and attention states.
+        max_length_ratio: If positive, beam search ends every hypothesis with EOS
+            once it is max_length_ratio times as long as its source sentence.
 
     Returns:
-        A tuple of the form (outputs, state, symbols), where:
+        A tuple of the form (outputs, state, symbols, attention_keys), where:
             outputs: A list of the same length as decoder_inputs of 2D Tensors of
                   shape [batch_size x output_size].
             state: The state of each decoder cell the final time-step.
                 It is a 2D Tensor of shape [batch_size x cell.state_size].
-            symbols: A list of target word ids, the best results returned by beam search
+            symbols: A list of batch-sized Tensors, the best target word ids found by beam search
+            attention_keys: The projected attention_states of each head, 4D Tensors
+                [batch_size x attn_length x 1 x attention_vec_size]; feeding them skips the projection.
 
     Raises:
         ValueError: when num_heads is not positive, there are no inputs, shapes
@@ -174,6 +316,21 @@ def attention_decoder(encoder_mask, decoder_inputs, initial_state, attention_sta
                 hidden_features.append(nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME"))
                 v.append(variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size],
                                                      initializer=init_ops.constant_initializer(0.0)))
+        attention_keys = hidden_features
+
+        # Beam search keeps the beam_size hypotheses of each sentence in consecutive rows.
+        beam_rows = 1
+        prev_probs = [0]
+        if loop_function is not None:
+            beam_rows = beam_size
+            hidden = _tile_beam(hidden, beam_size)
+            hidden_features = [_tile_beam(h, beam_size) for h in hidden_features]
+            encoder_mask = _tile_beam(encoder_mask, beam_size)
+            initial_state = _tile_beam(initial_state, beam_size)
+            decoder_inputs = [_tile_beam(decoder_inputs[0], beam_size)] + decoder_inputs[1:]
+            # only the first hypothesis of each sentence is alive before the first step
+            prev_probs = array_ops.reshape(array_ops.tile(
+                    array_ops.constant([[0.0] + [-1e30] * (beam_size - 1)]), array_ops.pack([batch_size, 1])), [-1])
 
         def attention(query, scope=None):
             """Put attention masks on hidden using hidden_features and query."""
@@ -205,53 +362,85 @@ def attention_decoder(encoder_mask, decoder_inputs, initial_state, attention_sta
                         ds.append(array_ops.reshape(d, [-1, attn_size]))
             return ds
 
+        def decoder_step(inp, out_state, state, attns, i):
+            """Run the attention, the RNN and the output projection of one decoding step."""
+            # Run the attention mechanism.
+            if i > 0 or (i == 0 and initial_state_attention):
+                attns = attention(out_state, scope="attention")
+
+            # Run the RNN.
+            cinp = array_ops.concat(1, [inp, attns[0]])
+            # state, _ = cell(cinp, state)
+            out_state, state = cell(cinp, state)
+
+            with variable_scope.variable_scope("AttnOutputProjection"):
+                output = linear([out_state] + [cinp], output_size, False)
+                output = array_ops.reshape(output, [-1, output_size // 2, 2])
+                output = math_ops.reduce_max(output, 2)  # maxout
+            return [out_state, state] + attns + [output]
+
         outputs = []
         output = None
         state = initial_state
         out_state = array_ops.split(1, num_layers, state)[-1]
         prev = None
         symbols = []
-        prev_probs = [0]
-        batch_attn_size = array_ops.pack([batch_size, attn_size])
+        batch_attn_size = array_ops.pack([batch_size * beam_rows, attn_size])
         attns = [array_ops.zeros(batch_attn_size, dtype=dtype)
                  for _ in xrange(num_heads)]
         for a in attns:  # Ensure the second shape of attention vectors is set.
             a.set_shape([None, attn_size])
 
+        if loop_function is not None:
+            # The best hypothesis ending with EOS of each sentence, and whether no live hypothesis can beat them.
+            finished_probs = array_ops.fill(array_ops.pack([batch_size]), -1e30)
+            finished_steps = array_ops.zeros(array_ops.pack([batch_size]), dtype=dtypes.int32)
+            finished_rows = array_ops.zeros(array_ops.pack([batch_size]), dtype=dtypes.int32)
+            done = array_ops.constant(False)
+            # the back-pointers of beam search: the rebuilt hypotheses are gathered once at the end
+            step_symbols = []
+            step_indices = []
+            max_lengths = None
+            if max_length_ratio > 0:
+                max_lengths = math_ops.to_int32(math_ops.ceil(
+                        max_length_ratio * math_ops.to_float(math_ops.reduce_sum(encoder_mask, [1]))))
+
         for i, inp in enumerate(decoder_inputs):
             if i > 0:
                 variable_scope.get_variable_scope().reuse_variables()
             # If loop_function is set, we use it instead of decoder_inputs.
             if loop_function is not None and prev is not None:
                 with variable_scope.variable_scope("loop_function", reuse=True):
-                    inp, prev_probs, index, prev_symbol = loop_function(prev, prev_probs, beam_size, i)
+                    # the hypotheses reaching the maximum length must end with this symbol
+                    force_eos = None if max_lengths is None else math_ops.less_equal(max_lengths, i - 1)
+                    inp, prev_probs, index, prev_symbol, eos_probs = loop_function(
+                            prev, prev_probs, beam_size, done, force_eos)
+                    finished_probs, finished_steps, finished_rows = _update_finished(
+                            finished_probs, finished_steps, finished_rows, eos_probs, i, batch_size, beam_size)
+                    # a sentence whose live hypotheses all fall behind its finished one is over: its rows die
+                    stopped = math_ops.less(
+                            math_ops.reduce_max(array_ops.reshape(prev_probs, [-1, beam_size]), [1]), finished_probs)
+                    done = math_ops.reduce_all(stopped)
+                    prev_probs -= 1e30 * _tile_beam(math_ops.to_float(stopped), beam_size)
                     out_state = array_ops.gather(out_state, index)  # update prev state
                     state = array_ops.gather(state, index)  # update prev state
                     attns = [array_ops.gather(attn, index) for attn in attns]  # update prev attens
-                    for j, output in enumerate(outputs):
-                        outputs[j] = array_ops.gather(output, index)  # update prev outputs
-                    for j, symbol in enumerate(symbols):
-                        symbols[j] = array_ops.gather(symbol, index)  # update prev symbols
-                    symbols.append(prev_symbol)
+                    step_symbols.append(prev_symbol)
+                    step_indices.append(index)
 
             # Merge input and previous attentions into one vector of the right size.
             input_size = inp.get_shape().with_rank(2)[1]
             if input_size.value is None:
                 raise ValueError("Could not infer input size from input: %s" % inp.name)
 
-            # Run the attention mechanism.
-            if i > 0 or (i == 0 and initial_state_attention):
-                attns = attention(out_state, scope="attention")
-
-            # Run the RNN.
-            cinp = array_ops.concat(1, [inp, attns[0]])
-            # state, _ = cell(cinp, state)
-            out_state, state = cell(cinp, state)
-
-            with variable_scope.variable_scope("AttnOutputProjection"):
-                output = linear([out_state] + [cinp], output_size, False)
-                output = array_ops.reshape(output, [-1, output_size // 2, 2])
-                output = math_ops.reduce_max(output, 2)  # maxout
+            if loop_function is not None and prev is not None:
+                # Skip the step once the search is done.
+                step_outputs = control_flow_ops.cond(
+                        done, lambda: [out_state, state] + attns + [prev],
+                        lambda: decoder_step(inp, out_state, state, attns, i))
+            else:
+                step_outputs = decoder_step(inp, out_state, state, attns, i)
+            out_state, state, attns, output = step_outputs[0], step_outputs[1], step_outputs[2:-1], step_outputs[-1]
 
             if loop_function is not None:
                 prev = output
@@ -259,32 +448,32 @@ def attention_decoder(encoder_mask, decoder_inputs, initial_state, attention_sta
 
         if loop_function is not None:
             # process the last symbol
-            inp, prev_probs, index, prev_symbol = loop_function(prev, prev_probs, beam_size, i + 1)
-            out_state = array_ops.gather(out_state, index)  # update prev state
-            state = array_ops.gather(state, index)  # update prev state
-            for j, output in enumerate(outputs):
-                outputs[j] = array_ops.gather(output, index)  # update prev outputs
-            for j, symbol in enumerate(symbols):
-                symbols[j] = array_ops.gather(symbol, index)  # update prev symbols
-            symbols.append(prev_symbol)
-
-            # output the final best result of beam search
-            for k, symbol in enumerate(symbols):
-                symbols[k] = array_ops.gather(symbol, 0)
-            out_state = array_ops.expand_dims(array_ops.gather(out_state, 0), 0)
-            state = array_ops.expand_dims(array_ops.gather(state, 0), 0)
-            state = array_ops.expand_dims(array_ops.gather(state, 0), 0)
-            for j, output in enumerate(outputs):
-                outputs[j] = array_ops.expand_dims(array_ops.gather(output, 0), 0)  # update prev outputs
-    return outputs, state, symbols
+            force_eos = None if max_lengths is None else math_ops.less_equal(max_lengths, i)
+            inp, prev_probs, index, prev_symbol, eos_probs = loop_function(
+                    prev, prev_probs, beam_size, done, force_eos)
+            finished_probs, finished_steps, finished_rows = _update_finished(
+                    finished_probs, finished_steps, finished_rows, eos_probs, i + 1, batch_size, beam_size)
+            step_symbols.append(prev_symbol)
+            step_indices.append(index)
+
+            # output the final best result of beam search: the best finished hypothesis of each sentence,
+            # unless its first live hypothesis, which did not end, is better
+            best = math_ops.range(0, batch_size) * beam_size
+            use_finished = math_ops.greater_equal(finished_probs, array_ops.gather(prev_probs, best))
+            symbols, (outputs,) = _trace_back(step_symbols, step_indices, best, use_finished,
+                                              finished_steps, finished_rows, [outputs])
+            out_state = array_ops.gather(out_state, array_ops.gather(index, best))
+            state = array_ops.gather(state, array_ops.gather(index, best))
+    return outputs, state, symbols, attention_keys
 
 
 def embedding_attention_decoder(encoder_mask, decoder_inputs, initial_state, attention_states,
                                 cell, num_symbols, embedding_size, beam_size, num_heads=1,
                                 output_size=None, num_layers=1, feed_previous=False,
-                                update_embedding_for_previous=True,
+                                update_embedding_for_previous=True, shortlist=None,
                                 dtype=dtypes.float32, scope=None,
-                                initial_state_attention=False):
+                                initial_state_attention=False, max_length_ratio=0.0, beam_margin=None,
+                                beam_width=None):
     """RNN decoder with embedding and attention.
 
     Args:
@@ -301,20 +490,30 @@ def embedding_attention_decoder(encoder_mask, decoder_inputs, initial_state, att
         feed_previous: Boolean, if True, only the first of decoder_inputs will be
             used (the "GO" symbol), and all other decoder inputs will be generated by:
             next = embedding_lookup(embedding, argmax(previous_output)).
+        shortlist: if not None, the pair (ids, mask) of the target word ids considered when feed_previous
+            is set, see _extract_argmax_and_embed.
         dtype: The dtype to use for the RNN initial states (default: tf.float32).
         scope: VariableScope for the created subgraph; defaults to "embedding_attention_decoder".
         initial_state_attention: If False (default), initial attentions are zero.
             If True, initialize the attentions from the initial state and attention
             states -- useful when we wish to resume decoding from a previously
             stored decoder state and attention states.
+        max_length_ratio: If positive, the maximum length of a translation relative
+            to its source sentence when feed_previous is set.
+        beam_margin: If not None, a float or a scalar float Tensor; if positive, beam search drops
+            the hypotheses whose score is more than beam_margin below the best one of their sentence.
+        beam_width: If not None, an int32 scalar Tensor, the number of hypotheses of each sentence
+            beam search keeps alive, at most beam_size.
 
     Returns:
-        A tuple of the form (outputs, state, symbols), where:
+        A tuple of the form (outputs, state, symbols, attention_keys), where:
             outputs: A list of the same length as decoder_inputs of 2D Tensors of
                   shape [batch_size x output_size].
             state: The state of each decoder cell the final time-step.
                 It is a 2D Tensor of shape [batch_size x cell.state_size].
-            symbols: A list of target word ids, the best results returned by beam search
+            symbols: A list of batch-sized Tensors, the best target word ids found by beam search
+            attention_keys: The projected attention_states of each head, 4D Tensors
+                [batch_size x attn_length x 1 x attention_vec_size]; feeding them skips the projection.
 
     Raises:
         ValueError: When output_projection has the wrong shape.
@@ -327,18 +526,76 @@ def embedding_attention_decoder(encoder_mask, decoder_inputs, initial_state, att
                                                 initializer=init_ops.random_normal_initializer(0, 0.01, seed=SEED))
 
         loop_function = _extract_argmax_and_embed(embedding, num_symbols,
-                update_embedding_for_previous) if feed_previous else None
+                update_embedding_for_previous, shortlist, beam_margin, beam_width) if feed_previous else None
         emb_inp = [embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs]
         return attention_decoder(encoder_mask, emb_inp, initial_state, attention_states, cell,
                                  beam_size, output_size=output_size,
                                  num_layers=num_layers, num_heads=num_heads, loop_function=loop_function,
-                                 initial_state_attention=initial_state_attention), tf.identity(embedding)
+                                 initial_state_attention=initial_state_attention,
+                                 max_length_ratio=max_length_ratio), tf.identity(embedding)
+
+
+def _projected_gru_cell(cell):
+    """Returns (num_units, input_keep_prob, seed) if cell is one GRUCell, maybe with input dropout, else None."""
+    input_keep_prob, seed = 1.0, None
+    if isinstance(cell, rnn_cell.DropoutWrapper):
+        if not isinstance(cell._output_keep_prob, float) or cell._output_keep_prob < 1:
+            return None
+        input_keep_prob, seed = cell._input_keep_prob, cell._seed
+        cell = cell._cell
+    if type(cell) is not rnn_cell.GRUCell:
+        return None
+    return cell.output_size, input_keep_prob, seed
+
+
+def bidirectional_gru_encoder(encoder_inputs, embedding, num_units, sequence_length, dtype,
+                              input_keep_prob=1.0, seed=None):
+    """The bidirectional GRU encoder with the input projections out of the recurrence.
+
+    This builds the same variables as rnn.bidirectional_rnn over an EmbeddingWrapper
+    around a GRUCell, but embeds the inputs of all time steps at once and multiplies
+    them by the input half of the GRU weights in one matmul per direction, so only
+    the recurrent matmuls are left in the unrolled loop.
+
+    Args:
+        encoder_inputs: A list of 1D int32 Tensors of shape [batch_size].
+        embedding: The source embedding, of shape [num_encoder_symbols x embedding_size].
+        num_units: The size of the GRU state.
+        sequence_length: A 1D Tensor of the lengths of the input sentences.
+        dtype: The dtype of the initial RNN state.
+        input_keep_prob: The keep probability of the dropout on the embedded inputs.
+        seed: The seed of the dropout.
+
+    Returns:
+        A tuple (outputs, output_state_fw, output_state_bw), as rnn.bidirectional_rnn.
+    """
+    num_steps = len(encoder_inputs)
+    with ops.device("/cpu:0"):
+        embedded = embedding_ops.embedding_lookup(embedding, array_ops.concat(0, encoder_inputs))
+    outputs = {}
+    states = {}
+    for direction in ("FW", "BW"):
+        with variable_scope.variable_scope("BiRNN_" + direction) as rnn_scope:
+            inputs = embedded
+            if not isinstance(input_keep_prob, float) or input_keep_prob < 1:
+                inputs = nn_ops.dropout(inputs, input_keep_prob, seed=seed)
+            cell = rnn_cell.ProjectedGRUCell(num_units)
+            with variable_scope.variable_scope("EmbeddingWrapper"):
+                inputs = array_ops.split(0, num_steps, cell.project_inputs(inputs))
+            if direction == "BW":
+                inputs = rnn._reverse_seq(inputs, sequence_length)
+            outputs[direction], states[direction] = rnn.rnn(cell, inputs, dtype=dtype,
+                                                            sequence_length=sequence_length, scope=rnn_scope)
+    output_bw = rnn._reverse_seq(outputs["BW"], sequence_length)
+    outputs = [array_ops.concat(1, [fw, bw]) for fw, bw in zip(outputs["FW"], output_bw)]
+    return outputs, states["FW"], states["BW"]
 
 
 def embedding_attention_seq2seq(encoder_inputs, encoder_mask, decoder_inputs, cell,
                                 num_encoder_symbols, num_decoder_symbols, embedding_size,
-                                beam_size, num_layers=1, num_heads=1, feed_previous=False, dtype=dtypes.float32,
-                                scope=None, initial_state_attention=True):
+                                beam_size, num_layers=1, num_heads=1, feed_previous=False, shortlist=None,
+                                dtype=dtypes.float32, scope=None, initial_state_attention=True,
+                                max_length_ratio=0.0, beam_margin=None, beam_width=None):
     """Embedding sequence-to-sequence model with attention.
 
     Args:
@@ -352,33 +609,52 @@ def embedding_attention_seq2seq(encoder_inputs, encoder_mask, decoder_inputs, ce
         beam_size: Integer, the beam size used in beam search.
         num_heads: Number of attention heads that read from attention_states.
         feed_previous: Boolean, if True, only the first of decoder_inputs will be used (the "GO" symbol).
+        shortlist: if not None, the pair (ids, mask) of the target word ids considered when feed_previous
+            is set, see _extract_argmax_and_embed.
         dtype: The dtype of the initial RNN state (default: tf.float32).
         scope: VariableScope for the created subgraph; defaults to "embedding_attention_seq2seq".
         initial_state_attention: If False (default), initial attentions are zero.
             If True, initialize the attentions from the initial state and attention
             states.
+        max_length_ratio: If positive, the maximum length of a translation relative to its source sentence.
+        beam_margin: If not None, the score margin below the best hypothesis of beam search pruning;
+            a scalar Tensor lets it change from run to run.
+        beam_width: If not None, an int32 scalar Tensor, the number of live hypotheses of each sentence
+            in beam search, from 1 to beam_size; it can change from run to run.
 
     Returns:
-        A tuple of the form (outputs, state, symbols), where:
+        A tuple of the form ((outputs, state, symbols), embedding, (attention_states, encoder_state, attention_keys)),
+        where:
             outputs: A list of the same length as decoder_inputs of 2D Tensors of
                   shape [batch_size x output_size].
             state: The state of each decoder cell the final time-step.
                 It is a 2D Tensor of shape [batch_size x cell.state_size].
-            symbols: A list of target word ids, the best results returned by beam search
+            symbols: A list of batch-sized Tensors, the best target word ids found by beam search
+            embedding: The target word embedding, used as the output projection.
+            attention_states: The 3D Tensor of encoder outputs the decoder attends to.
+            encoder_state: The final state of the encoder.
+            attention_keys: The list of the projected attention_states of each attention head.
     """
     with variable_scope.variable_scope(scope or "embedding_attention_seq2seq"):
         embedding = variable_scope.get_variable(
                 "embedding", [num_encoder_symbols, embedding_size], dtype=dtype,
                 initializer=init_ops.random_normal_initializer(0, 0.01, seed=SEED))
-        encoder_cell = rnn_cell.EmbeddingWrapper(cell, embedding_classes=num_encoder_symbols,
-                embedding_size=embedding_size, embedding=embedding)
-
         encoder_lens = math_ops.reduce_sum(encoder_mask, [1])
 
-        encoder_outputs, _, encoder_state = rnn.bidirectional_rnn(
-                encoder_cell, encoder_cell, encoder_inputs, sequence_length=encoder_lens, dtype=dtype)
+        projected_gru = _projected_gru_cell(cell)
+        if projected_gru:
+            num_units, input_keep_prob, seed = projected_gru
+            encoder_outputs, _, encoder_state = bidirectional_gru_encoder(
+                    encoder_inputs, embedding, num_units, encoder_lens, dtype,
+                    input_keep_prob=input_keep_prob, seed=seed)
+        else:
+            encoder_cell = rnn_cell.EmbeddingWrapper(cell, embedding_classes=num_encoder_symbols,
+                    embedding_size=embedding_size, embedding=embedding)
+
+            encoder_outputs, _, encoder_state = rnn.bidirectional_rnn(
+                    encoder_cell, encoder_cell, encoder_inputs, sequence_length=encoder_lens, dtype=dtype)
 
-        assert encoder_cell._embedding is embedding
+            assert encoder_cell._embedding is embedding
 
         # First calculate a concatenation of encoder outputs to put attention on.
         top_states = [array_ops.reshape(e, [-1, 1, 2 * cell.output_size]) for e in encoder_outputs]
@@ -387,11 +663,17 @@ def embedding_attention_seq2seq(encoder_inputs, encoder_mask, decoder_inputs, ce
         # Decoder.
         output_size = None
 
-        return embedding_attention_decoder(encoder_mask, decoder_inputs, encoder_state, attention_states, cell,
+        decoder_outputs, target_embedding = embedding_attention_decoder(encoder_mask, decoder_inputs, encoder_state, attention_states, cell,
                                            num_decoder_symbols, embedding_size, beam_size=beam_size,
                                            num_heads=num_heads, output_size=output_size, num_layers=num_layers,
-                                           feed_previous=feed_previous,
-                                           initial_state_attention=initial_state_attention)
+                                           feed_previous=feed_previous, shortlist=shortlist,
+                                           initial_state_attention=initial_state_attention,
+                                           max_length_ratio=max_length_ratio, beam_margin=beam_margin,
+                                           beam_width=beam_width)
+        outputs, state, symbols, attention_keys = decoder_outputs
+        # The encoder outputs of the bucket, which Seq2SeqModel.search feeds to skip the encoder
+        # and the projection of the attention keys.
+        return (outputs, state, symbols), target_embedding, (attention_states, encoder_state, attention_keys)
 
 
 def sequence_loss_by_example(logits, targets, weights, softmax_loss_function, output_projection,
@@ -419,11 +701,12 @@ def sequence_loss_by_example(logits, targets, weights, softmax_loss_function, ou
                          "%d, %d, %d." % (len(logits), len(weights), len(targets)))
     with ops.op_scope(logits + targets + weights, name,
                       "sequence_loss_by_example"):
-        log_perp_list = []
-        for logit, target, weight in zip(logits, targets, weights):
-            crossent = softmax_loss_function(logit, target, output_projection)
-            log_perp_list.append(crossent * weight)
-        log_perps = math_ops.add_n(log_perp_list)
+        # Project and score all time steps at once: one [steps * batch_size] batch
+        # instead of one matmul and one softmax per step.
+        crossent = softmax_loss_function(array_ops.concat(0, logits), array_ops.concat(0, targets),
+                                         output_projection)
+        crossent = array_ops.reshape(crossent * array_ops.concat(0, weights), [len(logits), -1])
+        log_perps = math_ops.reduce_sum(crossent, 0)
         if average_across_timesteps:
             total_size = math_ops.add_n(weights)
             total_size += 1e-12  # Just to avoid division by 0 for all-0 weights.
@@ -465,7 +748,7 @@ def sequence_loss(logits, targets, weights, softmax_loss_function, output_projec
 
 def model_with_buckets(encoder_inputs, encoder_mask, decoder_inputs, targets, weights,
                        buckets, seq2seq, softmax_loss_function=None,
-                       per_example_loss=False, name=None):
+                       per_example_loss=False, name=None, bucket_ids=None, reuse=None):
     """Create a sequence-to-sequence model with support for bucketing.
 
     The seq2seq argument is a function that defines a sequence-to-sequence model,
@@ -485,14 +768,18 @@ def model_with_buckets(encoder_inputs, encoder_mask, decoder_inputs, targets, we
             tensor of losses for each sequence in the batch. If unset, it will be
             a scalar with the averaged loss from all examples.
         name: Optional name for this operation, defaults to "model_with_buckets".
+        bucket_ids: The ids of the buckets to build, all of them if None; the outputs, losses,
+            symbols and encoder outputs of the other buckets are None.
+        reuse: If True, reuse the variables of buckets built before, e.g. by an earlier call.
 
     Returns:
-        A tuple of the form (outputs, losses, symbols), where:
+        A tuple of the form (outputs, losses, symbols, encoder_outputs), where:
             outputs: The outputs for each bucket. Its j'th element consists of a list
                 of 2D Tensors of shape [batch_size x num_decoder_symbols] (jth outputs).
             losses: List of scalar Tensors, representing losses for each bucket, or,
                 if per_example_loss is set, a list of 1D batch-sized float Tensors.
             symbols: List of target word ids, the best results returned by beam search.
+            encoder_outputs: List of the (attention_states, encoder_state, attention_keys) of each bucket.
 
     Raises:
         ValueError: If length of encoder_inputsut, targets, or weights is smaller
@@ -512,14 +799,24 @@ def model_with_buckets(encoder_inputs, encoder_mask, decoder_inputs, targets, we
     losses = []
     outputs = []
     symbols = []  # to save the output of beam search
+    encoder_outputs = []
+    built = False
     with ops.op_scope(all_inputs, name, "model_with_buckets"):
         for j, bucket in enumerate(buckets):
+            if bucket_ids is not None and j not in bucket_ids:
+                outputs.append(None)
+                losses.append(None)
+                symbols.append(None)
+                encoder_outputs.append(None)
+                continue
             with variable_scope.variable_scope(variable_scope.get_variable_scope(),
-                                               reuse=True if j > 0 else None):
-                (bucket_outputs, _, bucket_symbols), output_proj = seq2seq(encoder_inputs[:bucket[0]], encoder_mask,
-                                                            decoder_inputs[:bucket[1]])
+                                               reuse=True if reuse or built else None):
+                built = True
+                (bucket_outputs, _, bucket_symbols), output_proj, bucket_encoder_outputs = seq2seq(
+                        encoder_inputs[:bucket[0]], encoder_mask, decoder_inputs[:bucket[1]])
                 outputs.append(bucket_outputs)
                 symbols.append(bucket_symbols)
+                encoder_outputs.append(bucket_encoder_outputs)
                 # use the target word embedding matrix as the outprojection matrix
                 if per_example_loss:
                     losses.append(sequence_loss_by_example(outputs[-1], targets[:bucket[1]], weights[:bucket[1]],
@@ -528,4 +825,4 @@ def model_with_buckets(encoder_inputs, encoder_mask, decoder_inputs, targets, we
                     losses.append(sequence_loss(outputs[-1], targets[:bucket[1]], weights[:bucket[1]],
                             softmax_loss_function=softmax_loss_function, output_projection=output_proj))
 
-    return outputs, losses, symbols
+    return outputs, losses, symbols, encoder_outputs
@@ -33,6 +33,7 @@ from __future__ import division
 from __future__ import print_function
 
 import random
+import time
 import numpy as np
 from six.moves import xrange
 import tensorflow as tf
@@ -45,6 +46,7 @@ sys.path.append(".")
 import rnn_cell
 import data_utils
 import seq2seq_fy
+import translation_cache
 
 SEED = 123
 
@@ -61,7 +63,9 @@ class Seq2SeqModel(object):
                  hidden_edim, hidden_units, num_layers, keep_prob,
                  max_gradient_norm, batch_size, learning_rate,
                  learning_rate_decay_factor, beam_size,
-                 use_lstm=False, forward_only=False):
+                 use_lstm=False, forward_only=False, use_shortlist=False, num_samples=0,
+                 lazy_buckets=False, max_length_ratio=0.0,
+                 beam_margin=0.0, encoder_cache_size=0):
         """Create the model.
 
         Args:
@@ -81,9 +85,19 @@ class Seq2SeqModel(object):
                 changed after initialization if this is convenient, e.g., for decoding.
             learning_rate: learning rate to start with.
             learning_rate_decay_factor: decay learning rate by this much when needed.
-            beam_size: the beam size used in beam search
+            beam_size: the beam size used in beam search; search can use a narrower beam.
             use_lstm: if true, we use LSTM cells instead of GRU cells.
             forward_only: if set, we do not construct the backward pass in the model.
+            use_shortlist: if set, beam search only considers the target words fed to step as shortlist.
+            num_samples: if positive, training uses a sampled softmax loss with this many sampled
+                target words; the losses used for evaluation keep the full softmax.
+            lazy_buckets: if set with forward_only, only the first bucket is built here, and each
+                other bucket the first time step is called on it.
+            max_length_ratio: if positive, beam search ends a translation with EOS once it is
+                max_length_ratio times as long as its source sentence.
+            beam_margin: if positive, beam search drops the hypotheses whose log probability is
+                more than beam_margin below the best one of their sentence; search can change it.
+            encoder_cache_size: the number of sentences whose encoder states encode keeps for reuse.
         """
         self.source_vocab_size = source_vocab_size
         self.target_vocab_size = target_vocab_size
@@ -93,6 +107,9 @@ class Seq2SeqModel(object):
         self.learning_rate_decay_op = self.learning_rate.assign(
                 self.learning_rate * learning_rate_decay_factor)
         self.global_step = tf.Variable(0, trainable=False)
+        self.beam_size = beam_size
+        self.default_beam_margin = beam_margin
+        self.encoder_cache = translation_cache.LRUCache(encoder_cache_size)
 
         def loss_function(logit, target, output_projection):
             logit = math_ops.matmul(logit, output_projection, transpose_b=True)
@@ -103,6 +120,12 @@ class Seq2SeqModel(object):
 
         softmax_loss_function = loss_function
 
+        # Sampled softmax over the tied output projection (the target embedding), without bias.
+        def sampled_loss_function(logit, target, output_projection):
+            labels = array_ops.reshape(math_ops.to_int64(target), [-1, 1])
+            return tf.nn.sampled_softmax_loss(output_projection, array_ops.zeros([target_vocab_size]),
+                                              logit, labels, num_samples, target_vocab_size)
+
         # Create the internal multi-layer cell for our RNN.
         single_cell = rnn_cell.GRUCell(hidden_units)
         if use_lstm:
@@ -122,7 +145,11 @@ class Seq2SeqModel(object):
                     embedding_size=hidden_edim,
                     beam_size=beam_size,
                     num_layers=num_layers,
-                    feed_previous=do_decode)
+                    feed_previous=do_decode,
+                    shortlist=None if self.shortlist is None else (self.shortlist, self.shortlist_mask),
+                    max_length_ratio=max_length_ratio,
+                    beam_margin=self.beam_margin,
+                    beam_width=self.beam_width)
 
         # Feeds for inputs.
         self.encoder_inputs = []
@@ -135,22 +162,57 @@ class Seq2SeqModel(object):
             self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None], name="decoder{0}".format(i)))
             self.target_weights.append(tf.placeholder(tf.float32, shape=[None], name="weight{0}".format(i)))
         self.encoder_mask = tf.placeholder(tf.int32, shape=[None, None], name="encoder_mask")
+        self.shortlist = None
+        self.shortlist_mask = None
+        if use_shortlist:
+            self.shortlist = tf.placeholder(tf.int32, shape=[None], name="shortlist")
+            self.shortlist_mask = tf.placeholder(tf.float32, shape=[None, None], name="shortlist_mask")
+        self.beam_margin = tf.placeholder(tf.float32, shape=[], name="beam_margin")
+        self.beam_width = tf.placeholder(tf.int32, shape=[], name="beam_width")
 
         # Our targets are decoder inputs shifted by one.
         targets = [self.decoder_inputs[i + 1] for i in xrange(len(self.decoder_inputs) - 1)]
 
         # Training outputs and losses.
+        # The encoder outputs of each bucket, fed by search to skip the encoder.
+        self.encoder_attention_states = [None] * len(buckets)
+        self.encoder_state = [None] * len(buckets)
+        self.encoder_attention_keys = [None] * len(buckets)
         if forward_only:
-            self.outputs, self.losses, self.symbols = seq2seq_fy.model_with_buckets(
-                    self.encoder_inputs, self.encoder_mask, self.decoder_inputs, targets,
-                    self.target_weights, buckets, lambda x, y, z: seq2seq_f(x, y, z, True),
-                    softmax_loss_function=softmax_loss_function)
+            def build_buckets(bucket_ids=None, reuse=None):
+                return seq2seq_fy.model_with_buckets(
+                        self.encoder_inputs, self.encoder_mask, self.decoder_inputs, targets,
+                        self.target_weights, buckets, lambda x, y, z: seq2seq_f(x, y, z, True),
+                        softmax_loss_function=softmax_loss_function, bucket_ids=bucket_ids, reuse=reuse)
+
+            self._build_buckets = None
+            if lazy_buckets:
+                # The first bucket creates all the variables; the others reuse them when built.
+                self.outputs, self.losses, self.symbols, encoder_outputs = build_buckets([0])
+                self._keep_encoder_outputs(encoder_outputs)
+                self._build_buckets = build_buckets
+                self._graph = tf.get_default_graph()
+                self._variable_scope = tf.get_variable_scope()
+            else:
+                self.outputs, self.losses, self.symbols, encoder_outputs = build_buckets()
+                self._keep_encoder_outputs(encoder_outputs)
         else:
-            self.outputs, self.losses, self.symbols = seq2seq_fy.model_with_buckets(
+            self.outputs, self.losses, self.symbols, _ = seq2seq_fy.model_with_buckets(
                     self.encoder_inputs, self.encoder_mask, self.decoder_inputs, targets,
                     self.target_weights, buckets, lambda x, y, z: seq2seq_f(x, y, z, False),
                     softmax_loss_function=softmax_loss_function)
 
+        # The losses to optimize; the full softmax losses stay in self.losses for evaluation.
+        self.train_losses = self.losses
+        if num_samples > 0 and not forward_only:
+            with tf.variable_scope("embedding_attention_seq2seq/embedding_attention_decoder", reuse=True):
+                output_projection = tf.get_variable("embedding")
+            self.train_losses = [seq2seq_fy.sequence_loss(self.outputs[b], targets[:bucket[1]],
+                                                          self.target_weights[:bucket[1]],
+                                                          softmax_loss_function=sampled_loss_function,
+                                                          output_projection=output_projection)
+                                 for b, bucket in enumerate(buckets)]
+
         # backward
         params_to_update = tf.trainable_variables()
         if not forward_only:
@@ -159,7 +221,7 @@ class Seq2SeqModel(object):
             self.updates = []
             opt = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
             for b in xrange(len(buckets)):
-                gradients = tf.gradients(self.losses[b], params_to_update,
+                gradients = tf.gradients(self.train_losses[b], params_to_update,
                                          aggregation_method=tf.AggregationMethod.EXPERIMENTAL_ACCUMULATE_N)
                 clipped_gradients, norm = tf.clip_by_global_norm(gradients, max_gradient_norm)
                 self.gradient_norms.append(norm)
@@ -168,8 +230,29 @@ class Seq2SeqModel(object):
 
         self.saver = tf.train.Saver(tf.all_variables(), max_to_keep=1000, keep_checkpoint_every_n_hours=6)
 
+    def build_bucket(self, bucket_id):
+        """Build the subgraph of a bucket if the model was created with lazy_buckets and it is not built yet."""
+        if self.outputs[bucket_id] is not None:
+            return
+        start_time = time.time()
+        with self._graph.as_default(), tf.variable_scope(self._variable_scope):
+            outputs, losses, symbols, encoder_outputs = self._build_buckets([bucket_id], reuse=True)
+        self._keep_encoder_outputs(encoder_outputs)
+        self.losses[bucket_id] = losses[bucket_id]
+        self.symbols[bucket_id] = symbols[bucket_id]
+        self.outputs[bucket_id] = outputs[bucket_id]
+        sys.stderr.write("Built bucket %d in %.1fs\n" % (bucket_id, time.time() - start_time))
+        sys.stderr.flush()
+
+    def _keep_encoder_outputs(self, encoder_outputs):
+        """Keep the encoder outputs returned by model_with_buckets for the built buckets."""
+        for bucket_id, bucket_encoder_outputs in enumerate(encoder_outputs):
+            if bucket_encoder_outputs is not None:
+                (self.encoder_attention_states[bucket_id], self.encoder_state[bucket_id],
+                 self.encoder_attention_keys[bucket_id]) = bucket_encoder_outputs
+
     def step(self, session, encoder_inputs, encoder_mask, decoder_inputs, target_weights,
-             bucket_id, forward_only):
+             bucket_id, forward_only, shortlist=None):
         """Run a step of the model feeding the given inputs.
 
         Args:
@@ -180,15 +263,20 @@ class Seq2SeqModel(object):
             target_weights: list of numpy float vectors to feed as target weights.
             bucket_id: which bucket of the model to use.
             forward_only: whether to do the backward step or only forward.
+            shortlist: if the model uses a shortlist, the sorted target word ids considered in beam search,
+                or the pair (ids, mask) of mem.merge_shortlists to give each sentence its own.
 
         Returns:
             A triple consisting of gradient norm (or None if we did not do backward),
-            average perplexity, and the outputs.
+            average perplexity (or None when decoding with beam search), and the outputs.
 
         Raises:
             ValueError: if length of encoder_inputs, decoder_inputs, or
             target_weights disagrees with bucket size for the specified bucket_id.
         """
+        if forward_only and self.outputs[bucket_id] is None:
+            self.build_bucket(bucket_id)
+
         # Check if the sizes match.
         encoder_size, decoder_size = self.buckets[bucket_id]
         if len(encoder_inputs) != encoder_size:
@@ -209,56 +297,152 @@ class Seq2SeqModel(object):
             input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
             input_feed[self.target_weights[l].name] = target_weights[l]
         input_feed[self.encoder_mask.name] = encoder_mask
+        if self.shortlist is not None:
+            self._feed_shortlist(input_feed, shortlist, len(encoder_mask))
+        input_feed[self.beam_margin.name] = self.default_beam_margin
+        input_feed[self.beam_width.name] = self.beam_size
 
         # Since our targets are decoder inputs shifted by one, we need one more.
         last_target = self.decoder_inputs[decoder_size].name
-        input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+        input_feed[last_target] = np.zeros([len(decoder_inputs[0])], dtype=np.int32)
 
         # Output feed: depends on whether we do a backward step or not.
         if not forward_only:
             output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
                            self.gradient_norms[bucket_id],  # Gradient norm.
-                           self.losses[bucket_id]]  # Loss for this batch.
+                           self.train_losses[bucket_id]]  # Loss for this batch.
+        elif self.symbols[0]:
+            # The loss of the beam search outputs means nothing, so it is not computed when decoding.
+            output_feed = [self.symbols[bucket_id][l] for l in xrange(decoder_size)]  # Output symbols
         else:
             output_feed = [self.losses[bucket_id]]  # Loss for this batch.
-            if self.symbols[0]:
-                for l in xrange(decoder_size):  # Output symbols
-                    output_feed.append(self.symbols[bucket_id][l])
-            else:
-                for l in xrange(decoder_size):  # Output logits.
-                    output_feed.append(self.outputs[bucket_id][l])
+            for l in xrange(decoder_size):  # Output logits.
+                output_feed.append(self.outputs[bucket_id][l])
 
         outputs = session.run(output_feed, input_feed)
         if not forward_only:
             return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
+        elif self.symbols[0]:
+            return None, None, outputs  # No gradient norm, no loss, symbols.
         else:
             return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
 
+    def encode(self, session, source_ids, bucket_id):
+        """Run the encoder of the decoding model on sentences of a bucket, and project the source
+        annotations the attention compares with its queries.
+
+        The states of the sentences seen recently are taken from the encoder cache of the model,
+        so re-decoding a sentence with other search settings skips the encoder.
+
+        Args:
+            session: tensorflow session to use.
+            source_ids: a list of source token ids, ending with EOS, shorter than the bucket.
+            bucket_id: which bucket of the model to use.
+
+        Returns:
+            A list of the encoder states of the sentences, to give to search.
+        """
+        if self.outputs[bucket_id] is None:
+            self.build_bucket(bucket_id)
+        keys = [(bucket_id, tuple(token_ids)) for token_ids in source_ids]
+        states = [self.encoder_cache.get(key) for key in keys]
+        misses = [k for k, state in enumerate(states) if state is None]
+        if misses:
+            encoder_inputs, encoder_mask, _, _ = self.prepare_batch([(source_ids[k], []) for k in misses], bucket_id)
+            input_feed = {self.encoder_mask.name: encoder_mask}
+            for l in xrange(len(encoder_inputs)):
+                input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+            attention_states, encoder_state, attention_keys = session.run(
+                    [self.encoder_attention_states[bucket_id], self.encoder_state[bucket_id],
+                     self.encoder_attention_keys[bucket_id]], input_feed)
+            for i, k in enumerate(misses):
+                states[k] = (attention_states[i], encoder_state[i], np.array(encoder_mask[i], dtype=np.int32),
+                             [head_keys[i] for head_keys in attention_keys])
+                self.encoder_cache.put(keys[k], states[k])
+        return states
+
+    def search(self, session, states, bucket_id, shortlist=None, beam_margin=None, beam_width=None):
+        """Run beam search from encoder states returned by encode, without running the encoder
+        or projecting the attention keys again.
+
+        Args:
+            session: tensorflow session to use.
+            states: a list of encoder states of sentences of the bucket, returned by encode.
+            bucket_id: which bucket of the model to use.
+            shortlist: if the model uses a shortlist, the sorted target word ids considered in beam search,
+                or the pair (ids, mask) of mem.merge_shortlists to give each sentence its own.
+            beam_margin: the beam pruning margin of this search, see the constructor; None uses the
+                margin of the model.
+            beam_width: the number of hypotheses of each sentence kept alive in this search, from 1 to
+                the beam_size of the model; None uses beam_size.
+
+        Returns:
+            The output symbols, one numpy vector over the sentences for each decoder step, as from step.
+        """
+        if beam_width is not None and not 1 <= beam_width <= self.beam_size:
+            raise ValueError("beam_width must be from 1 to %d, got %d." % (self.beam_size, beam_width))
+        if self.outputs[bucket_id] is None:
+            self.build_bucket(bucket_id)
+        _, decoder_size = self.buckets[bucket_id]
+        input_feed = {
+            self.encoder_attention_states[bucket_id].name: np.array([state[0] for state in states]),
+            self.encoder_state[bucket_id].name: np.array([state[1] for state in states]),
+            self.encoder_mask.name: np.array([state[2] for state in states]),
+            self.decoder_inputs[0].name: np.full([len(states)], data_utils.GO_ID, dtype=np.int32),
+            self.beam_margin.name: self.default_beam_margin if beam_margin is None else beam_margin,
+            self.beam_width.name: self.beam_size if beam_width is None else beam_width,
+        }
+        for a, head_keys in enumerate(self.encoder_attention_keys[bucket_id]):
+            input_feed[head_keys.name] = np.array([state[3][a] for state in states])
+        if self.shortlist is not None:
+            self._feed_shortlist(input_feed, shortlist, len(states))
+        return session.run([self.symbols[bucket_id][l] for l in xrange(decoder_size)], input_feed)
+
+    def _feed_shortlist(self, input_feed, shortlist, batch_size):
+        """Feed the target word ids of a shortlist, and the mask of those of each sentence."""
+        ids, mask = shortlist if isinstance(shortlist, tuple) else (shortlist, None)
+        if mask is None:
+            # the sentences share all the ids
+            mask = np.ones([batch_size, len(ids)], dtype=np.float32)
+        input_feed[self.shortlist.name] = ids
+        input_feed[self.shortlist_mask.name] = mask
+
     def get_batch(self, data, bucket_id):
         """Get a random batch of data from the specified bucket, prepare for step.
 
+        Args:
+            data: a tuple of size len(self.buckets) in which each element contains
+                lists of pairs of input and output data that we use to create a batch.
+            bucket_id: integer, which bucket to get the batch for.
+
+        Returns:
+            The batch returned by prepare_batch.
+        """
+        pairs = [random.choice(data[bucket_id]) for _ in xrange(self.batch_size)]
+        return self.prepare_batch(pairs, bucket_id)
+
+    def prepare_batch(self, pairs, bucket_id):
+        """Prepare the given pairs of the specified bucket for step.
+
         To feed data in step(..) it must be a list of batch-major vectors, while
         data here contains single length-major cases. So the main logic of this
         function is to re-index data cases to be in the proper format for feeding.
 
         Args:
-            data: a tuple of size len(self.buckets) in which each element contains
-                lists of pairs of input and output data that we use to create a batch.
-            bucket_id: integer, which bucket to get the batch for.
+            pairs: a list of pairs of input and output data, one for each batch entry.
+            bucket_id: integer, which bucket the pairs belong to.
 
         Returns:
             The triple (batch_encoder_inputs, encoder_mask, batch_decoder_inputs, batch_weights) for
             the constructed batch that has the proper format to call step(...) later.
         """
+        batch_size = len(pairs)
         encoder_size, decoder_size = self.buckets[bucket_id]
         encoder_inputs, decoder_inputs = [], []
         encoder_mask = []
 
-        # Get a random batch of encoder and decoder inputs from data,
-        # pad them if needed, reverse encoder inputs and add GO to decoder.
-        for _ in xrange(self.batch_size):
-            encoder_input, decoder_input = random.choice(data[bucket_id])
-
+        # Pad the encoder and decoder inputs if needed and add GO to decoder.
+        for encoder_input, decoder_input in pairs:
             # Encoder inputs are padded and then reversed.
             encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
             encoder_inputs.append(list(encoder_input + encoder_pad))
@@ -275,17 +459,17 @@ class Seq2SeqModel(object):
         for length_idx in xrange(encoder_size):
             batch_encoder_inputs.append(
                     np.array([encoder_inputs[batch_idx][length_idx]
-                              for batch_idx in xrange(self.batch_size)], dtype=np.int32))
+                              for batch_idx in xrange(batch_size)], dtype=np.int32))
 
         # Batch decoder inputs are re-indexed decoder_inputs, we create weights.
         for length_idx in xrange(decoder_size):
             batch_decoder_inputs.append(
                     np.array([decoder_inputs[batch_idx][length_idx]
-                              for batch_idx in xrange(self.batch_size)], dtype=np.int32))
+                              for batch_idx in xrange(batch_size)], dtype=np.int32))
 
             # Create target_weights to be 0 for targets that are padding.
-            batch_weight = np.ones(self.batch_size, dtype=np.float32)
-            for batch_idx in xrange(self.batch_size):
+            batch_weight = np.ones(batch_size, dtype=np.float32)
+            for batch_idx in xrange(batch_size):
                 # We set weight to 0 if the corresponding target is a PAD symbol.
                 # The corresponding target is decoder_input shifted by 1 forward.
                 if length_idx < decoder_size - 1:
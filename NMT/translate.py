@@ -39,6 +39,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
 import math
 import os
 import time
@@ -49,6 +50,8 @@ import sys
 
 sys.path.append(".")
 import data_utils
+import mem
+import translation_cache
 import seq2seq_model
 
 tf.app.flags.DEFINE_float("learning_rate", 0.0005, "Learning rate.")
@@ -73,6 +76,59 @@ tf.app.flags.DEFINE_boolean("decode", False,
 tf.app.flags.DEFINE_string("model", "ckpt", "the checkpoint model to load")
 tf.app.flags.DEFINE_integer("beam_size", 5,
                             "The size of beam search. Do greedy search when set this to 1.")
+tf.app.flags.DEFINE_integer("num_samples", 0,
+                            "Number of target words sampled by the sampled softmax training loss; "
+                            "0 trains with the full softmax.")
+tf.app.flags.DEFINE_float("decode_length_ratio", 0.0,
+                          "When decoding, end every translation once it is this many times as long as its source "
+                          "sentence; 0 only limits it by the bucket.")
+tf.app.flags.DEFINE_float("beam_relative_threshold", 0.0,
+                          "When decoding, drop the hypotheses whose probability is below this fraction of the best "
+                          "one of their sentence, e.g. 0.01; 0 keeps them.")
+tf.app.flags.DEFINE_float("beam_absolute_margin", 0.0,
+                          "When decoding, drop the hypotheses whose log probability is more than this below the best "
+                          "one of their sentence; 0 keeps them.")
+tf.app.flags.DEFINE_integer("encoder_cache_size", 0,
+                            "When decoding, keep the encoder states of this many recent sentences and run beam search "
+                            "from them, so that repeated sentences and shortlist_check skip the encoder; 0 disables it.")
+tf.app.flags.DEFINE_integer("decode_batch_size", 1,
+                            "The number of input sentences read and translated together when decoding.")
+tf.app.flags.DEFINE_string("decode_input", "",
+                           "Translate this file, with its sentences sorted by length and translated in batches of "
+                           "decode_batch_size, instead of reading stdin.")
+tf.app.flags.DEFINE_string("decode_output", "",
+                           "The file of the translations of decode_input, in the input order; empty prints them.")
+tf.app.flags.DEFINE_integer("decode_chunk_size", 10000,
+                            "The number of lines of decode_input read and sorted at a time; 0 reads the whole file.")
+tf.app.flags.DEFINE_integer("translation_cache_size", 0,
+                            "When decoding, keep the translations of this many recent sentences in memory and reuse "
+                            "them for repeated sentences; 0 disables the cache unless translation_cache_path is set.")
+tf.app.flags.DEFINE_string("translation_cache_path", "",
+                           "A file keeping all translations across runs; it is emptied when the model changes.")
+tf.app.flags.DEFINE_float("fuzzy_threshold", 0.0,
+                          "When decoding, reuse the translation of a previously translated sentence whose similarity "
+                          "(1 - edit distance / length) to the input is at least this; 0 disables the fuzzy memory.")
+tf.app.flags.DEFINE_integer("fuzzy_max_edits", 2,
+                            "The maximum number of token edits between the input and a reused sentence.")
+tf.app.flags.DEFINE_string("fuzzy_memory_path", "",
+                           "A file keeping the fuzzy memory across runs; it is emptied when the model changes.")
+tf.app.flags.DEFINE_boolean("fuzzy_flag", False,
+                            "Prefix the reused fuzzy translations with [fuzzy <similarity>].")
+tf.app.flags.DEFINE_integer("intra_op_threads", 0,
+                            "The number of threads of the decoding session within an op (e.g. a matmul); "
+                            "0 lets TensorFlow use all cores.")
+tf.app.flags.DEFINE_integer("inter_op_threads", 0,
+                            "The number of threads of the decoding session running independent ops; "
+                            "0 lets TensorFlow choose.")
+tf.app.flags.DEFINE_boolean("lazy_buckets", False,
+                            "When decoding, build the graph of a bucket the first time a sentence of its length comes.")
+tf.app.flags.DEFINE_integer("shortlist_top_n", 0,
+                            "Decode with a vocabulary shortlist made of the top n mems2t candidates of each source "
+                            "word and the shortlist_frequent most frequent target words; 0 uses the full vocabulary.")
+tf.app.flags.DEFINE_integer("shortlist_frequent", 2000,
+                            "Number of most frequent target words always in the shortlist.")
+tf.app.flags.DEFINE_boolean("shortlist_check", False,
+                            "Also decode with the full vocabulary and report how often both translations agree.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -124,17 +180,41 @@ def read_data(source_path, target_path):
     return data_set
 
 
+def _report_graph(start_time):
+    """Print the time taken to build the model graph and the size of its GraphDef."""
+    graph_def = tf.get_default_graph().as_graph_def()
+    sys.stderr.write("Built the model in %.1fs: %d ops, GraphDef %.1f MB\n"
+                     % (time.time() - start_time, len(graph_def.node), graph_def.ByteSize() / 2.0 ** 20))
+    sys.stderr.flush()
+
+
+def _beam_margin():
+    """The margin of log probability below the best hypothesis of the beam pruning flags, 0 if none is set."""
+    margins = []
+    if FLAGS.beam_absolute_margin > 0:
+        margins.append(FLAGS.beam_absolute_margin)
+    if 0 < FLAGS.beam_relative_threshold < 1:
+        margins.append(-math.log(FLAGS.beam_relative_threshold))
+    return min(margins) if margins else 0.0
+
+
 def create_model(session,
                  forward_only,
-                 ckpt_file=None):
+                 ckpt_file=None,
+                 use_shortlist=False):
     """Create translation model and initialize or load parameters in session."""
+    start_time = time.time()
     model = seq2seq_model.Seq2SeqModel(
             FLAGS.src_vocab_size, FLAGS.trg_vocab_size, _buckets,
             FLAGS.hidden_edim, FLAGS.hidden_units,
             FLAGS.num_layers, FLAGS.keep_prob, FLAGS.max_gradient_norm, FLAGS.batch_size,
             FLAGS.learning_rate, FLAGS.learning_rate_decay_factor,
             FLAGS.beam_size,
-            forward_only=forward_only)
+            forward_only=forward_only, use_shortlist=use_shortlist,
+            num_samples=FLAGS.num_samples, lazy_buckets=forward_only and FLAGS.lazy_buckets,
+            max_length_ratio=FLAGS.decode_length_ratio, beam_margin=_beam_margin(),
+            encoder_cache_size=FLAGS.encoder_cache_size if forward_only else 0)
+    _report_graph(start_time)
     if ckpt_file:
         model_path = os.path.join(FLAGS.train_dir, ckpt_file)
         if tf.gfile.Exists(model_path):
@@ -234,8 +314,66 @@ def train():
                 sys.stdout.flush()
 
 
+def translate_file(input_path, output_path, to_token_ids, translate):
+    """Translate a file in batches of sentences of similar lengths, and write the translations in the input order.
+
+    Args:
+        input_path: the file of the source sentences, one per line.
+        output_path: the file to write the translations to; they are printed if it is empty.
+        to_token_ids: a function sentence -> token ids, ending with EOS.
+        translate: a function (list of token ids, bucket_id) -> list of translations.
+    """
+    def bucket_of(token_ids):
+        return min([b for b in xrange(len(_buckets)) if _buckets[b][0] > len(token_ids)])
+
+    start_time = time.time()
+    num_sentences, num_source_tokens, num_target_tokens = 0, 0, 0
+    output_file = open(output_path, "w") if output_path else sys.stdout
+    with open(input_path) as input_file:
+        while True:
+            # Read a chunk of the input, or all of it.
+            sentences = list(itertools.islice(input_file, FLAGS.decode_chunk_size or None))
+            if not sentences:
+                break
+            token_ids = [to_token_ids(sentence) for sentence in sentences]
+            # Sort the sentences by length, so that each batch holds sentences of the same bucket.
+            order = sorted(xrange(len(sentences)), key=lambda k: len(token_ids[k]))
+            translations = [None] * len(sentences)
+            start = 0
+            while start < len(order):
+                bucket_id = bucket_of(token_ids[order[start]])
+                end = start + 1
+                while (end < len(order) and end - start < FLAGS.decode_batch_size
+                       and bucket_of(token_ids[order[end]]) == bucket_id):
+                    end += 1
+                batch = order[start:end]
+                for k, translation in zip(batch, translate([token_ids[k] for k in batch], bucket_id)):
+                    translations[k] = translation
+                start = end
+
+            for translation in translations:
+                output_file.write(translation + "\n")
+            output_file.flush()
+            num_sentences += len(sentences)
+            num_source_tokens += sum(len(ids) - 1 for ids in token_ids)
+            num_target_tokens += sum(len(translation.split()) for translation in translations)
+            sys.stderr.write("Translated %d sentences\n" % num_sentences)
+            sys.stderr.flush()
+    if output_path:
+        output_file.close()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    sys.stderr.write("Translated %d sentences in %.1fs: %.2f sentences/s, %.1f source tokens/s, "
+                     "%.1f target tokens/s\n" % (num_sentences, elapsed, num_sentences / elapsed,
+                                                 num_source_tokens / elapsed, num_target_tokens / elapsed))
+    sys.stderr.flush()
+
+
 def decode():
-    with tf.Session() as sess:
+    # Several decoding processes on one machine each get their share of the cores, see shard_decode.py.
+    config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                            inter_op_parallelism_threads=FLAGS.inter_op_threads)
+    with tf.Session(config=config) as sess:
         # Load vocabularies.
         src_vocab_path = os.path.join(FLAGS.data_dir,
                                       "vocab%d.src" % FLAGS.src_vocab_size)
@@ -249,33 +387,153 @@ def decode():
         if FLAGS.trg_vocab_size > len(trg_vocab):
             FLAGS.trg_vocab_size = len(trg_vocab)
 
-        # Create model and load parameters.
-        model = create_model(sess, True, FLAGS.model)
-        model.batch_size = 1  # We decode one sentence at a time.
+        if FLAGS.shortlist_top_n > 0:
+            mems2t = mem.LexicalTable.load(os.path.join(FLAGS.data_dir, "mems2t"))
+            full_vocab = np.arange(FLAGS.trg_vocab_size, dtype=np.int32)
+        # shortlist size, translations identical to full vocabulary decoding, translations checked
+        check = [0, 0, 0]
 
-        sentence = sys.stdin.readline()
-        while sentence:
+        # Create model and load parameters.
+        model = create_model(sess, True, FLAGS.model, use_shortlist=FLAGS.shortlist_top_n > 0)
+
+        cache, fuzzy = None, None
+        if FLAGS.translation_cache_size > 0 or FLAGS.translation_cache_path or FLAGS.fuzzy_threshold > 0:
+            # The translations depend on the checkpoints, the vocabularies and the decoding settings.
+            patterns = translation_cache.checkpoint_patterns(os.path.join(FLAGS.train_dir, FLAGS.model))
+            patterns += [src_vocab_path, trg_vocab_path]
+            settings = (FLAGS.beam_size, _beam_margin(), FLAGS.decode_length_ratio, FLAGS.shortlist_top_n,
+                        FLAGS.shortlist_frequent, FLAGS.hidden_edim, FLAGS.hidden_units, FLAGS.num_layers)
+            model_fingerprint = translation_cache.fingerprint(patterns, settings)
+            if FLAGS.translation_cache_size > 0 or FLAGS.translation_cache_path:
+                cache = translation_cache.TranslationCache(model_fingerprint, FLAGS.translation_cache_size,
+                                                           FLAGS.translation_cache_path)
+            if FLAGS.fuzzy_threshold > 0:
+                fuzzy = translation_cache.FuzzyMemory(model_fingerprint, FLAGS.fuzzy_threshold, FLAGS.fuzzy_max_edits,
+                                                      path=FLAGS.fuzzy_memory_path)
+        # seconds of beam search, sentences translated by beam search
+        search_time = [0.0, 0]
+
+        def to_token_ids(sentence):
             # Get token-ids for the input sentence.
             token_ids = data_utils.sentence_to_token_ids(tf.compat.as_bytes(sentence), src_vocab)
             token_ids.append(data_utils.EOS_ID)
-            # Which bucket does it belong to?
-            bucket_id = min([b for b in xrange(len(_buckets))
-                             if _buckets[b][0] > len(token_ids)])
-            # Get a 1-element batch to feed the sentence to the model.
-            encoder_inputs, encoder_mask, decoder_inputs, target_weights = model.get_batch(
-                    {bucket_id: [(token_ids, [])]}, bucket_id)
-            # Get output logits for the sentence.
-            _, _, output_logits = model.step(sess, encoder_inputs, encoder_mask, decoder_inputs,
-                                             target_weights, bucket_id, True)
-
-            # This is a beam search decoder - output is the best result from beam search
-            outputs = [int(logit) for logit in output_logits]
-
-            # If there is an EOS symbol in outputs, cut them at that point.
-            if data_utils.EOS_ID in outputs:
-                outputs = outputs[:outputs.index(data_utils.EOS_ID)]
-            print(" ".join([tf.compat.as_str(rev_trg_vocab[output]) for output in outputs]))
+            return token_ids
+
+        def translate(batch, bucket_id):
+            """Translate a list of token ids of the same bucket together, returns the translated sentences."""
+            shortlist = None
+            if FLAGS.shortlist_top_n > 0:
+                # The batch is decoded over the union of the shortlists, each sentence over its own.
+                shortlist = mem.merge_shortlists([
+                    mem.get_shortlist(mems2t, token_ids, FLAGS.shortlist_top_n,
+                                      min(FLAGS.shortlist_frequent, FLAGS.trg_vocab_size))
+                    for token_ids in batch])
+            if FLAGS.encoder_cache_size > 0:
+                # Search from the cached encoder states; the check below reuses them too.
+                states = model.encode(sess, batch, bucket_id)
+                output_logits = model.search(sess, states, bucket_id, shortlist=shortlist)
+                if FLAGS.shortlist_top_n > 0 and FLAGS.shortlist_check:
+                    full_logits = model.search(sess, states, bucket_id, shortlist=full_vocab)
+            else:
+                # Get a batch of the sentences of the bucket to feed the model.
+                encoder_inputs, encoder_mask, decoder_inputs, target_weights = model.prepare_batch(
+                        [(token_ids, []) for token_ids in batch], bucket_id)
+                # Get output logits for the sentences.
+                _, _, output_logits = model.step(sess, encoder_inputs, encoder_mask, decoder_inputs,
+                                                 target_weights, bucket_id, True, shortlist=shortlist)
+                if FLAGS.shortlist_top_n > 0 and FLAGS.shortlist_check:
+                    _, _, full_logits = model.step(sess, encoder_inputs, encoder_mask, decoder_inputs,
+                                                   target_weights, bucket_id, True, shortlist=full_vocab)
+
+            translations = []
+            for i in xrange(len(batch)):
+                # This is a beam search decoder - output is the best result from beam search
+                outputs = [int(logit[i]) for logit in output_logits]
+                if FLAGS.shortlist_top_n > 0 and FLAGS.shortlist_check:
+                    check[0] += shortlist[1][i].sum()
+                    check[1] += [int(logit[i]) for logit in full_logits] == outputs
+                    check[2] += 1
+
+                # If there is an EOS symbol in outputs, cut them at that point.
+                if data_utils.EOS_ID in outputs:
+                    outputs = outputs[:outputs.index(data_utils.EOS_ID)]
+                translations.append(" ".join([tf.compat.as_str(rev_trg_vocab[output]) for output in outputs]))
+            return translations
+
+        def reuse_translate(batch, bucket_id):
+            """Like translate, but only the sentences missing from the cache and the fuzzy memory are translated."""
+            translations = [None] * len(batch)
+            if cache is not None:
+                translations = [cache.get(token_ids) for token_ids in batch]
+            if fuzzy is not None:
+                for k, token_ids in enumerate(batch):
+                    match = fuzzy.lookup(token_ids) if translations[k] is None else None
+                    if match is not None:
+                        translation, similarity = match
+                        if FLAGS.fuzzy_flag:
+                            translation = "[fuzzy %.2f] %s" % (similarity, translation)
+                        translations[k] = translation
+            misses = [k for k, translation in enumerate(translations) if translation is None]
+            if misses:
+                start_time = time.time()
+                translated = translate([batch[k] for k in misses], bucket_id)
+                search_time[0] += time.time() - start_time
+                search_time[1] += len(misses)
+                for k, translation in zip(misses, translated):
+                    translations[k] = translation
+                    if cache is not None:
+                        cache.put(batch[k], translation)
+                    if fuzzy is not None:
+                        fuzzy.add(batch[k], translation)
+            return translations
+
+        translate_batch = reuse_translate if cache is not None or fuzzy is not None else translate
+        if FLAGS.decode_input:
+            translate_file(FLAGS.decode_input, FLAGS.decode_output, to_token_ids, translate_batch)
+        else:
             sentence = sys.stdin.readline()
+            while sentence:
+                # Read up to decode_batch_size sentences, and translate those of the same bucket together.
+                sentences = [sentence]
+                while len(sentences) < FLAGS.decode_batch_size:
+                    sentence = sys.stdin.readline()
+                    if not sentence:
+                        break
+                    sentences.append(sentence)
+                batches = {}
+                for k, sentence in enumerate(sentences):
+                    token_ids = to_token_ids(sentence)
+                    # Which bucket does it belong to?
+                    bucket_id = min([b for b in xrange(len(_buckets))
+                                     if _buckets[b][0] > len(token_ids)])
+                    batches.setdefault(bucket_id, []).append((k, token_ids))
+
+                translations = [None] * len(sentences)
+                for bucket_id, batch in batches.items():
+                    translated = translate_batch([token_ids for _, token_ids in batch], bucket_id)
+                    for (k, _), translation in zip(batch, translated):
+                        translations[k] = translation
+                for translation in translations:
+                    print(translation)
+                sys.stdout.flush()
+                sentence = sys.stdin.readline()
+
+        reused = 0
+        if cache is not None:
+            cache.close()
+            reused += cache.hits
+            sys.stderr.write(cache.report() + "\n")
+        if fuzzy is not None:
+            fuzzy.save()
+            reused += fuzzy.hits
+            sys.stderr.write("%s, at most %d edits and similarity %.2f\n"
+                             % (fuzzy.report(), FLAGS.fuzzy_max_edits, FLAGS.fuzzy_threshold))
+        if reused > 0 and search_time[1] > 0:
+            sys.stderr.write("Reusing %d translations saved about %.1fs of beam search (%.3fs per sentence)\n"
+                             % (reused, reused * search_time[0] / search_time[1], search_time[0] / search_time[1]))
+        if FLAGS.shortlist_top_n > 0 and FLAGS.shortlist_check and check[2] > 0:
+            sys.stderr.write("Shortlist check: %d of %d translations identical to full vocabulary decoding, "
+                             "average shortlist size %.1f.\n" % (check[1], check[2], check[0] / check[2]))
 
 
 def main(_):
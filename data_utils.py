@@ -38,7 +38,11 @@ import tarfile
 
 from six.moves import urllib
 
-from tensorflow.python.platform import gfile
+try:
+    from tensorflow.python.platform import gfile
+except ImportError:
+    # mem.py and its tests run without TensorFlow; only local paths can be read then.
+    gfile = None
 
 # Special vocabulary symbols - we always put them at the start.
 _PAD = b"_PAD"
@@ -59,6 +63,16 @@ _WORD_SPLIT = re.compile(b"([.,!?\"':;)(])")
 _DIGIT_RE = re.compile(br"\d")
 
 
+def _exists(path):
+    """gfile.Exists, which also supports GCS and HDFS paths, or os.path.exists without TensorFlow."""
+    return gfile.Exists(path) if gfile is not None else os.path.exists(path)
+
+
+def _open(path, mode):
+    """gfile.GFile, which also supports GCS and HDFS paths, or open without TensorFlow."""
+    return gfile.GFile(path, mode=mode) if gfile is not None else open(path, mode)
+
+
 def basic_tokenizer(sentence):
     """Very basic tokenizer: split the sentence into a list of tokens."""
     words = []
@@ -87,10 +101,10 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
         if None, basic_tokenizer will be used.
       normalize_digits: Boolean; if true, all digits are replaced by 0s.
     """
-    if not gfile.Exists(vocabulary_path):
+    if not _exists(vocabulary_path):
         print("Creating vocabulary %s from data %s" % (vocabulary_path, data_path))
         vocab = {}
-        with gfile.GFile(data_path, mode="rb") as f:
+        with _open(data_path, mode="rb") as f:
             counter = 0
             for line in f:
                 counter += 1
@@ -106,7 +120,7 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
             vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
             if len(vocab_list) > max_vocabulary_size:
                 vocab_list = vocab_list[:max_vocabulary_size]
-            with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
+            with _open(vocabulary_path, mode="wb") as vocab_file:
                 for w in vocab_list:
                     vocab_file.write(w + b"\n")
 
@@ -130,9 +144,9 @@ def initialize_vocabulary(vocabulary_path):
     Raises:
       ValueError: if the provided vocabulary_path does not exist.
     """
-    if gfile.Exists(vocabulary_path):
+    if _exists(vocabulary_path):
         rev_vocab = []
-        with gfile.GFile(vocabulary_path, mode="rb") as f:
+        with _open(vocabulary_path, mode="rb") as f:
             rev_vocab.extend(f.readlines())
         rev_vocab = [line.strip() for line in rev_vocab]
         vocab = dict([(x, y) for (y, x) in enumerate(rev_vocab)])
@@ -186,11 +200,11 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
         if None, basic_tokenizer will be used.
       normalize_digits: Boolean; if true, all digits are replaced by 0s.
     """
-    if not gfile.Exists(target_path):
+    if not _exists(target_path):
         print("Tokenizing data in %s" % data_path)
         vocab, _ = initialize_vocabulary(vocabulary_path)
-        with gfile.GFile(data_path, mode="rb") as data_file:
-            with gfile.GFile(target_path, mode="w") as tokens_file:
+        with _open(data_path, mode="rb") as data_file:
+            with _open(target_path, mode="w") as tokens_file:
                 counter = 0
                 for line in data_file:
                     counter += 1
@@ -12,86 +12,547 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+from __future__ import print_function
+
+import argparse
+import itertools
+import multiprocessing
+import os
 import pickle as pkl
-from collections import Counter
+import numpy as np
+from six.moves import zip
 import data_utils
 
-def get_mem_s2t():
-    slines = open("./data/train.ids30000.src")
-    tlines = open("./data/train.ids30000.trg")
-    mlines = open("./data/aligns")
-    mem = {}
-    for sline, tline, mline in zip(slines, tlines, mlines):
-        zh_words = sline.strip().split(' ')
-        en_words = tline.strip().split(' ')
-        maps = mline.strip().split(' ')
-        for m in maps:
-            zhid, enid = m.split('-')
-            zh_word = zh_words[int(zhid)]
-            if int(zh_word) == 3:
-                continue
-            en_word = en_words[int(enid)]
-            if int(en_word) == 3:
-                continue
-            if int(zh_word) not in mem:
-                mem[int(zh_word)] = []
-            mem[int(zh_word)].append(int(en_word))
-
-    for m in mem:
-        l = len(mem[m])
-        words = Counter(mem[m])
-        words = sorted(words.items(), key=lambda x: x[1], reverse=True)
-        mem[m] = map(lambda x: (x[0], x[1] / float(l)), words)
-
-    del slines
-    del tlines
-    del mlines
-
-    en_vocab_path = "./data/vocab30000.src"
-    fr_vocab_path = "./data/vocab30000.trg"
-    en_vocab, rev_en_vocab = data_utils.initialize_vocabulary(en_vocab_path)
-    fr_vocab, rev_fr_vocab = data_utils.initialize_vocabulary(fr_vocab_path)
-
-    for i, word in enumerate(rev_en_vocab):
-        if i not in mem:
-            if word in fr_vocab:
-                mem[i] = [(fr_vocab[word], 1.0), (fr_vocab['_NULL'], 0.0)]
-            else:
-                mem[i] = [(fr_vocab['_NULL'], 0.0), (fr_vocab['_NULL'], 0.0)]
-
-    f = open("./data/mems2t.pkl", 'wb')
-    pkl.dump(mem, f)
-
-
-def get_mem_t2s():
-    slines = open("./data/train.ids30000.src")
-    tlines = open("./data/train.ids30000.trg")
-    mlines = open("./data/aligns")
-    mem = {}
+_TABLE_ARRAYS = ("indptr", "indices", "probs")
+
+# The memory of a sentence takes at most this many target candidates of each source word.
+MEM_CANDIDATES = 5
+
+
+class LexicalTable(object):
+    """A lexical memory table in CSR layout.
+
+    Row i holds the entries of word i: indices[indptr[i]:indptr[i + 1]] are the ids of the words it maps to
+    and probs[indptr[i]:indptr[i + 1]] their probabilities. mems2t rows are sorted by decreasing probability,
+    memt2s rows by increasing id. The arrays are saved as .npy files and memory-mapped when loaded, so loading
+    is cheap and processes using the same table share its pages.
+    """
+
+    def __init__(self, indptr, indices, probs):
+        self.indptr = indptr
+        self.indices = indices
+        self.probs = probs
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def row(self, i):
+        """Returns the pair (indices, probs) of row i, empty if the row does not exist."""
+        if i >= len(self):
+            return self.indices[:0], self.probs[:0]
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.probs[start:end]
+
+    def lookup(self, i, ids):
+        """Returns the probabilities of the entries ids in row i, 0.0 for ids not in the row.
+        The indices of the row must be sorted, as in memt2s."""
+        ids = np.asarray(ids)
+        indices, probs = self.row(i)
+        if len(indices) == 0:
+            return np.zeros(ids.shape, dtype=np.float32)
+        pos = np.minimum(np.searchsorted(indices, ids), len(indices) - 1)
+        return np.where(indices[pos] == ids, probs[pos], 0.0).astype(np.float32)
+
+    def save(self, prefix):
+        """Write the table to prefix.indptr.npy, prefix.indices.npy and prefix.probs.npy."""
+        for name in _TABLE_ARRAYS:
+            np.save("%s.%s.npy" % (prefix, name), getattr(self, name))
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        """Load a table written by save, memory-mapped unless mmap_mode is None."""
+        return cls(*[np.load("%s.%s.npy" % (prefix, name), mmap_mode=mmap_mode) for name in _TABLE_ARRAYS])
+
+    def replace_rows(self, rows, table):
+        """Returns a new table where the given rows are taken from table and the others from this table.
+        The result has as many rows as the larger of the two tables."""
+        num_rows = max(len(self), len(table))
+        replaced = np.zeros((num_rows,), dtype=bool)
+        replaced[rows] = True
+
+        def entries(t, keep):
+            entry_rows = np.repeat(np.arange(len(t)), np.diff(t.indptr))
+            mask = keep[entry_rows]
+            return entry_rows[mask], t.indices[mask], t.probs[mask]
+
+        old_rows, old_cols, old_probs = entries(self, ~replaced)
+        new_rows, new_cols, new_probs = entries(table, replaced)
+        return LexicalTable.from_entries(num_rows, np.concatenate([old_rows, new_rows]),
+                                         np.concatenate([old_cols, new_cols]), np.concatenate([old_probs, new_probs]))
+
+    @classmethod
+    def from_entries(cls, num_rows, rows, cols, probs):
+        """Build a table from (rows[k], cols[k], probs[k]) entries in any row order.
+        The entries of a row keep their relative order."""
+        order = np.argsort(rows, kind='mergesort')
+        indptr = np.zeros((num_rows + 1,), dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_rows))
+        return cls(indptr, np.asarray(cols)[order].astype(np.int32), np.asarray(probs)[order].astype(np.float32))
+
+
+class PairCounter(object):
+    """Sparse (COO) accumulator of aligned (source id, target id) counts.
+
+    Pairs are buffered as int64 keys (source id << 32 | target id), and the buffer is merged into
+    sorted unique keys with their counts whenever it grows large, so the memory used is
+    proportional to the number of distinct pairs, not to the number of alignment links.
+    """
+
+    def __init__(self, flush_size=1 << 22):
+        self._keys = np.zeros((0,), dtype=np.int64)
+        self._counts = np.zeros((0,), dtype=np.int64)
+        self._buffer = []
+        self._buffered = 0
+        self._flush_size = flush_size
+
+    def add(self, src_ids, trg_ids, counts=None):
+        """Count one co-occurrence for each pair (src_ids[i], trg_ids[i]), or counts[i] if given."""
+        keys = (np.asarray(src_ids).astype(np.int64) << 32) | np.asarray(trg_ids).astype(np.int64)
+        if counts is None:
+            counts = np.ones((len(keys),), dtype=np.int64)
+        self._buffer.append((keys, np.asarray(counts).astype(np.int64)))
+        self._buffered += len(keys)
+        if self._buffered >= self._flush_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        keys = np.concatenate([self._keys] + [b[0] for b in self._buffer])
+        counts = np.concatenate([self._counts] + [b[1] for b in self._buffer])
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._counts = np.bincount(inverse, weights=counts, minlength=len(self._keys)).astype(np.int64)
+        self._buffer = []
+        self._buffered = 0
+
+    def result(self):
+        """Returns the triple (src_ids, trg_ids, counts) of the distinct pairs, sorted by (src_id, trg_id)."""
+        self._flush()
+        return self._keys >> 32, self._keys & 0xffffffff, self._counts
+
+
+def _count_lines(counter, slines, tlines, mlines):
     for sline, tline, mline in zip(slines, tlines, mlines):
-        zh_words = sline.strip().split(' ')
-        en_words = tline.strip().split(' ')
-        maps = mline.strip().split(' ')
-        for m in maps:
-            zhid, enid = m.split('-')
-            zh_word = zh_words[int(zhid)]
-            if int(zh_word) == 3:
-                continue
-            en_word = en_words[int(enid)]
-            if int(en_word) == 3:
+        links = np.array(mline.replace('-', ' ').split(), dtype=np.int64).reshape(-1, 2)
+        if len(links) == 0:
+            continue
+        zh_words = np.array(sline.split(), dtype=np.int64)
+        en_words = np.array(tline.split(), dtype=np.int64)
+        zh_ids = zh_words[links[:, 0]]
+        en_ids = en_words[links[:, 1]]
+        keep = (zh_ids != data_utils.UNK_ID) & (en_ids != data_utils.UNK_ID)
+        counter.add(zh_ids[keep], en_ids[keep])
+
+
+def count_aligned_pairs(src_path, trg_path, align_path):
+    """Count the aligned word pairs of a word-aligned corpus in one pass.
+
+    Links touching an UNK on either side are skipped.
+
+    Args:
+        src_path: the token-ids of the source sentences.
+        trg_path: the token-ids of the target sentences.
+        align_path: the word alignments, one line of "i-j" links per sentence pair.
+
+    Returns:
+        The triple (src_ids, trg_ids, counts) returned by PairCounter.result.
+    """
+    counter = PairCounter()
+    with open(src_path) as slines, open(trg_path) as tlines, open(align_path) as mlines:
+        _count_lines(counter, slines, tlines, mlines)
+    return counter.result()
+
+
+def _line_offsets(path, line_numbers):
+    """Returns the byte offsets at which the given (increasing) line numbers of a file start."""
+    offsets = []
+    wanted = iter(line_numbers)
+    target = next(wanted, None)
+    offset = 0
+    with open(path, 'rb') as f:
+        for line_number, line in enumerate(f):
+            while target == line_number:
+                offsets.append(offset)
+                target = next(wanted, None)
+            if target is None:
+                break
+            offset += len(line)
+    # line numbers past the last line start at the end of the file
+    while target is not None:
+        offsets.append(offset)
+        target = next(wanted, None)
+    return offsets
+
+
+def split_shards(paths, num_shards):
+    """Split line-aligned files into num_shards ranges of (almost) the same number of lines.
+
+    Returns:
+        A list of (offsets, num_lines): shard i reads num_lines lines of paths[k] starting at byte offsets[k].
+    """
+    with open(paths[-1], 'rb') as f:
+        total = sum(1 for _ in f)
+    starts = [total * i // num_shards for i in range(num_shards + 1)]
+    offsets = list(zip(*[_line_offsets(path, starts[:-1]) for path in paths]))
+    return [(offsets[i], starts[i + 1] - starts[i]) for i in range(num_shards)]
+
+
+def _count_shard(args):
+    src_path, trg_path, align_path, offsets, num_lines = args
+    counter = PairCounter()
+    files = [open(path) for path in (src_path, trg_path, align_path)]
+    try:
+        for f, offset in zip(files, offsets):
+            f.seek(offset)
+        _count_lines(counter, *[itertools.islice(f, num_lines) for f in files])
+    finally:
+        for f in files:
+            f.close()
+    return counter.result()
+
+
+def count_aligned_pairs_parallel(src_path, trg_path, align_path, num_workers):
+    """Count the aligned word pairs like count_aligned_pairs, with the corpus split at line boundaries into
+    num_workers shards which are counted in a process pool. The merged counts are the same as the serial ones.
+    """
+    if num_workers <= 1:
+        return count_aligned_pairs(src_path, trg_path, align_path)
+    shards = split_shards((src_path, trg_path, align_path), num_workers)
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        results = pool.map(_count_shard, [(src_path, trg_path, align_path, offsets, num_lines)
+                                          for offsets, num_lines in shards])
+    finally:
+        pool.close()
+        pool.join()
+    counter = PairCounter()
+    for src_ids, trg_ids, counts in results:
+        counter.add(src_ids, trg_ids, counts)
+    return counter.result()
+
+
+def _s2t_entries(src_ids, trg_ids, counts, num_rows):
+    order = np.lexsort((trg_ids, -counts, src_ids))
+    rows, cols, counts = src_ids[order], trg_ids[order], counts[order]
+    totals = np.bincount(rows, weights=counts, minlength=num_rows)
+    return rows, cols, counts / totals[rows], totals
+
+
+def _t2s_entries(src_ids, trg_ids, counts, num_rows):
+    order = np.lexsort((src_ids, trg_ids))
+    rows, cols, counts = trg_ids[order], src_ids[order], counts[order]
+    totals = np.bincount(rows, weights=counts, minlength=num_rows)
+    return rows, cols, counts / totals[rows]
+
+
+def get_mem_s2t(src_ids, trg_ids, counts, src_vocab_path, trg_vocab_path):
+    """The source to target memory: row s lists the target words aligned to source word s with their
+    probabilities, by decreasing probability (ties by target id). Source words which were never aligned map
+    to themselves when the word is also in the target vocabulary, and to _NULL otherwise."""
+    en_vocab, rev_en_vocab = data_utils.initialize_vocabulary(src_vocab_path)
+    fr_vocab, rev_fr_vocab = data_utils.initialize_vocabulary(trg_vocab_path)
+    num_rows = max([len(rev_en_vocab)] + [int(src_ids.max()) + 1] * (len(src_ids) > 0))
+    rows, cols, probs, totals = _s2t_entries(src_ids, trg_ids, counts, num_rows)
+
+    fallback = []
+    for i in np.flatnonzero(totals == 0):
+        word = rev_en_vocab[i] if i < len(rev_en_vocab) else None
+        if word in fr_vocab:
+            fallback += [(i, fr_vocab[word], 1.0), (i, fr_vocab[data_utils._NULL], 0.0)]
+        else:
+            fallback += [(i, fr_vocab[data_utils._NULL], 0.0), (i, fr_vocab[data_utils._NULL], 0.0)]
+    if fallback:
+        fallback = np.array(fallback)
+        rows = np.concatenate([rows, fallback[:, 0].astype(np.int64)])
+        cols = np.concatenate([cols, fallback[:, 1].astype(np.int64)])
+        probs = np.concatenate([probs, fallback[:, 2]])
+    return LexicalTable.from_entries(num_rows, rows, cols, probs)
+
+
+def get_mem_t2s(src_ids, trg_ids, counts):
+    """The target to source memory: row t lists the source words aligned to target word t with their
+    probabilities, by increasing source id."""
+    num_rows = int(trg_ids.max()) + 1 if len(trg_ids) else 0
+    return LexicalTable.from_entries(num_rows, *_t2s_entries(src_ids, trg_ids, counts, num_rows))
+
+
+def save_counts(path, src_ids, trg_ids, counts):
+    """Save the raw aligned pair counts, from which the memories are derived, to a compressed .npz file."""
+    np.savez_compressed(path, src_ids=src_ids.astype(np.int32), trg_ids=trg_ids.astype(np.int32), counts=counts)
+
+
+def load_counts(path):
+    """Returns the triple (src_ids, trg_ids, counts) saved by save_counts."""
+    data = np.load(path)
+    return data["src_ids"].astype(np.int64), data["trg_ids"].astype(np.int64), data["counts"]
+
+
+def _member_mask(ids, members, size):
+    """Returns the mask of the ids which are in members, all of them smaller than size."""
+    mask = np.zeros((size + 1,), dtype=bool)
+    mask[members] = True
+    return mask[np.minimum(ids, size)]
+
+
+def update_memories(mems2t, memt2s, old_pairs, new_pairs):
+    """Fold newly counted aligned pairs into existing memories.
+
+    Only the rows whose counts changed, i.e. the source words (for mems2t) and target words (for memt2s)
+    of the new pairs, are derived again; they are the same as in memories built from all the data at once.
+
+    Args:
+        mems2t: the source to target memory built from old_pairs.
+        memt2s: the target to source memory built from old_pairs.
+        old_pairs: the counts (src_ids, trg_ids, counts) the memories were built from.
+        new_pairs: the counts of the new data.
+
+    Returns:
+        The tuple (mems2t, memt2s, pairs) of the updated memories and the merged counts.
+    """
+    counter = PairCounter()
+    counter.add(*old_pairs)
+    counter.add(*new_pairs)
+    src_ids, trg_ids, counts = counter.result()
+
+    changed = np.unique(new_pairs[0])
+    num_rows = int(changed.max()) + 1 if len(changed) else 0
+    keep = _member_mask(src_ids, changed, num_rows)
+    rows, cols, probs, _ = _s2t_entries(src_ids[keep], trg_ids[keep], counts[keep], num_rows)
+    mems2t = mems2t.replace_rows(changed, LexicalTable.from_entries(num_rows, rows, cols, probs))
+
+    changed = np.unique(new_pairs[1])
+    num_rows = int(changed.max()) + 1 if len(changed) else 0
+    keep = _member_mask(trg_ids, changed, num_rows)
+    rows, cols, probs = _t2s_entries(src_ids[keep], trg_ids[keep], counts[keep], num_rows)
+    memt2s = memt2s.replace_rows(changed, LexicalTable.from_entries(num_rows, rows, cols, probs))
+    return mems2t, memt2s, (src_ids, trg_ids, counts)
+
+
+def prune_table(table, top_k=0, min_prob=0.0, renormalize=False):
+    """Drop the rare entries of a lexical table.
+
+    Args:
+        table: a LexicalTable.
+        top_k: if positive, keep the top_k most probable entries of each row (ties kept in row order).
+        min_prob: drop the entries whose probability is below min_prob.
+        renormalize: if true, rescale the kept probabilities of each row to sum up to 1.
+
+    Returns:
+        The pruned LexicalTable; the kept entries of a row stay in their order.
+    """
+    num_entries = len(table.indices)
+    entry_rows = np.repeat(np.arange(len(table)), np.diff(table.indptr))
+    probs = np.asarray(table.probs)
+    keep = probs >= min_prob
+    if top_k > 0:
+        order = np.lexsort((np.arange(num_entries), -probs, entry_rows))
+        rank = np.empty((num_entries,), dtype=np.int64)
+        rank[order] = np.arange(num_entries) - table.indptr[entry_rows[order]]
+        keep &= rank < top_k
+    rows, probs = entry_rows[keep], probs[keep]
+    if renormalize:
+        totals = np.bincount(rows, weights=probs, minlength=len(table))
+        totals[totals == 0] = 1.0
+        probs = probs / totals[rows]
+    return LexicalTable.from_entries(len(table), rows, table.indices[keep], probs)
+
+
+def table_nbytes(table):
+    """Returns the size of the arrays of a table in bytes."""
+    return sum(getattr(table, name).nbytes for name in _TABLE_ARRAYS)
+
+
+def fill_memory(mems2t, source_ids, capacity):
+    """Select the target words in the memory of a source sentence.
+
+    In the first loop, add the most possible target word of each source word in the source sentence;
+    in the second loop, add the second possible target word, ... up to MEM_CANDIDATES loops.
+    EOS and UNK are never added, and each target word is added once.
+
+    Args:
+        mems2t: the source to target memory.
+        source_ids: the token-ids of the source sentence, read up to the first EOS.
+        capacity: the maximum number of target words in memory.
+
+    Returns:
+        The list of the target ids in memory.
+    """
+    candidates = []
+    for sid in source_ids:
+        if sid == data_utils.EOS_ID:
+            break
+        candidates.append(mems2t.row(sid)[0])
+    id_set = set()  # record the target ids in memory
+    ids = []
+    loop = 0
+    while len(ids) < capacity and loop < MEM_CANDIDATES:
+        for candidate in candidates:
+            if len(candidate) <= loop:
                 continue
-            if int(en_word) not in mem:
-                mem[int(en_word)] = []
-            mem[int(en_word)].append(int(zh_word))
+            k = int(candidate[loop])
+            if k not in id_set and k != data_utils.EOS_ID and k != data_utils.UNK_ID:
+                id_set.add(k)
+                ids.append(k)
+                if len(ids) == capacity:
+                    break
+        loop += 1
+    return ids
+
+
+def get_shortlist(mems2t, source_ids, top_n, num_frequent):
+    """The target words considered when decoding a source sentence with a shortlist.
+
+    Args:
+        mems2t: the source to target memory.
+        source_ids: the token-ids of the source sentence.
+        top_n: the number of candidates of each source word taken from mems2t.
+        num_frequent: the number of most frequent target words always included; the vocabularies are
+            sorted by frequency, so they are the ids below num_frequent. The special symbols are always included.
+
+    Returns:
+        A sorted int32 numpy array of target ids.
+    """
+    ids = [np.arange(max(num_frequent, data_utils.NULL_ID + 1))]
+    for sid in source_ids:
+        ids.append(mems2t.row(sid)[0][:top_n])
+    return np.unique(np.concatenate(ids)).astype(np.int32)
+
+
+def merge_shortlists(shortlists):
+    """Merge the shortlists of the sentences of a batch, which are decoded together.
+
+    Args:
+        shortlists: a list of sorted int32 numpy arrays of target ids, one for each sentence, from get_shortlist.
+
+    Returns:
+        A pair (ids, mask): the sorted union of the shortlists, and a float32 numpy array
+        [number of sentences x len(ids)] which is 1 for the ids in the shortlist of each sentence, so
+        that each sentence is decoded over its own shortlist whatever the other sentences of the batch.
+    """
+    ids = np.unique(np.concatenate(shortlists)).astype(np.int32)
+    mask = np.zeros([len(shortlists), len(ids)], dtype=np.float32)
+    for i, shortlist in enumerate(shortlists):
+        mask[i, np.searchsorted(ids, shortlist)] = 1.0
+    return ids, mask
+
+
+def check_memories(full, pruned, sentences_path, num_sentences):
+    """Compare the memories fill_memory selects with the full and the pruned mems2t for the first
+    num_sentences source sentences. Returns the number of sentences whose memory differs."""
+    differ = 0
+    with open(sentences_path) as f:
+        for line in itertools.islice(f, num_sentences):
+            source_ids = [int(x) for x in line.split()]
+            # the memory at the largest capacity; smaller capacities only truncate it
+            capacity = MEM_CANDIDATES * len(source_ids)
+            if fill_memory(full, source_ids, capacity) != fill_memory(pruned, source_ids, capacity):
+                differ += 1
+    return differ
+
+
+def convert_pickles(mems2t_path, memt2s_path):
+    """Convert memories in the former pickle format into LexicalTables.
+
+    mems2t.pkl is a dict {source id: [(target id, probability), ...]} sorted by decreasing probability and
+    memt2s.pkl a dict {target id: {source id: probability}}; both may come from any bilingual dictionary.
+
+    Returns:
+        The pair (mems2t, memt2s) of LexicalTables.
+    """
+    f = open(mems2t_path, 'rb')
+    mem = pkl.load(f)
+    f.close()
+    entries = [(sid, tid, p) for sid in mem for tid, p in mem[sid]]
+    rows, cols, probs = [np.array(x) for x in zip(*entries)]
+    mems2t = LexicalTable.from_entries(max(mem) + 1, rows.astype(np.int64), cols, probs)
+
+    f = open(memt2s_path, 'rb')
+    mem = pkl.load(f)
+    f.close()
+    entries = [(tid, sid, p) for tid in mem for sid, p in sorted(mem[tid].items())]
+    rows, cols, probs = [np.array(x) for x in zip(*entries)]
+    memt2s = LexicalTable.from_entries(max(mem) + 1, rows.astype(np.int64), cols, probs)
+    return mems2t, memt2s
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the lexical memories of MNMT from a word-aligned corpus.")
+    parser.add_argument("--data_dir", default="./data", help="Data directory.")
+    parser.add_argument("--vocab_size", type=int, default=30000, help="Vocabulary size of the token-id files.")
+    parser.add_argument("--convert", action="store_true",
+                        help="Convert mems2t.pkl and memt2s.pkl in data_dir instead of building from alignments.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes counting the aligned pairs of the corpus shards.")
+    parser.add_argument("--update", nargs=3, metavar=("SRC_IDS", "TRG_IDS", "ALIGNS"),
+                        help="Fold new token-ids and alignment files into the memories in data_dir, using the "
+                             "counts saved in mem_counts.npz; only the rows whose counts change are rebuilt.")
+    parser.add_argument("--s2t_top_k", type=int, default=0,
+                        help="Keep the top k target words of each source word in mems2t; 0 keeps all. "
+                             "MNMT reads at most %d of them." % MEM_CANDIDATES)
+    parser.add_argument("--t2s_top_k", type=int, default=0,
+                        help="Keep the top k source words of each target word in memt2s; 0 keeps all.")
+    parser.add_argument("--t2s_min_prob", type=float, default=0.0,
+                        help="Drop the memt2s entries with a smaller probability.")
+    parser.add_argument("--renormalize", action="store_true",
+                        help="Renormalize the probabilities of the pruned rows to sum up to 1.")
+    parser.add_argument("--check_sentences", type=int, default=10000,
+                        help="Number of training sentences whose memory is checked after pruning mems2t.")
+    args = parser.parse_args()
+    counts_path = os.path.join(args.data_dir, "mem_counts.npz")
+
+    pairs = None
+    if args.convert:
+        mems2t, memt2s = convert_pickles(os.path.join(args.data_dir, "mems2t.pkl"),
+                                         os.path.join(args.data_dir, "memt2s.pkl"))
+    elif args.update:
+        if not os.path.exists(counts_path):
+            raise ValueError("%s not found; build the memories from the whole corpus first." % counts_path)
+        new_pairs = count_aligned_pairs_parallel(args.update[0], args.update[1], args.update[2], args.workers)
+        mems2t, memt2s, pairs = update_memories(LexicalTable.load(os.path.join(args.data_dir, "mems2t"), None),
+                                                LexicalTable.load(os.path.join(args.data_dir, "memt2s"), None),
+                                                load_counts(counts_path), new_pairs)
+        print("Updated %d rows of mems2t and %d rows of memt2s."
+              % (len(np.unique(new_pairs[0])), len(np.unique(new_pairs[1]))))
+    else:
+        pairs = count_aligned_pairs_parallel(os.path.join(args.data_dir, "train.ids%d.src" % args.vocab_size),
+                                             os.path.join(args.data_dir, "train.ids%d.trg" % args.vocab_size),
+                                             os.path.join(args.data_dir, "aligns"), args.workers)
+        mems2t = get_mem_s2t(pairs[0], pairs[1], pairs[2],
+                             os.path.join(args.data_dir, "vocab%d.src" % args.vocab_size),
+                             os.path.join(args.data_dir, "vocab%d.trg" % args.vocab_size))
+        memt2s = get_mem_t2s(*pairs)
+    if pairs is not None:
+        save_counts(counts_path, *pairs)
 
-    for m in mem:
-        l = float(len(mem[m]))
-        words = Counter(mem[m])
-        mem[m] = {w: words[w] / l for w in words}
+    if args.s2t_top_k > 0:
+        pruned = prune_table(mems2t, top_k=args.s2t_top_k, renormalize=args.renormalize)
+        print("mems2t: %d -> %d entries, %d -> %d bytes."
+              % (len(mems2t.indices), len(pruned.indices), table_nbytes(mems2t), table_nbytes(pruned)))
+        sentences_path = os.path.join(args.data_dir, "train.ids%d.src" % args.vocab_size)
+        if os.path.exists(sentences_path):
+            differ = check_memories(mems2t, pruned, sentences_path, args.check_sentences)
+            print("The memories of %d of the first %d training sentences changed."
+                  % (differ, args.check_sentences))
+        mems2t = pruned
+    if args.t2s_top_k > 0 or args.t2s_min_prob > 0:
+        pruned = prune_table(memt2s, top_k=args.t2s_top_k, min_prob=args.t2s_min_prob,
+                             renormalize=args.renormalize)
+        print("memt2s: %d -> %d entries, %d -> %d bytes."
+              % (len(memt2s.indices), len(pruned.indices), table_nbytes(memt2s), table_nbytes(pruned)))
+        memt2s = pruned
 
-    f = open("./data/memt2s.pkl", 'wb')
-    pkl.dump(mem, f)
+    mems2t.save(os.path.join(args.data_dir, "mems2t"))
+    memt2s.save(os.path.join(args.data_dir, "memt2s"))
 
 if __name__ == '__main__':
-    get_mem_s2t()
-    get_mem_t2s()
+    main()
@@ -19,7 +19,8 @@ else
             then
                 echo "Testing a NMT checkpoint 'translate.ckpt-nmt'..."
                 cp ./models/translate.ckpt-nmt ./NMT/train/
-                python ./NMT/translate.py --model translate.ckpt-nmt  --decode --beam_size 12 < ./data/test.src > res
+                python ./NMT/translate.py --model translate.ckpt-nmt  --decode --beam_size 12 \
+                    --decode_input ./data/test.src --decode_output res --decode_batch_size 32
                 perl multi-bleu.perl ./data/test.trg < res
             fi
         elif [ $model == "mnmt" ]
@@ -35,7 +36,8 @@ else
             then
                 echo "Testing a MNMT checkpoint 'translate.ckpt-mnmt'..."
                 cp ./models/translate.ckpt-mnmt ./MNMT/train/
-                python ./MNMT/translate.py --model2 translate.ckpt-mnmt --decode --beam_size 12 < ./data/test.src > res
+                python ./MNMT/translate.py --model2 translate.ckpt-mnmt --decode --beam_size 12 \
+                    --decode_input ./data/test.src --decode_output res --decode_batch_size 32
                 perl multi-bleu.perl ./data/test.trg < res
             fi
         fi
@@ -0,0 +1,157 @@
+# Copyright 2017, Center of Speech and Language of Tsinghua University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Decode a file with several processes, each running NMT/translate.py or MNMT/translate.py with its
+own session on a shard of the input, and merge the translations in the input order.
+
+    python shard_decode.py --workers 4 --intra_op_threads 2 --input ./data/test.src --output res \
+        NMT/translate.py --model translate.ckpt-nmt --decode --beam_size 12 --decode_batch_size 8
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from six.moves import xrange
+
+_SPEED = re.compile(r"Translated \d+ sentences in .*")
+
+
+def split_lines(lines, num_shards, by_length=False):
+    """Returns the line numbers of each shard.
+
+    Args:
+        lines: the input lines.
+        num_shards: the number of shards.
+        by_length: if set, the longest lines are assigned first, each to the shard with the fewest
+            tokens, so that the shards take about as long to translate; otherwise the lines are
+            dealt round-robin.
+    """
+    shards = [[] for _ in xrange(num_shards)]
+    if not by_length:
+        for k in xrange(len(lines)):
+            shards[k % num_shards].append(k)
+        return shards
+    tokens = [0] * num_shards
+    for k in sorted(xrange(len(lines)), key=lambda k: -len(lines[k].split())):
+        shard = tokens.index(min(tokens))
+        shards[shard].append(k)
+        tokens[shard] += len(lines[k].split()) + 1
+    return [sorted(shard) for shard in shards]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode a file with several translate.py processes.")
+    parser.add_argument("--workers", type=int, default=2, help="Number of decoding processes.")
+    parser.add_argument("--intra_op_threads", type=int, default=1,
+                        help="Number of threads of the session of each process within an op.")
+    parser.add_argument("--split", choices=("round_robin", "length"), default="length",
+                        help="Deal the lines round-robin, or balance the number of tokens of the shards.")
+    parser.add_argument("--input", default="", help="The file to translate; default is stdin.")
+    parser.add_argument("--output", default="", help="The file of the translations; default is stdout.")
+    parser.add_argument("--work_dir", default="",
+                        help="Keep the shards, their translations and the logs of the workers in this directory; "
+                             "default is a temporary directory which is removed.")
+    parser.add_argument("script", help="NMT/translate.py or MNMT/translate.py.")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="The decoding arguments of the script.")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            lines = f.readlines()
+    else:
+        lines = sys.stdin.readlines()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="shard_decode")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    shards = split_lines(lines, args.workers, args.split == "length")
+    workers = []
+    start_time = time.time()
+    for i, shard in enumerate(shards):
+        if not shard:
+            continue
+        input_path = os.path.join(work_dir, "shard%d.src" % i)
+        output_path = os.path.join(work_dir, "shard%d.trg" % i)
+        log_path = os.path.join(work_dir, "shard%d.log" % i)
+        with open(input_path, "w") as f:
+            f.writelines(lines[k] if lines[k].endswith("\n") else lines[k] + "\n" for k in shard)
+        command = [sys.executable, args.script] + args.args + [
+            "--decode", "--decode_input", input_path, "--decode_output", output_path,
+            "--intra_op_threads", str(args.intra_op_threads)]
+        log = open(log_path, "w")
+        workers.append((i, shard, output_path, log_path, log, subprocess.Popen(command, stdout=log, stderr=log)))
+
+    # Wait for the workers, and report the throughput of each, with and without loading its model.
+    translations = [None] * len(lines)
+    failed = False
+    pending = list(workers)
+    while pending and not failed:
+        time.sleep(0.5)
+        for worker in list(pending):
+            i, shard, output_path, log_path, log, process = worker
+            if process.poll() is None:
+                continue
+            pending.remove(worker)
+            log.close()
+            elapsed = time.time() - start_time
+            with open(log_path) as f:
+                speed = _SPEED.findall(f.read())
+            if process.returncode != 0:
+                failed = True
+                sys.stderr.write("Worker %d failed with code %d, see %s\n" % (i, process.returncode, log_path))
+                break
+            tokens = sum(len(lines[k].split()) for k in shard)
+            sys.stderr.write("Worker %d: %d sentences in %.1fs with loading, %.2f sentences/s, %.1f source tokens/s; "
+                             "%s\n" % (i, len(shard), elapsed, len(shard) / elapsed, tokens / elapsed,
+                                       speed[-1] if speed else "no speed reported"))
+            with open(output_path) as f:
+                for k, translation in zip(shard, f):
+                    translations[k] = translation
+    # The translation of the whole input is lost when a worker fails, so the others are stopped.
+    for i, _, _, _, log, process in pending:
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+            sys.stderr.write("Worker %d terminated\n" % i)
+        log.close()
+    if not failed and None in translations:
+        failed = True
+        sys.stderr.write("%d lines have no translation\n" % translations.count(None))
+    if failed:
+        sys.stderr.write("The shards are kept in %s\n" % work_dir)
+        sys.exit(1)
+
+    elapsed = time.time() - start_time
+    sys.stderr.write("Translated %d sentences with %d workers in %.1fs: %.2f sentences/s\n"
+                     % (len(lines), len(workers), elapsed, len(lines) / max(elapsed, 1e-6)))
+    output = open(args.output, "w") if args.output else sys.stdout
+    output.writelines(translations)
+    if args.output:
+        output.close()
+    if not args.work_dir:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# Copyright 2017, Center of Speech and Language of Tsinghua University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests of the lexical memories built by mem.py."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+import numpy as np
+from six.moves import xrange
+
+import data_utils
+import mem
+
+# Word ids of the toy corpus start after the special symbols.
+_FIRST_ID = data_utils.NULL_ID + 1
+
+
+def _write_corpus(tmpdir, num_lines, seed=0, vocab_size=20):
+    """Write a random word-aligned corpus of token ids, with some UNK words, and return its three paths."""
+    rng = np.random.RandomState(seed)
+    src_lines, trg_lines, align_lines = [], [], []
+    for _ in xrange(num_lines):
+        src = rng.randint(data_utils.UNK_ID, vocab_size, size=rng.randint(1, 8))
+        trg = rng.randint(data_utils.UNK_ID, vocab_size, size=rng.randint(1, 8))
+        links = set((rng.randint(len(src)), rng.randint(len(trg))) for _ in xrange(rng.randint(0, 6)))
+        src_lines.append(" ".join(str(i) for i in src))
+        trg_lines.append(" ".join(str(i) for i in trg))
+        align_lines.append(" ".join("%d-%d" % link for link in sorted(links)))
+    paths = []
+    for name, lines in (("src", src_lines), ("trg", trg_lines), ("align", align_lines)):
+        path = tmpdir.join(name)
+        path.write("\n".join(lines) + "\n")
+        paths.append(str(path))
+    return paths
+
+
+def _write_vocab(tmpdir, vocab_size=20):
+    path = tmpdir.join("vocab")
+    path.write_binary(b"\n".join(data_utils._START_VOCAB +
+                                 [("w%d" % i).encode("ascii") for i in xrange(_FIRST_ID, vocab_size)]) + b"\n")
+    return str(path)
+
+
+def _naive_counts(src_path, trg_path, align_path):
+    """Count the aligned pairs without UNK with a Counter."""
+    counts = collections.Counter()
+    with open(src_path) as slines, open(trg_path) as tlines, open(align_path) as mlines:
+        for sline, tline, mline in zip(slines, tlines, mlines):
+            src, trg = sline.split(), tline.split()
+            for link in mline.split():
+                i, j = link.split("-")
+                pair = int(src[int(i)]), int(trg[int(j)])
+                if data_utils.UNK_ID not in pair:
+                    counts[pair] += 1
+    return counts
+
+
+def _as_counter(pairs):
+    src_ids, trg_ids, counts = pairs
+    return collections.Counter(dict(((int(s), int(t)), int(c)) for s, t, c in zip(src_ids, trg_ids, counts)))
+
+
+def test_pair_counter_merges_flushes():
+    counter = mem.PairCounter(flush_size=3)
+    counter.add([5, 6, 5], [7, 7, 7])
+    counter.add([5, 8], [7, 9], counts=[2, 4])
+    counter.add([6], [7])
+    src_ids, trg_ids, counts = counter.result()
+    assert list(zip(src_ids, trg_ids, counts)) == [(5, 7, 4), (6, 7, 2), (8, 9, 4)]
+
+
+def test_count_aligned_pairs_skips_unk(tmpdir):
+    paths = _write_corpus(tmpdir, 50)
+    assert _as_counter(mem.count_aligned_pairs(*paths)) == _naive_counts(*paths)
+
+
+def test_memories_are_normalized_and_sorted(tmpdir):
+    paths = _write_corpus(tmpdir, 50)
+    src_ids, trg_ids, counts = mem.count_aligned_pairs(*paths)
+    memt2s = mem.get_mem_t2s(src_ids, trg_ids, counts)
+    for t in xrange(len(memt2s)):
+        indices, probs = memt2s.row(t)
+        if len(indices):
+            assert np.all(np.diff(indices) > 0)
+            assert np.isclose(probs.sum(), 1.0)
+
+    vocab_path = _write_vocab(tmpdir)
+    mems2t = mem.get_mem_s2t(src_ids, trg_ids, counts, vocab_path, vocab_path)
+    aligned = set(int(s) for s in src_ids)
+    for s in xrange(len(mems2t)):
+        indices, probs = mems2t.row(s)
+        if s in aligned:
+            assert np.all(np.diff(probs) <= 0)
+            assert np.isclose(probs.sum(), 1.0)
+        else:
+            # the special symbols and the unaligned words map to themselves or to _NULL
+            assert len(indices) == 2 and indices[1] == data_utils.NULL_ID
+
+
+def _toy_table():
+    # row 0: empty; row 1: 3 entries; row 2: 1 entry; row 3: empty
+    return mem.LexicalTable.from_entries(4, np.array([1, 2, 1, 1]), np.array([9, 4, 2, 6]),
+                                         np.array([0.5, 1.0, 0.3, 0.2]))
+
+
+def test_table_npy_round_trip(tmpdir):
+    table = _toy_table()
+    prefix = str(tmpdir.join("mems2t"))
+    table.save(prefix)
+    for mmap_mode in ("r", None):
+        loaded = mem.LexicalTable.load(prefix, mmap_mode=mmap_mode)
+        assert len(loaded) == len(table)
+        for name in ("indptr", "indices", "probs"):
+            assert getattr(loaded, name).dtype == getattr(table, name).dtype
+            assert np.array_equal(getattr(loaded, name), getattr(table, name))
+    assert isinstance(mem.LexicalTable.load(prefix).probs, np.memmap)
+
+
+def test_table_rows_keep_entry_order():
+    table = _toy_table()
+    assert list(table.row(1)[0]) == [9, 2, 6]
+    assert list(table.row(2)[0]) == [4]
+    assert len(table.row(0)[0]) == 0 and len(table.row(3)[0]) == 0
+    # rows past the end are empty
+    assert len(table.row(10)[0]) == 0
+
+
+def test_table_lookup():
+    # lookup needs sorted rows, as in memt2s
+    table = mem.LexicalTable.from_entries(3, np.array([1, 1, 1, 2]), np.array([2, 6, 9, 4]),
+                                          np.array([0.3, 0.2, 0.5, 1.0]))
+    assert np.allclose(table.lookup(1, [9, 2, 3, 6, 10, 0]), [0.5, 0.3, 0.0, 0.2, 0.0, 0.0])
+    assert np.allclose(table.lookup(2, [4, 5]), [1.0, 0.0])
+    # empty rows, and rows past the end, give zeros of the shape of ids
+    assert np.array_equal(table.lookup(0, [1, 2]), [0.0, 0.0])
+    assert table.lookup(7, np.array([[1, 2]])).shape == (1, 2)
+    assert table.lookup(1, [2]).dtype == np.float32
+
+
+def test_split_shards_cover_all_lines(tmpdir):
+    paths = _write_corpus(tmpdir, 10)
+    for num_shards in (1, 3, 10, 12):
+        shards = mem.split_shards(paths, num_shards)
+        assert len(shards) == num_shards
+        assert sum(num_lines for _, num_lines in shards) == 10
+        with open(paths[0], "rb") as f:
+            first_lines = [f.readline() for _ in xrange(10)]
+        line = 0
+        for offsets, num_lines in shards:
+            if num_lines:
+                with open(paths[0], "rb") as f:
+                    f.seek(offsets[0])
+                    assert f.readline() == first_lines[line]
+            line += num_lines
+
+
+def test_parallel_counts_equal_serial(tmpdir):
+    paths = _write_corpus(tmpdir, 200, seed=1)
+    serial = mem.count_aligned_pairs(*paths)
+    for num_workers in (2, 3, 7):
+        parallel = mem.count_aligned_pairs_parallel(paths[0], paths[1], paths[2], num_workers)
+        for serial_array, parallel_array in zip(serial, parallel):
+            assert np.array_equal(serial_array, parallel_array)
+
+
+def _assert_same_table(a, b):
+    assert len(a) == len(b)
+    for i in xrange(len(a)):
+        a_indices, a_probs = a.row(i)
+        b_indices, b_probs = b.row(i)
+        assert np.array_equal(a_indices, b_indices), i
+        assert np.allclose(a_probs, b_probs), i
+
+
+def test_update_memories_equals_recounting(tmpdir):
+    vocab_path = _write_vocab(tmpdir)
+    old_paths = _write_corpus(tmpdir.mkdir("old"), 100, seed=2)
+    new_paths = _write_corpus(tmpdir.mkdir("new"), 30, seed=3)
+    old_pairs = mem.count_aligned_pairs(*old_paths)
+    new_pairs = mem.count_aligned_pairs(*new_paths)
+    mems2t = mem.get_mem_s2t(old_pairs[0], old_pairs[1], old_pairs[2], vocab_path, vocab_path)
+    memt2s = mem.get_mem_t2s(*old_pairs)
+
+    mems2t, memt2s, pairs = mem.update_memories(mems2t, memt2s, old_pairs, new_pairs)
+
+    counter = mem.PairCounter()
+    counter.add(*old_pairs)
+    counter.add(*new_pairs)
+    all_pairs = counter.result()
+    for merged, recounted in zip(pairs, all_pairs):
+        assert np.array_equal(merged, recounted)
+    _assert_same_table(mems2t, mem.get_mem_s2t(all_pairs[0], all_pairs[1], all_pairs[2], vocab_path, vocab_path))
+    _assert_same_table(memt2s, mem.get_mem_t2s(*all_pairs))
+
+
+def test_update_memories_adds_new_words(tmpdir):
+    old_pairs = (np.array([5, 5]), np.array([6, 7]), np.array([1, 3]))
+    new_pairs = (np.array([9]), np.array([12]), np.array([2]))
+    memt2s = mem.get_mem_t2s(*old_pairs)
+    mems2t = mem.LexicalTable.from_entries(6, np.array([5, 5]), np.array([7, 6]), np.array([0.75, 0.25]))
+    mems2t, memt2s, _ = mem.update_memories(mems2t, memt2s, old_pairs, new_pairs)
+    assert len(mems2t) == 10 and len(memt2s) == 13
+    assert list(mems2t.row(5)[0]) == [7, 6]
+    assert list(mems2t.row(9)[0]) == [12] and np.allclose(mems2t.row(9)[1], [1.0])
+    assert list(memt2s.row(12)[0]) == [9]
+
+
+def _pruning_table():
+    # row 0: 4 entries with a tie; row 1: empty; row 2: 2 entries
+    return mem.LexicalTable.from_entries(3, np.array([0, 0, 0, 0, 2, 2]), np.array([10, 11, 12, 13, 20, 21]),
+                                         np.array([0.4, 0.1, 0.4, 0.1, 0.05, 0.95]))
+
+
+def test_prune_table_top_k():
+    pruned = mem.prune_table(_pruning_table(), top_k=2)
+    # the kept entries stay in row order, ties are broken by position
+    assert list(pruned.row(0)[0]) == [10, 12]
+    assert len(pruned.row(1)[0]) == 0
+    assert list(pruned.row(2)[0]) == [20, 21]
+    assert list(mem.prune_table(_pruning_table(), top_k=3).row(0)[0]) == [10, 11, 12]
+    assert list(mem.prune_table(_pruning_table(), top_k=1).row(2)[0]) == [21]
+
+
+def test_prune_table_min_prob():
+    pruned = mem.prune_table(_pruning_table(), min_prob=0.1)
+    assert list(pruned.row(0)[0]) == [10, 11, 12, 13]
+    assert list(pruned.row(2)[0]) == [21]
+    assert np.allclose(pruned.row(2)[1], [0.95])
+
+
+def test_prune_table_top_k_and_min_prob_renormalized():
+    pruned = mem.prune_table(_pruning_table(), top_k=3, min_prob=0.2, renormalize=True)
+    assert list(pruned.row(0)[0]) == [10, 12]
+    assert np.allclose(pruned.row(0)[1], [0.5, 0.5])
+    assert list(pruned.row(2)[0]) == [21]
+    assert np.allclose(pruned.row(2)[1], [1.0])
+    assert len(pruned) == 3 and pruned.indptr[-1] == 3
+
+
+def test_merge_shortlists_masks_each_sentence_to_its_own():
+    shortlists = [np.array([0, 1, 2, 7], dtype=np.int32), np.array([0, 1, 2, 5, 9], dtype=np.int32)]
+    ids, mask = mem.merge_shortlists(shortlists)
+    assert list(ids) == [0, 1, 2, 5, 7, 9]
+    assert mask.shape == (2, 6)
+    for shortlist, row in zip(shortlists, mask):
+        assert list(ids[row > 0]) == list(shortlist)
+    # the mask of a sentence does not depend on the other sentences of the batch
+    alone_ids, alone_mask = mem.merge_shortlists(shortlists[:1])
+    assert list(alone_ids[alone_mask[0] > 0]) == list(ids[mask[0] > 0])
@@ -0,0 +1,52 @@
+# Copyright 2017, Center of Speech and Language of Tsinghua University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests of the splitting of the input of shard_decode.py."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shard_decode
+
+
+def _lines(lengths):
+    return [" ".join("w%d" % k for k in range(length)) + "\n" for length in lengths]
+
+
+def test_split_lines_round_robin():
+    shards = shard_decode.split_lines(_lines([1] * 7), 3)
+    assert shards == [[0, 3, 6], [1, 4], [2, 5]]
+
+
+def test_split_lines_by_length_covers_every_line_once():
+    lines = _lines([5, 1, 9, 3, 3, 7, 2, 8, 4])
+    shards = shard_decode.split_lines(lines, 3, by_length=True)
+    assert sorted(k for shard in shards for k in shard) == list(range(len(lines)))
+    for shard in shards:
+        assert shard == sorted(shard)
+
+
+def test_split_lines_by_length_balances_tokens():
+    # round-robin would give all the long lines to the first shard
+    lines = _lines([10, 1, 10, 1, 10, 1, 10, 1])
+    shards = shard_decode.split_lines(lines, 2, by_length=True)
+    tokens = [sum(len(lines[k].split()) for k in shard) for shard in shards]
+    assert tokens == [22, 22]
+    round_robin = shard_decode.split_lines(lines, 2)
+    assert [sum(len(lines[k].split()) for k in shard) for shard in round_robin] == [40, 4]
+
+
+def test_split_lines_more_shards_than_lines():
+    shards = shard_decode.split_lines(_lines([2, 3]), 4, by_length=True)
+    assert sorted(len(shard) for shard in shards) == [0, 0, 1, 1]
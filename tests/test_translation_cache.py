@@ -0,0 +1,171 @@
+# Copyright 2017, Center of Speech and Language of Tsinghua University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests of the translation cache and fuzzy memory of translation_cache.py."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import translation_cache
+
+
+def _write(path, content):
+    with open(str(path), "wb") as f:
+        f.write(content)
+
+
+def test_checkpoint_patterns_exclude_longer_steps(tmpdir):
+    """The fingerprint of ckpt-1000 depends on its own files only, not on those of ckpt-10000."""
+    for step in ("1000", "10000"):
+        for suffix in (".index", ".data-00000-of-00001", ".meta"):
+            _write(tmpdir.join("ckpt-" + step + suffix), b"step " + step.encode("utf-8"))
+    patterns = translation_cache.checkpoint_patterns(str(tmpdir.join("ckpt-1000")))
+    before = translation_cache.fingerprint(patterns)
+
+    _write(tmpdir.join("ckpt-10000.data-00000-of-00001"), b"other variables")
+    _write(tmpdir.join("ckpt-10000.meta"), b"other graph")
+    assert translation_cache.fingerprint(patterns) == before
+
+    _write(tmpdir.join("ckpt-1000.data-00000-of-00001"), b"new variables")
+    assert translation_cache.fingerprint(patterns) != before
+
+
+def test_checkpoint_patterns_match_old_checkpoints(tmpdir):
+    """A TensorFlow 0.10 checkpoint is the file at the path itself plus its .meta graph."""
+    _write(tmpdir.join("ckpt-1000"), b"variables")
+    _write(tmpdir.join("ckpt-1000.meta"), b"graph")
+    patterns = translation_cache.checkpoint_patterns(str(tmpdir.join("ckpt-1000")))
+    before = translation_cache.fingerprint(patterns)
+
+    _write(tmpdir.join("ckpt-1000"), b"new variables")
+    assert translation_cache.fingerprint(patterns) != before
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = translation_cache.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # b is now the least recently used
+    cache.put("c", 3)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_translation_cache_clears_shelve_of_other_fingerprint(tmpdir):
+    path = str(tmpdir.join("translations"))
+    cache = translation_cache.TranslationCache("model-a", 10, path)
+    cache.put([4, 5, 6], "a translation")
+    cache.close()
+
+    cache = translation_cache.TranslationCache("model-a", 10, path)
+    assert cache.get([4, 5, 6]) == "a translation"
+    cache.close()
+
+    cache = translation_cache.TranslationCache("model-b", 10, path)
+    assert cache.get([4, 5, 6]) is None
+    cache.close()
+
+    # the translations of model-a were removed from the file, not only hidden by the key
+    cache = translation_cache.TranslationCache("model-a", 10, path)
+    assert cache.get([4, 5, 6]) is None
+    cache.close()
+
+
+def test_edit_distance():
+    assert translation_cache.edit_distance([1, 2, 3], [1, 2, 3]) == 0
+    assert translation_cache.edit_distance([1, 2, 3], [1, 3]) == 1
+    assert translation_cache.edit_distance([1, 2, 3, 4, 5], [6, 7, 8, 9, 10]) == 5
+    assert translation_cache.edit_distance([1, 2, 3], [1, 3], max_distance=2) == 1
+
+
+def test_edit_distance_stops_above_max_distance():
+    # the lengths alone differ by more than max_distance
+    assert translation_cache.edit_distance([1], [1, 2, 3, 4], max_distance=1) == 2
+    # every row of the table is above max_distance long before the end
+    assert translation_cache.edit_distance([1, 2, 3, 4, 5], [6, 7, 8, 9, 10], max_distance=2) == 3
+    assert translation_cache.edit_distance([1, 2, 3], [4, 5, 6], max_distance=0) == 1
+
+
+def test_fuzzy_memory_lookup_honours_threshold_and_max_edits():
+    stored = list(range(10, 20))
+    near = stored[:-1] + [99]  # one substitution, similarity 0.9
+
+    memory = translation_cache.FuzzyMemory("model", threshold=0.8, max_edits=1)
+    memory.add(stored, "translation")
+    memory.add([10, 11], "short translation")
+    assert memory.lookup(near) == ("translation", 0.9)
+    # one word added to the two-word sentence is within max_edits but below the threshold
+    assert memory.lookup([10, 11, 12]) is None
+
+    memory = translation_cache.FuzzyMemory("model", threshold=0.95, max_edits=1)
+    memory.add(stored, "translation")
+    assert memory.lookup(near) is None
+
+    memory = translation_cache.FuzzyMemory("model", threshold=0.5, max_edits=1)
+    memory.add(stored, "translation")
+    assert memory.lookup(stored[:-2] + [98, 99]) is None  # similarity 0.8, but two edits
+    assert (memory.hits, memory.misses) == (0, 1)
+
+
+class _CountingList(list):
+    """A posting list which counts the sentence ids read from it."""
+
+    read = [0]
+
+    def __iter__(self):
+        _CountingList.read[0] += len(self)
+        return list.__iter__(self)
+
+
+def _postings_read(num_shared):
+    """Returns the number of sentence ids read by a lookup, and its result, when num_shared stored sentences
+    end with the same bigram as the input."""
+    memory = translation_cache.FuzzyMemory("model", threshold=0.8, max_edits=1, max_postings=20)
+    memory.add([1, 2, 3, 4, 5, 6, 7, 8, 90, 2], "translation")
+    for k in range(num_shared):
+        memory.add([100 + 3 * k, 101 + 3 * k, 102 + 3 * k, 90, 2], "filler %d" % k)
+    for ngram, postings in memory._index.items():
+        memory._index[ngram] = _CountingList(postings)
+    _CountingList.read[0] = 0
+    result = memory.lookup([1, 2, 3, 4, 5, 6, 7, 9, 90, 2])
+    return _CountingList.read[0], result
+
+
+def test_fuzzy_memory_lookup_skips_frequent_ngrams():
+    """The cost of a lookup does not grow with the number of sentences sharing a frequent n-gram."""
+    read, result = _postings_read(50)
+    assert result == ("translation", 0.9)
+    assert _postings_read(5000) == (read, result)
+    assert 0 < read < 20
+
+
+def test_beam_margin_changes_fingerprint(tmpdir):
+    """Translations decoded with another beam margin are not served from the cache."""
+    _write(tmpdir.join("ckpt-1000"), b"variables")
+    patterns = translation_cache.checkpoint_patterns(str(tmpdir.join("ckpt-1000")))
+    # beam size, beam margin, length ratio, shortlist top n and frequent words, model sizes
+    settings = (12, 0.0, 1.5, 0, 2000, 500, 1000, 1)
+    with_margin = settings[:1] + (2.0,) + settings[2:]
+    assert translation_cache.fingerprint(patterns, settings) != translation_cache.fingerprint(patterns, with_margin)
+
+    path = str(tmpdir.join("translations"))
+    cache = translation_cache.TranslationCache(translation_cache.fingerprint(patterns, settings), 10, path)
+    cache.put([4, 5, 6], "a translation")
+    cache.close()
+    cache = translation_cache.TranslationCache(translation_cache.fingerprint(patterns, with_margin), 10, path)
+    assert cache.get([4, 5, 6]) is None
+    cache.close()
@@ -0,0 +1,273 @@
+# Copyright 2017, Center of Speech and Language of Tsinghua University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Cache of the translations of source sentences, in front of beam search.
+
+A translation is stored under the token ids of its source sentence and the fingerprint of
+everything else it depends on: the checkpoint files, the memory tables of MNMT and the
+decoding settings such as the beam size. The cache keeps the most recently used translations
+in memory, and optionally all of them in a shelve file, which is emptied when it was written
+with another fingerprint.
+
+LRUCache is the in-memory part, also used by Seq2SeqModel to keep the encoder states of
+recent sentences.
+
+FuzzyMemory also reuses the translation of a previous sentence which differs from the input
+by a few tokens, found through an inverted index of the n-grams of the previous sentences.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import glob
+import hashlib
+import os
+import pickle as pkl
+import shelve
+
+from six.moves import xrange
+
+_FINGERPRINT_KEY = "__fingerprint__"
+
+
+def fingerprint(patterns, settings=()):
+    """Returns a hex digest of the contents of the files matching some glob patterns and of some settings.
+
+    Args:
+        patterns: a list of glob patterns, e.g. the files of a checkpoint from checkpoint_patterns.
+        settings: a sequence of values, such as the beam size, which change the translations.
+    """
+    digest = hashlib.md5()
+    for pattern in patterns:
+        digest.update(pattern.encode("utf-8"))
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+    digest.update(repr(tuple(settings)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def checkpoint_patterns(path):
+    """Returns the glob patterns of the files of the checkpoint saved at path, and of no other checkpoint.
+
+    TensorFlow 0.10 writes the variables to path itself and the graph to path.meta; newer versions
+    write path.index and path.data-*-of-* instead. A pattern such as path + "*" would also match the
+    files of the checkpoint of step 10000 when path is the checkpoint of step 1000.
+    """
+    return [path, path + ".meta", path + ".index", path + ".data-*"]
+
+
+class LRUCache(object):
+    """A dict keeping the capacity most recently used items."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Returns the value of the key, or None."""
+        value = self._items.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        """Store the value of the key, and forget the least recently used items beyond the capacity."""
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+
+class TranslationCache(object):
+    """An LRU cache of translations, optionally backed by a shelve file."""
+
+    def __init__(self, fingerprint, capacity, path=None):
+        """Create the cache.
+
+        Args:
+            fingerprint: the fingerprint of the model and settings, see fingerprint.
+            capacity: the number of translations kept in memory.
+            path: if not empty, the shelve file which stores all translations across runs.
+        """
+        self.fingerprint = fingerprint
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._lru = LRUCache(capacity)
+        self._store = None
+        if path:
+            self._store = shelve.open(path)
+            if self._store.get(_FINGERPRINT_KEY) != fingerprint:
+                # the model or the settings changed since the translations were stored
+                self._store.clear()
+                self._store[_FINGERPRINT_KEY] = fingerprint
+
+    def _key(self, token_ids):
+        return "%s:%s" % (self.fingerprint, " ".join(str(i) for i in token_ids))
+
+    def get(self, token_ids):
+        """Returns the cached translation of the source token ids, or None."""
+        key = self._key(token_ids)
+        translation = self._lru.get(key)
+        if translation is None and self._store is not None:
+            translation = self._store.get(key)
+            if translation is not None:
+                self._lru.put(key, translation)
+        if translation is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return translation
+
+    def put(self, token_ids, translation):
+        """Cache the translation of the source token ids."""
+        key = self._key(token_ids)
+        self._lru.put(key, translation)
+        if self._store is not None:
+            self._store[key] = translation
+
+    def close(self):
+        """Write the shelve file to disk."""
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def report(self):
+        """Returns a line with the hit and miss counts."""
+        lookups = self.hits + self.misses
+        return "Translation cache: %d hits, %d misses (%.1f%% hits), %d translations in memory" % (
+            self.hits, self.misses, 100.0 * self.hits / max(lookups, 1), len(self._lru))
+
+
+def edit_distance(a, b, max_distance=None):
+    """Returns the Levenshtein distance between two sequences of token ids.
+
+    If max_distance is given, any distance above it may be returned as max_distance + 1.
+    """
+    if max_distance is not None and abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(xrange(len(b) + 1))
+    for i in xrange(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in xrange(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class FuzzyMemory(object):
+    """Translations of previous source sentences, looked up by similarity through an n-gram index."""
+
+    def __init__(self, fingerprint, threshold, max_edits, order=2, num_candidates=10, max_postings=1000,
+                 path=None):
+        """Create the memory, and load the sentences stored in path with the same fingerprint.
+
+        Args:
+            fingerprint: the fingerprint of the model and settings, see fingerprint.
+            threshold: the minimum similarity, 1 - edit distance / length of the longer sentence,
+                of a sentence whose translation is reused.
+            max_edits: the maximum edit distance of a sentence whose translation is reused.
+            order: the length of the n-grams of the index.
+            num_candidates: the number of sentences sharing most n-grams with the input that are compared with it.
+            max_postings: n-grams found in more sentences than this, such as (".", EOS), are left out of the
+                index, so that a lookup reads at most max_postings sentence ids per n-gram of the input.
+            path: if not empty, the file the memory is loaded from and saved to.
+        """
+        self.fingerprint = fingerprint
+        self.threshold = threshold
+        self.max_edits = max_edits
+        self.order = order
+        self.num_candidates = num_candidates
+        self.max_postings = max_postings
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.sentences = []
+        self.translations = []
+        self._ids = {}
+        self._index = collections.defaultdict(list)
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                stored_fingerprint, sentences, translations = pkl.load(f)
+            if stored_fingerprint == fingerprint:
+                for token_ids, translation in zip(sentences, translations):
+                    self.add(token_ids, translation)
+
+    def _ngrams(self, token_ids):
+        return set(tuple(token_ids[i:i + self.order]) for i in xrange(max(len(token_ids) - self.order + 1, 1)))
+
+    def add(self, token_ids, translation):
+        """Store the translation of the source token ids."""
+        token_ids = tuple(token_ids)
+        if token_ids in self._ids:
+            self.translations[self._ids[token_ids]] = translation
+            return
+        self._ids[token_ids] = len(self.sentences)
+        for ngram in self._ngrams(token_ids):
+            postings = self._index[ngram]
+            # one id past max_postings marks the n-gram as too frequent to be looked up
+            if len(postings) <= self.max_postings:
+                postings.append(len(self.sentences))
+        self.sentences.append(token_ids)
+        self.translations.append(translation)
+
+    def lookup(self, token_ids):
+        """Returns a pair (translation, similarity) of the most similar stored sentence, or None if no
+        stored sentence is within the threshold and max_edits."""
+        token_ids = tuple(token_ids)
+        shared = collections.Counter()
+        for ngram in self._ngrams(token_ids):
+            postings = self._index.get(ngram, ())
+            if len(postings) <= self.max_postings:
+                shared.update(postings)
+        best, best_similarity = None, self.threshold
+        for k, _ in shared.most_common(self.num_candidates):
+            sentence = self.sentences[k]
+            distance = edit_distance(token_ids, sentence, self.max_edits)
+            if distance > self.max_edits:
+                continue
+            similarity = 1.0 - distance / max(len(token_ids), len(sentence))
+            if similarity >= best_similarity:
+                best, best_similarity = k, similarity
+        if best is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.translations[best], best_similarity
+
+    def save(self):
+        """Write the memory to its path, if any."""
+        if self.path:
+            with open(self.path, "wb") as f:
+                pkl.dump((self.fingerprint, self.sentences, self.translations), f, pkl.HIGHEST_PROTOCOL)
+
+    def report(self):
+        """Returns a line with the hit and miss counts."""
+        lookups = self.hits + self.misses
+        return "Fuzzy memory: %d hits, %d misses (%.1f%% hits), %d sentences" % (
+            self.hits, self.misses, 100.0 * self.hits / max(lookups, 1), len(self.sentences))